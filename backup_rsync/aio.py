@@ -0,0 +1,200 @@
+"""
+asyncio API, to drive backups from an event loop (e.g. an orchestration service):
+
+    run = run_async(backup, timeout=3600)
+    async for event in run:  # optional: progress and itemized changes, as they happen
+        ...
+    result = await run
+
+The backup runs in a worker thread (shards, fan-out and retries keep their own threads),
+its rsync processes are stopped on cancellation or timeout: SIGTERM, then SIGKILL after a grace period.
+Interrupted rsync keep their partial files (see Endpoint.partial), so that the next run resumes them.
+"""
+import asyncio
+import os
+import signal
+import threading
+import time
+from dataclasses import dataclass
+from datetime import datetime
+from subprocess import Popen
+from typing import Dict, Optional
+from backup_rsync.progress import parse_progress_line
+from backup_rsync.report import parse_change_line
+
+# rsync exit code when stopped by a signal
+CANCELLED_CODE = 20
+
+
+@dataclass
+class RunResult:
+    code: Optional[int]  # rsync code (the worst one, when several rsync ran)
+    started: datetime
+    finished: datetime
+    cancelled: bool = False
+    timed_out: bool = False
+    report: Optional[Dict] = None  # see RunReport.as_dict
+
+    @property
+    def ok(self) -> bool:
+        return self.code == 0
+
+
+class ProcessGroup:
+    """ rsync processes of a run, to be terminated together. Once terminated, no new process is started """
+    def __init__(self):
+        self._processes = set()
+        self._lock = threading.Lock()
+        self.terminated = threading.Event()
+
+    def popen(self, cmd, **kwargs) -> Optional[Popen]:
+        """ start a process of the group, None if the group is terminated """
+        with self._lock:
+            if self.terminated.is_set():
+                return None
+            process = Popen(cmd, **kwargs)
+            self._processes.add(process)
+            return process
+
+    def wait(self, process: Popen, usage: bool = False):
+        """
+        wait for a process of the group, and remove it from the group.
+        It is only reaped under the lock, so that a signal never reaches another process reusing its pid.
+        With usage, returns its resource usage (see os.wait4).
+        """
+        os.waitid(os.P_PID, process.pid, os.WEXITED | os.WNOWAIT)  # exited, but not reaped yet
+        with self._lock:
+            self._processes.discard(process)
+            if not usage:
+                process.wait()
+                return None
+            _, status, resource_usage = os.wait4(process.pid, 0)
+            process.returncode = os.waitstatus_to_exitcode(status)
+            return resource_usage
+
+    def _signal(self, signum: int):
+        with self._lock:
+            for process in self._processes:
+                if process.returncode is None:  # not reaped (see wait)
+                    try:
+                        os.kill(process.pid, signum)
+                    except OSError:
+                        pass
+
+    def terminate(self, grace: float):
+        """ SIGTERM the running processes, SIGKILL those still running after grace seconds """
+        self.terminated.set()
+        self._signal(signal.SIGTERM)
+        deadline = time.monotonic() + grace
+        while time.monotonic() < deadline:
+            with self._lock:
+                if not self._processes:
+                    return
+            time.sleep(.1)
+        self._signal(signal.SIGKILL)
+
+
+class EventListener:
+    """ turns rsync output lines into events (progress and itemized changes), given to callback """
+    def __init__(self, callback):
+        self._callback = callback
+
+    def feed(self, line: str, channel: int = 0):
+        progress = parse_progress_line(line)
+        if progress is not None:
+            self._callback(dict(progress, type='progress', channel=channel))
+            return
+        change = parse_change_line(line)
+        if change is not None:
+            self._callback(dict(change, type='change', channel=channel))
+
+    def close(self, code: int):
+        self._callback(dict(type='finished', code=int(code)))
+
+
+def _in_thread(func) -> asyncio.Future:
+    """ run func in its own thread (not the default executor, whose size would bound concurrent backups) """
+    loop = asyncio.get_running_loop()
+    future = loop.create_future()
+
+    def target():
+        try:
+            result = func()
+        except BaseException as e:
+            loop.call_soon_threadsafe(future.set_exception, e)
+        else:
+            loop.call_soon_threadsafe(future.set_result, result)
+
+    threading.Thread(target=target, name='backup', daemon=True).start()
+    return future
+
+
+class AsyncRun:
+    """ a backup running in background: async iterable of its events, and awaitable of its result """
+    def __init__(self, backup, timeout: Optional[float] = None, grace: float = 10.):
+        self._backup = backup
+        self._timeout = timeout
+        self._grace = grace
+        self._task = None
+        self._events = None
+        self._cancelled = False
+
+    def _start(self):
+        if self._task is not None:
+            return
+        loop = asyncio.get_running_loop()
+        self._events = asyncio.Queue()
+        self._backup._event_listener = EventListener(
+            lambda event: loop.call_soon_threadsafe(self._events.put_nowait, event))
+        self._backup._processes = ProcessGroup()
+        self._task = loop.create_task(self._run())
+
+    async def _stop(self, future) -> Optional[int]:
+        await asyncio.to_thread(self._backup._processes.terminate, self._grace)
+        return await future
+
+    async def _run(self) -> RunResult:
+        started = datetime.now()
+        future = _in_thread(self._backup.save)
+        timed_out = False
+        try:
+            code = await asyncio.wait_for(asyncio.shield(future), self._timeout)
+        except asyncio.TimeoutError:
+            timed_out = True
+            code = await self._stop(future)
+        except asyncio.CancelledError:
+            if not self._cancelled:
+                await self._stop(future)
+                raise
+            code = await self._stop(future)  # cancel(): stopped, but still gives a result
+        finally:
+            self._events.put_nowait(None)
+        report = getattr(self._backup, '_report', None)
+        return RunResult(code=code, started=started, finished=datetime.now(),
+                         cancelled=self._cancelled, timed_out=timed_out,
+                         report=report.as_dict() if report is not None else None)
+
+    def cancel(self):
+        """ stop the backup: awaiting the run gives a cancelled result """
+        if self._task is not None and not self._task.done():
+            self._cancelled = True
+            self._task.cancel()
+
+    def __aiter__(self):
+        self._start()
+        return self
+
+    async def __anext__(self) -> Dict:
+        event = await self._events.get()
+        if event is None:
+            raise StopAsyncIteration
+        return event
+
+    def __await__(self):
+        self._start()
+        return self._task.__await__()
+
+
+def run_async(backup, timeout: Optional[float] = None, grace: float = 10.) -> AsyncRun:
+    """ run backup (see Backup.save) from the event loop, stopped after timeout seconds (if any) """
+    return AsyncRun(backup, timeout=timeout, grace=grace)
@@ -2,16 +2,52 @@
 # import os.path as path
 from jsonargparse import CLI
 from jsonargparse.typing import path_type
-from typing import Optional, List
+from typing import Dict, Optional, List, Literal, Tuple
 from dataclasses import dataclass, field
+import copy
 from datetime import datetime
-from subprocess import Popen
+from subprocess import Popen, PIPE
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import nullcontext
+import os
+import os.path as path
+import shlex
+import shutil
+import sys
+import tempfile
+import threading
+import time
+import weakref
 from backup_rsync.logger import Logger3
+from backup_rsync.shard import scan_top_level, split_shards, shard_filter_rules
+from backup_rsync.manifest import ManifestIndex, write_files_from
+from backup_rsync.history import incomplete_marker, list_timestamped
+from backup_rsync.progress import ProgressMonitor, pump
+from backup_rsync.report import RunReport, OUT_FORMAT
+from backup_rsync.ssh import SshMaster
+from backup_rsync.rsyncd import RsyncDaemon, daemon_config, daemon_script, read_secret
+from backup_rsync.capabilities import probe_rsync
+from backup_rsync.retry import FailedPaths, with_files_from
+from backup_rsync.journal import ChangeJournal, watch
+from backup_rsync.plan import scan_trees, compare_trees, estimate_throughput, format_plan
+from backup_rsync.throttle import Throttler, effective_policy
+from backup_rsync.dedup import dedup, format_dedup
+from backup_rsync.retention import Pruner, expired_paths
+from backup_rsync.delta import DeltaPass, delta_passes, parse_size
+from backup_rsync.filters import read_patterns, unique, stale_paths, compile_rules, write_rules
+from backup_rsync.filters import excluded_report, format_report, skipped_paths
+from backup_rsync.verify import verify_trees, verify_manifest, read_manifest, write_manifest, format_verify
+from backup_rsync.telemetry import Telemetry
+from backup_rsync.aio import CANCELLED_CODE
+from backup_rsync.catalog import CatalogIndex, ChangeRecorder, locate, format_versions
+import json
 from pathlib import PurePosixPath
 
 
 Path_d = path_type("d", docstring="path to a directory", skip_check=True)
 Path_f = path_type("f", docstring="path to a file", skip_check=True)
+# rsync codes of a complete transfer: success, or source files vanished during the transfer
+COMPLETE_CODES = (0, 24)
 
 
 @dataclass
@@ -20,12 +56,35 @@ class Startpoint:
     remote: bool = False
 
 
+@dataclass
+class Retention:
+    last: int = 1  # most recent directories to keep
+    daily: Optional[int] = None  # plus the most recent directory of each of the last N days
+    weekly: Optional[int] = None
+    monthly: Optional[int] = None
+    yearly: Optional[int] = None
+    workers: int = 4  # concurrent deletions
+    background: bool = False  # prune during the transfer, instead of after
+
+
 @dataclass
 class Endpoint:
     path: Path_f
     remote: bool = False
     history: Optional[Path_f] = None
     partial: Optional[Path_f] = None
+    snapshot: bool = False  # path is a timestamp template, unchanged files are hard-linked to previous snapshot
+    retention: Optional[Retention] = None  # of timestamped directories (history or snapshots, and logs)
+
+
+@dataclass
+class Daemon:
+    module: str = 'backup'
+    port: int = 873
+    password_file: Optional[Path_f] = None  # rsync --password-file (also the secret of a spawned daemon)
+    spawn: Optional[Literal['local', 'remote']] = None  # temporary rsync --daemon for the run (remote: via ssh)
+    # a spawned daemon requires username and password_file, and only serves the remote endpoint directory
+    timeout: float = 30.  # to wait for a spawned daemon to listen
 
 
 @dataclass
@@ -37,6 +96,17 @@ class Server:
     keyfile: Optional[Path_f] = None
     rsyncpath: Optional[str] = None
     timeout: Optional[int] = None
+    multiplex: bool = False  # share a single ssh master connection for the whole run
+    ciphers: Optional[str] = None  # e.g. aes128-gcm@openssh.com
+    daemon: Optional[Daemon] = None  # rsync:// transport instead of ssh (not encrypted, for trusted networks)
+
+
+@dataclass
+class Rotation:
+    max_size: Optional[int] = None  # rotate actions log beyond that size (bytes)
+    max_runs: Optional[int] = None  # rotate actions log after that number of runs
+    keep: Optional[int] = None  # number of rotated segments to keep (all if None)
+    compression: Optional[Literal['gzip', 'zstd']] = 'gzip'  # of rotated segments
 
 
 @dataclass
@@ -44,31 +114,152 @@ class Logging:
     actions: Optional[Path_f] = None
     progress: Optional[Path_f] = None
     errors: Optional[Path_f] = None
+    status: Optional[Path_f] = None  # json status, atomically rewritten while running
+    events: Optional[Path_f] = None  # json lines progress events
+    report: Optional[Path_f] = None  # json report of the run (stats and changes)
+    metrics: Optional[Path_f] = None  # prometheus node_exporter textfile
+    telemetry: Optional[Path_f] = None  # json time series of rsync (and ssh) cpu, io and memory
+    rotation: Optional[Rotation] = None  # of actions log, when it is not per run
+    index: bool = False  # offset of each run in actions log (in <actions>.idx)
+
+
+@dataclass
+class Sharding:
+    shards: int = 1
+    balance: Literal['directory', 'size'] = 'directory'
+    workers: Optional[int] = None
+
+
+@dataclass
+class Manifest:
+    path: Path_f
+    verify_every: int = 10  # let rsync checksum the whole tree every N runs (0: never)
+
+
+@dataclass
+class Journal:
+    path: Path_f  # written by the watch subcommand, consumed by save
+    max_entries: int = 100000  # beyond, the journal overflows and next save does a full scan
+
+
+@dataclass
+class Catalog:
+    path: Path_f  # sqlite index of file versions, for find and restore
+
+
+@dataclass
+class Dedup:
+    path: Path_f  # hash index, so that later passes only hash new files
+    min_size: int = 4096  # smaller files are not worth a link
+
+
+@dataclass
+class DeltaClass:
+    patterns: Optional[List[str]] = None  # files matching one of these glob patterns (rsync filter syntax)
+    min_size: Optional[str] = None  # or files of at least that size (rsync size, e.g. 1G)
+    whole_file: Optional[bool] = None  # True: no delta algorithm (fast on local or LAN), False: force it
+    inplace: bool = False  # update destination file directly (no temp copy), e.g. large VM images
+    append_verify: bool = False  # only send the end of files that grew (e.g. logs), implies inplace
+    block_size: Optional[int] = None  # delta algorithm block size (bytes)
+
+
+@dataclass
+class Verification:
+    after_save: bool = False  # verify destination against source at the end of each successful save
+    sample: float = 1.  # fraction of files verified per run (e.g. 0.01), rotating every day over all files
+    workers: Optional[int] = None  # hashing processes
+    manifest: Optional[Path_f] = None  # hashes of verified files, per destination (e.g. next to the logs)
+
+
+@dataclass
+class Filters:
+    exclude_from: List[Path_f] = field(default_factory=list)  # files of exclude patterns, one per line
+    ignore_file: Optional[str] = None  # per-directory exclude patterns file name (e.g. .backupignore)
+    min_size: Optional[str] = None  # do not transfer smaller files (rsync size, e.g. 10K)
+    max_size: Optional[str] = None  # do not transfer larger files (rsync size, e.g. 10G)
+    max_age: Optional[float] = None  # do not transfer files not modified for that many days
+
+
+@dataclass
+class Compression:
+    enabled: Optional[bool] = None  # default: only for remote transfers
+    algorithm: Optional[Literal['zstd', 'lz4', 'zlibx', 'zlib']] = None  # if supported by rsync
+    level: Optional[int] = None
+    skip: Optional[List[str]] = None  # suffixes not to compress (e.g. jpg, mp4, zip)
+
+
+@dataclass
+class Retry:
+    attempts: int = 1  # maximum number of rsync runs (1: no retry)
+    delay: float = 60.  # seconds before first retry
+    backoff: float = 2.  # delay multiplier between retries
+    codes: List[int] = field(default_factory=lambda: [23, 24, 30, 35, 255])  # rsync codes worth a retry
+
+
+@dataclass
+class Window:
+    start: str  # HH:MM
+    end: str  # HH:MM, may be before start (over midnight)
+    bwlimit: Optional[str] = None
+    nice: Optional[int] = None
+    ionice: Optional[Literal['idle', 'best-effort', 'realtime']] = None
+    ionice_level: Optional[int] = None
+    pause: bool = False  # do not transfer at all during that window
+
+
+@dataclass
+class Schedule:
+    bwlimit: Optional[str] = None  # rsync --bwlimit (e.g. 10M), at launch
+    nice: Optional[int] = None
+    ionice: Optional[Literal['idle', 'best-effort', 'realtime']] = None
+    ionice_level: Optional[int] = None
+    windows: List[Window] = field(default_factory=list)  # time windows, overriding the above
+    max_load: Optional[float] = None  # pause rsync while load average is above
+    max_busy: Optional[float] = None  # pause rsync while disk is busy above this ratio (0-1)
+    disk: Optional[str] = None  # block device for max_busy (e.g. sda)
+    interval: float = 5.  # seconds between checks
 
 
 @dataclass
 class Backup:
     source: Startpoint
-    destination: Endpoint
+    destination: Endpoint | List[Endpoint]  # several: fan-out from a single source scan
     dryrun: bool = False
     logging: Logging = field(default_factory=lambda: Logging())
-    server: Optional[Server] = None
+    server: Optional[Server | str] = None  # or the name of a shared server (see JobsConfig)
     exclude: Optional[str | List[str]] = None
+    filters: Filters = field(default_factory=lambda: Filters())
     rsync_local_path: str = 'rsync'
+    sharding: Sharding = field(default_factory=lambda: Sharding())
+    manifest: Optional[Manifest] = None
+    journal: Optional[Journal] = None
+    compression: Compression = field(default_factory=lambda: Compression())
+    retry: Retry = field(default_factory=lambda: Retry())
+    schedule: Schedule = field(default_factory=lambda: Schedule())
+    deduplication: Optional[Dedup] = None
+    delta: List[DeltaClass] = field(default_factory=list)  # per file class transfer policy, one rsync pass each
+    verification: Verification = field(default_factory=lambda: Verification())
+    fanout: Literal['batch', 'parallel'] = 'batch'  # how extra destinations are updated
+    catalog: Optional[Catalog] = None  # versions of the files of the (first) destination
 
-    def _format_path(self, node_path: Optional[Path_f | str], is_dir: bool) -> Optional[str]:
-        if node_path is None:
-            return
-        # transform date template
-        # assert isinstance(node_path, Path_f)
-        assert isinstance(self._timestamp, datetime)
+    @staticmethod
+    def _template_path(node_path: Path_f | str) -> str:
+        """ make path absolute (relative to config), but keep date template as is """
         if isinstance(node_path, Path_f):
             is_absolute = node_path.relative == node_path.absolute
             cwd = node_path.cwd
             node_path = node_path.relative
             if not is_absolute:
                 node_path = cwd + '/' + node_path
+        return node_path
 
+    def _format_path(self, node_path: Optional[Path_f | str], is_dir: bool) -> Optional[str]:
+        if node_path is None:
+            return
+        # transform date template
+        # assert isinstance(node_path, Path_f)
+        assert isinstance(self._timestamp, datetime)
+        node_path = self._template_path(node_path)
         node_path = self._timestamp.strftime(node_path)
         # force tailing slash for directories
         if is_dir and not node_path.endswith('/'):
@@ -77,7 +268,23 @@ class Backup:
 
     def __post_init__(self):
         """ check config validity """
-        self._timestamp = datetime.now()  # make a common timestamp for the all lifetime
+        # make a common timestamp for the all lifetime (kept by fan-out copies)
+        self._timestamp = getattr(self, '_timestamp', None) or datetime.now()
+
+        # extra destinations are handled by copies of this backup
+        self._fanout = []
+        if isinstance(self.destination, list):
+            if not self.destination:
+                raise ValueError('Missing destination.')
+            if len(self.destination) > 1 and (self.sharding.shards > 1 or self.delta):
+                raise ValueError('Multiple destinations cannot be combined with sharding or delta classes.')
+            destinations = self.destination
+            self.destination = destinations[0]
+            for destination in destinations[1:]:
+                fanout = copy.copy(self)
+                fanout.destination = destination
+                fanout.__post_init__()
+                self._fanout.append(fanout)
 
         # reformat exclude
         if self.exclude is None:
@@ -90,6 +297,50 @@ class Backup:
             raise ValueError('Source and destination cannot be both remotes.')
         if (self.source.remote or self.destination.remote) and self.server is None:
             raise ValueError('Missing remote server info.')
+        if self.sharding.shards < 1:
+            raise ValueError('Sharding requires at least 1 shard.')
+        if self.sharding.shards > 1 and self.source.remote:
+            raise ValueError('Sharding requires a local source.')
+        if self.manifest is not None and self.source.remote:
+            raise ValueError('Manifest requires a local source.')
+        if self.journal is not None:
+            if self.source.remote:
+                raise ValueError('Journal requires a local source.')
+            if self.manifest is not None:
+                raise ValueError('Journal and manifest are exclusive.')
+        if self.destination.snapshot:
+            if '%' not in str(self._template_path(self.destination.path)):
+                raise ValueError('Snapshot destination path must be a date template (e.g. %Y-%m-%d-%H-%M).')
+            if self.destination.remote:
+                raise ValueError('Snapshot requires a local destination.')
+            if self.destination.history is not None:
+                raise ValueError('Snapshot and history are exclusive.')
+            if self.manifest is not None or self.journal is not None:
+                raise ValueError('Snapshot cannot only transfer the changed files (manifest or journal).')
+        if self.destination.retention is not None:
+            if self.destination.remote:
+                raise ValueError('Retention requires a local destination.')
+            if self.destination.retention.last < 1:
+                raise ValueError('Retention must keep at least the last directory.')
+            if not self._retention_templates():
+                raise ValueError('Retention requires timestamped history, snapshots or logs.')
+        for delta_class in self.delta:
+            if (delta_class.patterns is None) == (delta_class.min_size is None):
+                raise ValueError('Delta class requires either patterns or min_size.')
+        if self.delta and self.sharding.shards > 1:
+            raise ValueError('Delta classes and sharding are exclusive.')
+        if self.deduplication is not None and any(c.inplace or c.append_verify for c in self.delta):
+            raise ValueError('Inplace transfer would modify the history copies linked by deduplication.')
+        if (self.filters.min_size or self.filters.max_size) and any(c.min_size for c in self.delta):
+            raise ValueError('Size filters cannot be combined with delta size classes.')
+        if self.filters.max_age is not None and self.source.remote:
+            raise ValueError('Age filter requires a local source.')
+        if self.catalog is not None and self.destination.remote:
+            raise ValueError('Catalog requires a local destination.')
+        if not 0. < self.verification.sample <= 1.:
+            raise ValueError('Verification sample must be in ]0, 1].')
+        if (self.logging.rotation is not None or self.logging.index) and self.logging.actions is None:
+            raise ValueError('Log rotation and index require an actions log file.')
 
         self._source_dirpath = self._format_path(self.source.path, is_dir=True)
         self._destination_dirpath = self._format_path(self.destination.path, is_dir=True)
@@ -98,6 +349,19 @@ class Backup:
         self._actions_filepath = self._format_path(self.logging.actions, is_dir=False)
         self._progress_filepath = self._format_path(self.logging.progress, is_dir=False)
         self._errors_filepath = self._format_path(self.logging.errors, is_dir=False)
+        self._status_filepath = self._format_path(self.logging.status, is_dir=False)
+        self._events_filepath = self._format_path(self.logging.events, is_dir=False)
+        self._report_filepath = self._format_path(self.logging.report, is_dir=False)
+        self._metrics_filepath = self._format_path(self.logging.metrics, is_dir=False)
+        self._telemetry_filepath = self._format_path(self.logging.telemetry, is_dir=False)
+        self._manifest_filepath = self._format_path(self.manifest.path, is_dir=False) if self.manifest else None
+        self._journal_filepath = self._format_path(self.journal.path, is_dir=False) if self.journal else None
+        self._dedup_filepath = self._format_path(self.deduplication.path, is_dir=False) if self.deduplication else None
+        self._catalog_filepath = self._format_path(self.catalog.path, is_dir=False) if self.catalog else None
+        self._verification_filepath = self._format_path(self.verification.manifest, is_dir=False)
+        self._link_dest_dirpath = self._previous_snapshot() if self.destination.snapshot else None
+        if not isinstance(self.server, str):  # shared server names are resolved by JobsConfig, then checked
+            self._check_server()
         # logging
         # check logfile (if any) is not inside destination (or source)
         # because, it may be destroyed or unnecessarily backup
@@ -111,45 +375,326 @@ class Backup:
         # todo: check against parameter injection
 
     def __str__(self):
-        rsync_cmd = self._create_rsync_command()
-        # make it safe
-        # destination = rsync_cmd.pop()
-        # source = rsync_cmd.pop()
-        # rsync = rsync_cmd.pop(0)
-        for i, opt in enumerate(rsync_cmd):
-            if '=' in opt and ' ' in opt:
-                e = opt.split('=')
-                rsync_cmd[i] = f"{e[0]}='{e[1]}'"
-        return ' '.join(rsync_cmd)
-
-    def _create_rsync_command(self) -> List[str]:
-        """ create the rsync command as a list of strings """
+        return ' '.join(self._quoted_command(self._create_rsync_command(inline_filters=True)))
+
+    @staticmethod
+    def _quoted_command(rsync_cmd: List[str]) -> List[str]:
+        """ make it safe to paste in a shell: option values (up to their first =) and paths are quoted """
+        quoted = []
+        for arg in rsync_cmd:
+            if arg.startswith('--') and '=' in arg:
+                option, value = arg.split('=', 1)
+                quoted.append(f'{option}={shlex.quote(value)}')
+            else:
+                quoted.append(shlex.quote(arg))
+        return quoted
+
+    def _previous_snapshot(self) -> Optional[str]:
+        """ most recent snapshot before this one, if any """
+        previous = [p for t, p in self._snapshots()
+                    if t <= self._timestamp and p.rstrip('/') != self._destination_dirpath.rstrip('/')]
+        if not previous:
+            return None
+        return previous[-1].rstrip('/') + '/'
+
+    def _retention_templates(self) -> List[str]:
+        """ strftime templates of the directories subject to retention """
+        templates = []
+        if self.destination.snapshot:
+            templates.append(self._template_path(self.destination.path))
+        elif self.destination.history is not None:
+            templates.append(self._template_path(self.destination.history))
+        for logfile in [self.logging.actions, self.logging.progress, self.logging.errors]:
+            if logfile is not None:
+                templates.append(path.dirname(self._template_path(logfile)))
+        templates = [t.rstrip('/') for t in templates if '%' in t]
+        return sorted(set(templates), key=templates.index)
+
+    def _expired(self) -> List[str]:
+        """ timestamped directories not kept by the retention policy (never the ones used by this run) """
+        retention = self.destination.retention
+        in_use = {p.rstrip('/') for p in [self._destination_dirpath, self._history_dirpath, self._link_dest_dirpath,
+                                          self._actions_filepath, self._progress_filepath, self._errors_filepath]
+                  if p is not None}
+        in_use |= {path.dirname(p) for p in in_use}
+        expired = []
+        for template in self._retention_templates():
+            expired += [p for p in expired_paths(template, last=retention.last, daily=retention.daily,
+                                                 weekly=retention.weekly, monthly=retention.monthly,
+                                                 yearly=retention.yearly)
+                        if p.rstrip('/') not in in_use and p not in expired]
+        return expired
+
+    @property
+    def _ssh_host(self) -> str:
+        if self.server.username:
+            return self.server.username + '@' + self.server.url
+        return self.server.url
+
+    @property
+    def _ssh_control_path(self) -> str:
+        return path.join(self._workdir, 'ssh.sock')
+
+    @property
+    def _ssh_cmd(self) -> List[str]:
+        """ ssh client command (without host), for connections outside rsync """
+        ssh_cmd = [self.server.sshpath or 'ssh']
+        if self.server.port:
+            ssh_cmd += ['-p', str(self.server.port)]
+        if self.server.keyfile:
+            ssh_cmd += ['-i', self._format_path(self.server.keyfile, is_dir=False)]
+        if self.server.ciphers:
+            ssh_cmd += ['-c', self.server.ciphers]
+        if self.server.timeout:
+            ssh_cmd += ['-o', f'ConnectTimeout={int(self.server.timeout)}']
+        return ssh_cmd
+
+    def _ssh_master(self, logger: Logger3):
+        """ master ssh connection for the whole run, if multiplexing is enabled """
+        if self.server is None or not self.server.multiplex:
+            return nullcontext()
+        master = SshMaster(self._ssh_cmd, self._ssh_host, self._ssh_control_path)
+        logger.actions.write(f'ssh master connection to {self._ssh_host}.\n')
+        return master
+
+    @property
+    def _daemon_url(self) -> str:
+        """ rsync:// prefix of remote paths (module paths are relative to the module) """
+        return f'rsync://{self._ssh_host}:{int(self.server.daemon.port)}/{self.server.daemon.module}/'
+
+    def _check_server(self):
+        """ checks depending on the server, once it is known """
+        if isinstance(self.server, str):
+            raise ValueError(f'Unknown server {self.server}: shared servers are only defined in jobs configs.')
+        if self.server is None or self.server.daemon is None:
+            return
+        if self.server.multiplex or self.server.ciphers:
+            raise ValueError('Ssh multiplexing and ciphers do not apply to the daemon transport.')
+        if self.server.daemon.spawn:
+            if not (self.server.daemon.password_file and self.server.username):
+                raise ValueError('Spawned daemon requires a username and a password file.')
+            if self.server.daemon.spawn == 'local' and self.server.url not in ('localhost', '127.0.0.1'):
+                raise ValueError('Local spawned daemon only listens on localhost.')
+            if len(self._fanout) > 0:
+                raise ValueError('Spawned daemon only serves a single destination.')
+            if self.destination.remote:
+                for dirpath in [self._history_dirpath, self._partial_dirpath]:
+                    if dirpath is not None and not dirpath.startswith(self._destination_dirpath):
+                        raise ValueError('Spawned daemon only serves the destination: history and partial '
+                                         'directories must be inside it.')
+
+    @property
+    def _spawned_daemon(self) -> Optional[Daemon]:
+        if isinstance(self.server, Server) and self.server.daemon is not None and self.server.daemon.spawn:
+            return self.server.daemon
+        return None
+
+    def _remote_path(self, dirpath: str) -> str:
+        """
+        remote directory, as given to the daemon: a spawned daemon module is the remote endpoint directory,
+        and the daemon (no chroot) resolves absolute paths from the module directory
+        """
+        if self._spawned_daemon is None:
+            return dirpath
+        return path.normpath('/' + path.relpath(dirpath, self._destination_dirpath)).rstrip('/') + '/'
+
+    def _rsync_daemon(self, logger: Logger3):
+        """ temporary rsync daemon for the whole run, if it has to be spawned """
+        daemon = self._spawned_daemon
+        if daemon is None:
+            return nullcontext()
+        secret = read_secret(self._format_path(daemon.password_file, is_dir=False))
+        module_dirpath = self._source_dirpath if self.source.remote else self._destination_dirpath
+        config = daemon_config(daemon.module, module_dirpath, self.server.username, read_only=self.source.remote)
+        if daemon.spawn == 'local':
+            host = '127.0.0.1'
+            cmd = ['sh', '-c', daemon_script(self.rsync_local_path, config, daemon.port, self.server.username,
+                                             remote=False)]
+        else:
+            host = self.server.url
+            script = daemon_script(self.server.rsyncpath or 'rsync', config, daemon.port, self.server.username,
+                                   remote=True)
+            cmd = self._ssh_cmd + ['-o', 'BatchMode=yes', self._ssh_host, script]
+        logger.actions.write(f'rsync daemon ({daemon.spawn}) on {self.server.url}:{daemon.port}.\n')
+        return RsyncDaemon(cmd, host, daemon.port, secret=secret, timeout=daemon.timeout)
+
+    def _throttler(self, logger: Logger3):
+        """ apply schedule policy to running rsync, if needed """
+        schedule = self.schedule
+        if (schedule.nice is None and schedule.ionice is None and not schedule.windows
+                and schedule.max_load is None and schedule.max_busy is None):
+            return nullcontext()
+        max_pause = None
+        if (self.source.remote or self.destination.remote) and self.server.timeout:
+            max_pause = self.server.timeout / 2  # rsync --timeout: the remote rsync gives up without data
+        return Throttler(schedule, max_pause=max_pause, errors=logger.errors)
+
+    @property
+    def _workdir(self) -> str:
+        """ temporary directory for files generated for rsync, removed with the instance """
+        if getattr(self, '_workdirpath', None) is None:
+            self._workdirpath = tempfile.mkdtemp(prefix='backup_rsync-')
+            weakref.finalize(self, shutil.rmtree, self._workdirpath, ignore_errors=True)
+        return self._workdirpath
+
+    @property
+    def _exclude_patterns(self) -> List[str]:
+        """ exclude patterns of the config and of the exclude files, in order (see read_patterns) """
+        patterns = list(self.exclude)
+        for filepath in self.filters.exclude_from:
+            patterns += read_patterns(self._format_path(filepath, is_dir=False))
+        return patterns
+
+    @property
+    def _compiled_filters(self) -> bool:
+        """ whether filter rules are compiled (short exclude lists stay --exclude options) """
+        return bool(self.filters.exclude_from or self.filters.ignore_file or self.filters.max_age is not None
+                    or len(self.exclude) > 32 or any(e.startswith('!') for e in self.exclude))
+
+    def _filter_rules_filepath(self) -> Optional[str]:
+        """
+        filter rules compiled in a file (only when needed, see _compiled_filters):
+        it avoids argument length limits, and rsync parses rules once.
+        The file is kept beside the actions log (if any), so that the logged command can be run again.
+        Age filter rules walk the source.
+        """
+        if not self._compiled_filters:
+            return None
+        filepath = getattr(self, '_filter_rules_filepath_cache', None)
+        if filepath is None:
+            stale = None
+            if self.filters.max_age is not None:
+                stale = stale_paths(self._source_dirpath, self.filters.max_age)
+            if self._actions_filepath is not None:
+                filepath = self._actions_filepath + '.filter'
+                os.makedirs(path.dirname(filepath) or '.', exist_ok=True)
+            else:
+                filepath = path.join(self._workdir, 'filter.rules')
+            write_rules(filepath, compile_rules(self._exclude_patterns, self.filters.ignore_file, stale))
+            self._filter_rules_filepath_cache = filepath
+        return filepath
+
+    def excluded(self, as_json: bool = False):
+        """ files and bytes excluded by each rule (and by size and age filters), to find which rules are worth it """
+        if self.source.remote:
+            raise ValueError('Excluded report requires a local source.')
+        report = excluded_report(
+            self._source_dirpath, self._exclude_patterns, ignore_file=self.filters.ignore_file,
+            min_size=parse_size(self.filters.min_size) if self.filters.min_size else None,
+            max_size=parse_size(self.filters.max_size) if self.filters.max_size else None,
+            max_age=self.filters.max_age)
+        print(json.dumps(report, indent=2) if as_json else format_report(report))
+
+    def _add_compression_options(self, rsync_option_list: set):
+        """ compress only what is worth it: remote transfers, with the best algorithm rsync supports """
+        enabled = self.compression.enabled
+        if enabled is None:
+            enabled = self.source.remote or self.destination.remote
+        if not enabled:
+            return
+        rsync_option_list.add('--compress')  # Compress file data during the transfer
+        if self.compression.algorithm:
+            capabilities = probe_rsync(self.rsync_local_path)
+            if capabilities is None or self.compression.algorithm in capabilities.compressions:
+                rsync_option_list.add(f'--compress-choice={self.compression.algorithm}')
+        if self.compression.level is not None:
+            rsync_option_list.add(f'--compress-level={int(self.compression.level)}')
+        if self.compression.skip:
+            rsync_option_list.add('--skip-compress=' + '/'.join(s.lstrip('.') for s in self.compression.skip))
+
+    def _create_rsync_command(
+            self,
+            filter_filepaths: Optional[List[str]] = None,
+            first_filter_filepaths: Optional[List[str]] = None,
+            partial_dirpath: Optional[str] = None,
+            actions_filepath: Optional[str] = None,
+            files_from: Optional[str] = None,
+            delta_pass: Optional[DeltaPass] = None,
+            inline_filters: bool = False,
+    ) -> List[str]:
+        """
+        create the rsync command as a list of strings
+        filter_filepaths, partial_dirpath and actions_filepath override the config (e.g. for shards).
+        first_filter_filepaths come before the config filter rules, filter_filepaths after.
+        files_from restricts the transfer to the listed paths (NUL separated, relative to source),
+        listed paths missing on source are deleted on destination.
+        delta_pass restricts the transfer to a file class, with its own options (see delta_passes).
+        inline_filters gives compiled filter rules as options instead of a file, without the age filter rules
+        (they walk the source), to print the command.
+        """
+        if isinstance(self.server, str):
+            self._check_server()  # not resolved by a jobs config
+        partial_dirpath = partial_dirpath or self._partial_dirpath
+        actions_filepath = actions_filepath or self._actions_filepath
         rsync_option_list = set()
+        # ordered options (e.g. filter rules), appended after the others
+        rsync_filter_list = [f'--filter=merge {f}' for f in filter_filepaths or []]
+        if delta_pass is not None:
+            rsync_option_list.update(delta_pass.options)
+            rsync_filter_list += [f'--filter={rule}' for rule in delta_pass.rules]
         # generic options
         rsync_option_list.add('--update')  # Skip files that are newer on the receiver
         rsync_option_list.add('--recursive')  # recurse into directories
-        rsync_option_list.add('--compress')  # Compress file data during the transfer
+        self._add_compression_options(rsync_option_list)
         rsync_option_list.add('--links')  # Copy symlinks as symlinks
         rsync_option_list.add('--times')  # preserve modification times (important for update)
-        rsync_option_list.add('--checksum')  # replace the times+sizes heuristic with sizes+md5 one
+        if files_from is None:
+            rsync_option_list.add('--checksum')  # replace the times+sizes heuristic with sizes+md5 one
+        else:
+            # the list of changed files already replaces the checksum
+            rsync_option_list.add(f'--files-from={files_from}')
+            rsync_option_list.add('--from0')  # list is NUL separated
+            rsync_option_list.add('--delete-missing-args')  # listed but missing on source: delete
         rsync_option_list.add('--delete')  # Delete extraneous files from destination dirs
         rsync_option_list.add('--delete-excluded')  # also delete the excluded files
         rsync_option_list.add('--one-file-system')  # Do not cross filesystem boundaries when recursing
         rsync_option_list.add('--verbose')
         rsync_option_list.add('--progress')
+        event_listener = getattr(self, '_event_listener', None)
+        if self._status_filepath or self._events_filepath or event_listener is not None:
+            rsync_option_list.add('--info=progress2')  # progress of the whole transfer, instead of per file
+        if self._report_filepath or self._metrics_filepath or event_listener is not None or self.catalog is not None:
+            rsync_option_list.add('--stats')  # give some file-transfer stats
+            rsync_option_list.add(f'--out-format={OUT_FORMAT}')  # itemized changes, with file size
 
         # enable partial copy to save time on resume
-        if self._partial_dirpath is not None:
+        if partial_dirpath is not None and not (delta_pass and delta_pass.inplace):
             rsync_option_list.add('--partial')  # Keep partially transferred files
-            rsync_option_list.add(f'--partial-dir={self._partial_dirpath}')
+            if self.destination.remote:
+                partial_dirpath = self._remote_path(partial_dirpath)
+            rsync_option_list.add(f'--partial-dir={partial_dirpath}')
+        # bandwidth limit of the current time window
+        bwlimit = effective_policy(self.schedule, datetime.now())['bwlimit']
+        if bwlimit:
+            rsync_option_list.add(f'--bwlimit={bwlimit}')
         # exclude
-        assert isinstance(self.exclude, list)
-        for e in self.exclude:
-            rsync_option_list.add(f'--exclude={e}')
+        if not self._compiled_filters:
+            for e in unique(self.exclude):
+                rsync_option_list.add(f'--exclude={e}')
+        else:
+            # all rules compiled in a single file, before any other filter rule
+            if inline_filters:
+                rules = compile_rules(self._exclude_patterns, self.filters.ignore_file)
+                rsync_filter_list[0:0] = [f'--filter={rule}' for rule in rules]
+            else:
+                rsync_filter_list.insert(0, f'--filter=merge {self._filter_rules_filepath()}')
+            if self.filters.ignore_file:
+                rsync_option_list.add('--delete-after')  # so that per-directory rules apply to deletions
+        rsync_filter_list[0:0] = [f'--filter=merge {f}' for f in first_filter_filepaths or []]
+        if self.filters.min_size:
+            rsync_option_list.add(f'--min-size={self.filters.min_size}')
+        if self.filters.max_size:
+            rsync_option_list.add(f'--max-size={self.filters.max_size}')
         # versioning
         if self._history_dirpath:
             rsync_option_list.add('--backup')  # make a backup of what changed on destination
-            rsync_option_list.add(f'--backup-dir={self._history_dirpath}')
+            history_dirpath = self._history_dirpath
+            if self.destination.remote:
+                history_dirpath = self._remote_path(history_dirpath)
+            rsync_option_list.add(f'--backup-dir={history_dirpath}')
+        # snapshot
+        if self._link_dest_dirpath:
+            rsync_option_list.add(f'--link-dest={self._link_dest_dirpath}')  # hard-link unchanged files
         # dryrun
         if self.dryrun:
             rsync_option_list.add('--dry-run')  # perform a trial run that does not make any changes
@@ -159,35 +704,57 @@ class Backup:
         dst_part = self._destination_dirpath
 
         # logging
-        if self._actions_filepath is not None:
-            rsync_option_list.add(f'--log-file={self._actions_filepath}')
+        if actions_filepath is not None:
+            rsync_option_list.add(f'--log-file={actions_filepath}')
 
         if self.server is not None:
             if self.server.timeout:
                 # maximum I/O timeout in seconds.
                 rsync_option_list.add(f'--timeout={int(self.server.timeout)}')
 
-            if self.server.sshpath or self.server.port or self.server.keyfile or self.server.rsyncpath:
+            if self.server.daemon is not None:
+                if self.server.daemon.password_file:
+                    password_filepath = self._format_path(self.server.daemon.password_file, is_dir=False)
+                    rsync_option_list.add(f'--password-file={password_filepath}')
+                if self.server.timeout:
+                    rsync_option_list.add(f'--contimeout={int(self.server.timeout)}')
+            elif (self.server.sshpath or self.server.port or self.server.keyfile or self.server.rsyncpath
+                    or self.server.ciphers or self.server.multiplex):
                 ssh_cmd = [self.server.sshpath or 'ssh']
                 if self.server.port:
                     ssh_cmd.append(f'-p {self.server.port}')
                 if self.server.keyfile:
                     ssh_cmd.append(f'-i "{self._format_path(self.server.keyfile, is_dir=False)}"')
+                if self.server.ciphers:
+                    ssh_cmd.append(f'-c {self.server.ciphers}')
+                if self.server.multiplex:
+                    # join the master connection of the run (if any)
+                    ssh_cmd.append(f'-o ControlMaster=no -o ControlPath={self._ssh_control_path}')
                 if self.server.rsyncpath:
                     ssh_cmd.append(f'--rsync-path="{self.server.rsyncpath}"')
                 rsync_option_list.add(f'--rsh=' + ' '.join(ssh_cmd))
 
-            server_prefix = self.server.url + ':'
-            if self.server.username:
-                server_prefix = self.server.username + '@' + server_prefix
-            if self.source.remote:
-                src_part = server_prefix + src_part
-            if self.destination.remote:
-                dst_part = server_prefix + dst_part
+            if self._spawned_daemon is not None:
+                # the module is the remote endpoint directory
+                if self.source.remote:
+                    src_part = self._daemon_url
+                if self.destination.remote:
+                    dst_part = self._daemon_url
+            elif self.server.daemon is not None:
+                if self.source.remote:
+                    src_part = self._daemon_url + src_part.lstrip('/')
+                if self.destination.remote:
+                    dst_part = self._daemon_url + dst_part.lstrip('/')
+            else:
+                server_prefix = self._ssh_host + ':'
+                if self.source.remote:
+                    src_part = server_prefix + src_part
+                if self.destination.remote:
+                    dst_part = server_prefix + dst_part
 
         src_part = src_part
         dst_part = dst_part
-        rsync_cmd = [self.rsync_local_path] + sorted(rsync_option_list) + [src_part, dst_part]
+        rsync_cmd = [self.rsync_local_path] + sorted(rsync_option_list) + rsync_filter_list + [src_part, dst_part]
 
         return rsync_cmd
 
@@ -195,16 +762,15 @@ class Backup:
     def rsync_command_pretty(self) -> str:
         """
         create the rsync command as a single string and with stdout/stderr redirections
-        ready to copy past in a terminal.
+        ready to copy past in a terminal (filter rules inline, see _create_rsync_command).
         """
-        cmd_str = str(self)
-        # reformat
+        return self._pretty_command(inline_filters=True)
+
+    def _pretty_command(self, inline_filters: bool) -> str:
+        cmd = self._quoted_command(self._create_rsync_command(inline_filters=inline_filters))
+        # reformat: split apart options, then source and destination
         indentation = ' ' * 4
-        cmd = cmd_str.split(' ')
-        # split apart source and destination
-        cmd_str = ' '.join(cmd[0:-2]) + '\n' + indentation + cmd[-2] + '\n' + indentation + cmd[-1]
-        # split apart options
-        cmd_str = cmd_str.replace('--', '\n' + indentation * 2 + '--')
+        cmd_str = '\n'.join([cmd[0]] + [indentation * 2 + o for o in cmd[1:-2]] + [indentation + a for a in cmd[-2:]])
         # printout
         if self._progress_filepath:
             cmd_str += f'\n1> {self._progress_filepath}'
@@ -216,29 +782,647 @@ class Backup:
         cmd_str = cmd_str.replace('\n', '\\\n')
         # except last one
         cmd_str = cmd_str[0:-2]
+        if self.filters.max_age is not None and inline_filters:
+            cmd_str += f'\n# plus hide and protect rules of the files not modified for {self.filters.max_age:g} days'
+        if self.server is not None and self.server.daemon is None and self.server.multiplex:
+            cmd_str += ('\n# ssh ControlPath is the master connection of a run, removed when it ends: '
+                        'ssh connects on its own')
         return cmd_str
 
     def debug(self):
+        """ show the rsync command (the source is not walked: see _create_rsync_command) """
         print(self.rsync_command_pretty)
+        for fanout in self._fanout:
+            print(fanout.rsync_command_pretty)
+
+    def plan(self, workers: int = 16, as_json: bool = False):
+        """
+        estimate what save would transfer (counts and bytes to create, update and delete) and how long it would take,
+        from file sizes and times only, much faster than a dry run.
+        """
+        if self.source.remote or self.destination.remote:
+            raise ValueError('Plan requires local source and destination.')
+        destination_dirpath = self._destination_dirpath
+        if self.destination.snapshot:
+            # new snapshot is compared to the previous one
+            destination_dirpath = self._link_dest_dirpath
+        source, destination = scan_trees([self._source_dirpath, destination_dirpath],
+                                         excludes=[self._exclude_patterns, []], workers=workers)
+        plan = compare_trees(source, destination, delete=not self.destination.snapshot)
+        throughput = estimate_throughput(self._template_path(self.logging.report) if self.logging.report else None)
+        plan['throughput'] = throughput
+        plan['eta'] = None
+        if throughput:
+            plan['eta'] = (plan['create']['bytes'] + plan['update']['bytes']) / throughput
+        print(json.dumps(plan, indent=2) if as_json else format_plan(plan))
+
+    def watch(self):
+        """ record source changes in the journal, for next save (runs until interrupted) """
+        if self.journal is None:
+            raise ValueError('Missing journal config.')
+        journal = ChangeJournal(self._journal_filepath, max_entries=self.journal.max_entries)
+        try:
+            watch(self._source_dirpath, journal)
+        except KeyboardInterrupt:
+            pass
+
+    def dedup(self, workers: Optional[int] = None, as_json: bool = False):
+        """
+        replace identical files across history directories (or snapshots) by hard links,
+        and report the bytes reclaimed. Can be interrupted and run again.
+        latest is left out: rsync updates the metadata of its files in place (e.g. --times),
+        which would change the history copies linked to them.
+        """
+        if self.deduplication is None:
+            raise ValueError('Missing deduplication config.')
+        if self.destination.remote:
+            raise ValueError('Dedup requires a local destination.')
+        if not self.destination.snapshot and self.destination.history is None:
+            raise ValueError('Dedup requires history directories or snapshots.')
+        preferred_dirpath = None
+        if self.destination.snapshot:
+            root_dirpaths = [p.rstrip('/') + '/' for _, p in self._snapshots()]
+            preferred_dirpath = root_dirpaths[-1] if root_dirpaths else None  # most recent snapshot
+        else:
+            root_dirpaths = [p for _, p in list_timestamped(self._template_path(self.destination.history))]
+        result = dedup(root_dirpaths, self._dedup_filepath, preferred_dirpath=preferred_dirpath,
+                       min_size=self.deduplication.min_size, workers=workers, dryrun=self.dryrun)
+        print(json.dumps(result.as_dict(), indent=2) if as_json else format_dedup(result))
+
+    def prune(self):
+        """ remove the timestamped directories not kept by the retention policy """
+        if self.destination.retention is None:
+            raise ValueError('Missing retention config.')
+        expired = self._expired()
+        if self.dryrun:
+            print(''.join(f'would remove {p}\n' for p in expired) + f'{len(expired)} directories to remove.')
+            return
+        pruner = Pruner(expired, workers=self.destination.retention.workers)
+        pruner.run()
+        for error in pruner.errors:
+            print(f'error: {error}', file=sys.stderr)
+        self._forget_pruned(pruner.paths)
+        print(f'{len(expired) - len(pruner.errors)} directories removed.')
+
+    def _forget_pruned(self, dirpaths: List[str]):
+        """ versions kept in removed history directories are no longer in the catalog """
+        removed = [p for p in dirpaths if not path.exists(p)]
+        if self._catalog_filepath is None or not removed:
+            return
+        with CatalogIndex(self._catalog_filepath) as catalog:
+            for dirpath in removed:
+                catalog.forget(dirpath)
+
+    def _snapshots(self) -> List[Tuple[datetime, str]]:
+        """ complete snapshots (oldest first), if destination is made of snapshots (see _mark_incomplete) """
+        if not self.destination.snapshot:
+            return []
+        return list_timestamped(self._template_path(self.destination.path), complete=True)
+
+    def find(self, pattern: str, at: Optional[str] = None, as_json: bool = False):
+        """
+        versions of the files matching a glob pattern (or below a directory), from the catalog:
+        when each was written and replaced, only the one current at a given time (iso format), if any.
+        """
+        if self._catalog_filepath is None:
+            raise ValueError('Missing catalog config.')
+        with CatalogIndex(self._catalog_filepath) as catalog:
+            versions = catalog.versions(pattern, at=datetime.fromisoformat(at) if at else None)
+        print(json.dumps([v.as_dict() for v in versions], indent=2) if as_json else format_versions(versions))
+
+    def restore(self, pattern: str, to: str, at: Optional[str] = None):
+        """
+        copy the files matching a glob pattern (or below a directory) into the directory to,
+        as they were at a given time (iso format, default now), found from the catalog.
+        """
+        if self._catalog_filepath is None:
+            raise ValueError('Missing catalog config.')
+        timestamp = datetime.fromisoformat(at) if at else datetime.now()
+        with CatalogIndex(self._catalog_filepath) as catalog:
+            versions = catalog.versions(pattern, at=timestamp)
+        snapshots = self._snapshots()
+        restored = 0
+        for version in versions:
+            filepath = locate(version, self._destination_dirpath, snapshots, at=timestamp)
+            if filepath is None or not path.exists(filepath):
+                print(f'error: {version.path} not found (removed since indexed?)', file=sys.stderr)
+                continue
+            target_filepath = path.join(to, version.path)
+            os.makedirs(path.dirname(target_filepath) or '.', exist_ok=True)
+            shutil.copy2(filepath, target_filepath, follow_symlinks=False)
+            restored += 1
+        print(f'{restored} files restored to {to}.')
+
+    def reindex(self):
+        """ rebuild the catalog from existing directories (snapshots, or history directories and destination) """
+        if self._catalog_filepath is None:
+            raise ValueError('Missing catalog config.')
+        with CatalogIndex(self._catalog_filepath) as catalog:
+            if self.destination.snapshot:
+                catalog.reindex_snapshots(self._snapshots())
+            else:
+                histories = []
+                if self.destination.history is not None:
+                    histories = list_timestamped(self._template_path(self.destination.history))
+                catalog.reindex_history(histories, self._destination_dirpath)
+            count = len(catalog.versions('*'))
+        print(f'{count} versions indexed.')
+
+    def _verification_manifests(self) -> Dict[str, Dict[str, List]]:
+        """ verification manifests, by verified directory """
+        if self._verification_filepath is None or not path.exists(self._verification_filepath):
+            return {}
+        return read_manifest(self._verification_filepath)
+
+    def _verify(self, destination_dirpath: str, one_side: bool = False,
+                sample: Optional[float] = None, workers: Optional[int] = None):
+        """ verify destination against source (or against its verification manifest, if one_side) """
+        if self.source.remote or self.destination.remote:
+            raise ValueError('Verify requires local source and destination.')
+        sample = self.verification.sample if sample is None else sample
+        workers = workers or self.verification.workers
+        rotation = self._timestamp.toordinal()
+        destination_dirpath = destination_dirpath.rstrip('/') + '/'
+        manifests = self._verification_manifests()
+        if one_side:
+            return verify_manifest(destination_dirpath, manifests[destination_dirpath],
+                                   sample=sample, rotation=rotation, workers=workers)
+        skipped = None
+        if self.filters.ignore_file or self.filters.min_size or self.filters.max_size or self.filters.max_age:
+            # files rsync does not transfer, with the same rules (see _filter_rules_filepath)
+            skipped = skipped_paths(
+                self._source_dirpath, self._exclude_patterns, ignore_file=self.filters.ignore_file,
+                min_size=parse_size(self.filters.min_size) if self.filters.min_size else None,
+                max_size=parse_size(self.filters.max_size) if self.filters.max_size else None,
+                max_age=self.filters.max_age)
+        result, manifest = verify_trees(self._source_dirpath, destination_dirpath, excludes=self._exclude_patterns,
+                                        sample=sample, rotation=rotation, workers=workers, skipped=skipped)
+        if self._verification_filepath is not None and not self.dryrun:
+            # samples add up, manifests of removed directories (e.g. pruned snapshots) are dropped
+            manifests = {dirpath: m for dirpath, m in manifests.items() if path.isdir(dirpath)}
+            manifests[destination_dirpath] = {**manifests.get(destination_dirpath, {}), **manifest}
+            os.makedirs(path.dirname(self._verification_filepath) or '.', exist_ok=True)
+            write_manifest(self._verification_filepath, manifests)
+        return result
+
+    def _verified_dirpath(self, with_manifest: bool) -> str:
+        """
+        destination to verify: the most recent snapshot, or latest.
+        with_manifest: the most recent one with a verification manifest.
+        """
+        if self.destination.snapshot:
+            candidates = [p.rstrip('/') + '/' for _, p in self._snapshots()]
+        else:
+            candidates = [self._destination_dirpath]
+        if with_manifest:
+            manifests = self._verification_manifests()
+            candidates = [d for d in candidates if d in manifests]
+            if not candidates:
+                raise ValueError('No verification manifest to verify against.')
+        if not candidates:
+            raise ValueError('No snapshot to verify.')
+        return candidates[-1]
+
+    def verify(self, one_side: bool = False, sample: Optional[float] = None, workers: Optional[int] = None,
+               as_json: bool = False) -> bool:
+        """
+        hash source and destination files and compare them, then write the manifest of verified files (if any).
+        With one_side, only hash destination files, against the manifest of the last verification.
+        """
+        destination_dirpath = self._verified_dirpath(with_manifest=one_side)
+        result = self._verify(destination_dirpath, one_side=one_side, sample=sample, workers=workers)
+        print(json.dumps(result.as_dict(), indent=2) if as_json else format_verify(result))
+        return result.ok
 
-    def save(self):
+    def save(self) -> Optional[int]:
+        """ run the backup, returns the rsync code (None if it failed before rsync ends) """
+        rsync_code = None
+        rotation = self.logging.rotation or Rotation(compression=None)
         with Logger3(actions_filepath=self._actions_filepath,
                      progress_filepath=self._progress_filepath,
-                     errors_filepath=self._errors_filepath) as logger:
+                     errors_filepath=self._errors_filepath,
+                     max_size=rotation.max_size,
+                     max_runs=rotation.max_runs,
+                     keep=rotation.keep,
+                     compression=rotation.compression,
+                     index=self.logging.index) as logger:
             logger.actions.write('-' * 80 + '\n')
-            logger.actions.write(self.rsync_command_pretty + '\n')
+            # the actual command, with the rules file kept beside the actions log (if any)
+            logger.actions.write(self._pretty_command(inline_filters=self._actions_filepath is None) + '\n')
             logger.actions.write('-' * 80 + '\n')
             logger.actions.flush()
-            rsync_cmd = self._create_rsync_command()
-            rsync_process = Popen(rsync_cmd, stdout=logger.progress, stderr=logger.errors)
-            rsync_code = rsync_process.wait()
+            # rsync output listeners
+            monitor = None
+            if self._status_filepath or self._events_filepath:
+                monitor = ProgressMonitor(status_filepath=self._status_filepath,
+                                          events_filepath=self._events_filepath)
+            report = None
+            event_listener = getattr(self, '_event_listener', None)  # see aio.run_async
+            if self._report_filepath or self._metrics_filepath or event_listener is not None:
+                report = RunReport()
+            self._report = report
+            recorder = ChangeRecorder() if self._catalog_filepath and not self.dryrun else None
+            self._listeners = [listener for listener in (monitor, report, event_listener, recorder)
+                               if listener is not None]
+
+            retention = self.destination.retention
+            background_expired = self._expired() if retention and retention.background and not self.dryrun else []
+            telemetry = Telemetry() if self._telemetry_filepath else None
+            incomplete_markers = self._mark_incomplete()
+            with self._ssh_master(logger) as master, self._rsync_daemon(logger) as daemon, \
+                    self._throttler(logger) as throttler, \
+                    Pruner(background_expired, workers=retention.workers if retention else 1) as pruner, \
+                    telemetry or nullcontext():
+                self._throttling = throttler
+                self._telemetry = telemetry
+                if master is not None and not master.connected:
+                    logger.actions.write(f'ssh master connection failed ({master.error}), not multiplexed.\n')
+                if daemon is not None and not daemon.running:
+                    logger.errors.write(f'rsync daemon failed to start: {daemon.error}\n')
+                if self.manifest is not None:
+                    rsync_code = self._save_manifest(logger)
+                elif self.journal is not None:
+                    rsync_code = self._save_journal(logger)
+                else:
+                    rsync_code = self._transfer(logger)
+
+            for marker in incomplete_markers:
+                if rsync_code in COMPLETE_CODES:
+                    os.remove(marker)
+                else:
+                    logger.actions.write(f'snapshot left incomplete ({marker}).\n')
+
+            if telemetry is not None:
+                logger.actions.write(telemetry.format_summary() + '\n')
+                telemetry.write(self._telemetry_filepath)
+
+            if recorder is not None and rsync_code is not None:
+                history_dirpath = self._history_dirpath  # only timestamped ones keep the replaced versions
+                if history_dirpath is not None and '%' not in self._template_path(self.destination.history):
+                    history_dirpath = None
+                with CatalogIndex(self._catalog_filepath) as catalog:
+                    # an incomplete snapshot (rsync errors) does not tell which files were deleted
+                    catalog.record_run(self._timestamp, self._destination_dirpath, history_dirpath,
+                                       written=recorder.written, deleted=recorder.deleted,
+                                       snapshot=self.destination.snapshot and rsync_code in COMPLETE_CODES)
+                logger.actions.write(f'catalog: {len(recorder.written)} files written, '
+                                     f'{len(recorder.deleted)} deleted.\n')
+
+            if retention is not None and not retention.background and not self.dryrun and rsync_code == 0:
+                pruner = Pruner(self._expired(), workers=retention.workers)
+                pruner.run()
+            if pruner.paths:
+                logger.actions.write(f'retention: {len(pruner.paths) - len(pruner.errors)} directories removed.\n')
+                for error in pruner.errors:
+                    logger.errors.write(f'retention: {error}\n')
+                self._forget_pruned(pruner.paths)
+
+            if self.verification.after_save and rsync_code == 0 and not self.dryrun:
+                result = self._verify(self._destination_dirpath)
+                logger.actions.write(format_verify(result) + '\n')
+                if not result.ok:
+                    logger.errors.write(f'verification failed: {len(result.mismatched)} mismatched, '
+                                        f'{len(result.missing)} missing, {len(result.errors)} errors.\n')
+
+            for listener in self._listeners:
+                listener.close(rsync_code)
+            if report is not None:
+                if not self.destination.remote:
+                    report.resolve_deleted(self._history_dirpath)
+                self._write_report(report)
             logger.actions.flush()
             logger.actions.write('-' * 80 + '\n')
             logger.actions.write(f'rsync finished with code {int(rsync_code)}.\n')
+        return rsync_code
+
+    def _mark_incomplete(self) -> List[str]:
+        """
+        mark the snapshots of this run as incomplete until the transfer succeeds:
+        an incomplete snapshot is neither a --link-dest base nor kept by retention (see list_timestamped).
+        """
+        if self.dryrun:
+            return []
+        markers = []
+        for backup in [self] + self._fanout:
+            if backup.destination.snapshot:
+                marker = incomplete_marker(backup._destination_dirpath)
+                os.makedirs(path.dirname(marker), exist_ok=True)
+                open(marker, 'w').close()
+                markers.append(marker)
+        return markers
+
+    def _run_rsync(self, rsync_cmd: List[str], logger: Logger3, channel: int = 0,
+                   first_cmd: Optional[List[str]] = None, attempt_codes: Optional[List[int]] = None) -> int:
+        """
+        run rsync command (first_cmd for the first attempt, if any), and wait for it.
+        On transient failures, retry with backoff, only for the failed paths (when they are known).
+        The code of each attempt is appended to attempt_codes, if any.
+        """
+        listeners = getattr(self, '_listeners', None)
+        report = getattr(self, '_report', None)
+        attempt_report = None
+        if self.retry.attempts > 1 and report is not None and listeners:
+            # the attempts report apart, so that a path counts once, and the stats are those of the last attempt
+            attempt_report = RunReport(paths=True)
+            listeners = [attempt_report if listener is report else listener for listener in listeners]
+        try:
+            return self._run_attempts(rsync_cmd, logger, channel, first_cmd or rsync_cmd, attempt_codes,
+                                      listeners, attempt_report)
+        finally:
+            if attempt_report is not None:
+                report.merge(attempt_report, channel=channel)
+
+    def _run_attempts(self, rsync_cmd: List[str], logger: Logger3, channel: int, attempt_cmd: List[str],
+                      attempt_codes: Optional[List[int]], listeners: Optional[List],
+                      attempt_report: Optional[RunReport]) -> int:
+        """ the attempts of _run_rsync """
+        if attempt_codes is None:
+            attempt_codes = []
+        if self.retry.attempts <= 1:
+            rsync_code = self._run_rsync_once(attempt_cmd, logger, channel=channel, listeners=listeners)
+            attempt_codes.append(rsync_code)
+            return rsync_code
+        delay = self.retry.delay
+        for attempt in range(1, self.retry.attempts + 1):
+            failed = FailedPaths([self._source_dirpath, self._destination_dirpath])
+            rsync_code = self._run_rsync_once(attempt_cmd, logger, channel=channel, errors=failed,
+                                              listeners=listeners)
+            attempt_codes.append(rsync_code)
+            if rsync_code not in self.retry.codes or attempt == self.retry.attempts:
+                return rsync_code
+            if failed.full:
+                attempt_cmd = rsync_cmd
+                what = 'same transfer'
+            elif failed.retry_paths:
+                files_from = path.join(self._workdir, f'retry-{channel}-{attempt}.txt')
+                write_files_from(files_from, failed.retry_paths)
+                attempt_cmd = with_files_from(rsync_cmd, files_from)
+                what = f'{len(failed.retry_paths)} failed paths'
+            else:
+                return rsync_code  # nothing worth a retry (e.g. vanished files)
+            logger.actions.write(f'rsync finished with code {int(rsync_code)}, '
+                                 f'retry {attempt}/{self.retry.attempts - 1} ({what}) in {delay:g}s.\n')
+            logger.actions.flush()
+            if attempt_report is not None:
+                attempt_report.retried(rsync_code)
+            processes = getattr(self, '_processes', None)
+            if processes is not None:
+                processes.terminated.wait(delay)  # a cancelled run starts no other attempt (see ProcessGroup)
+            else:
+                time.sleep(delay)
+            delay *= self.retry.backoff
+        return rsync_code
+
+    def _run_rsync_once(self, rsync_cmd: List[str], logger: Logger3, channel: int = 0,
+                        errors: Optional[FailedPaths] = None, listeners: Optional[List] = None) -> int:
+        """
+        run rsync command, and wait for it. Output is parsed on the fly by listeners, if any
+        (those of the run, by default).
+        """
+        if listeners is None:
+            listeners = getattr(self, '_listeners', None)
+        processes = getattr(self, '_processes', None)  # see aio.run_async
+        rsync_process = (processes.popen if processes is not None else Popen)(
+            rsync_cmd,
+            stdout=PIPE if listeners else logger.progress,
+            stderr=PIPE if errors is not None else logger.errors)
+        if rsync_process is None:
+            logger.actions.write('rsync not started: run cancelled.\n')
+            return CANCELLED_CODE
+        throttler = getattr(self, '_throttling', None)
+        if throttler is not None:
+            throttler.attach(rsync_process.pid)
+        telemetry = getattr(self, '_telemetry', None)
+        if telemetry is not None:
+            telemetry.attach(rsync_process.pid)
+        errors_thread = None
+        if errors is not None:
+            errors_thread = threading.Thread(target=pump, args=(rsync_process.stderr, logger.errors, [errors], channel))
+            errors_thread.start()
+        if listeners:
+            pump(rsync_process.stdout, logger.progress, listeners, channel=channel)
+        if errors_thread is not None:
+            errors_thread.join()
+        usage = None
+        if telemetry is not None:
+            telemetry.detach(rsync_process.pid)  # last sample, before the process is reaped
+        # wait4 gives the resources of rsync and of its own waited children (receiver, ssh)
+        if processes is not None:
+            usage = processes.wait(rsync_process, usage=telemetry is not None)
+        elif telemetry is not None:
+            _, status, usage = os.wait4(rsync_process.pid, 0)
+            rsync_process.returncode = os.waitstatus_to_exitcode(status)
+        if usage is not None:
+            telemetry.add_usage(usage)
+        rsync_code = rsync_process.wait()
+        if throttler is not None:
+            throttler.detach(rsync_process.pid)
+        return rsync_code
+
+    def _write_report(self, report: RunReport):
+        context = dict(source=self._source_dirpath, destination=self._destination_dirpath, dryrun=self.dryrun)
+        if self._report_filepath:
+            report.write_json(self._report_filepath, **context)
+        if self._metrics_filepath:
+            report.write_prometheus(self._metrics_filepath, destination=self._destination_dirpath)
+
+    def _transfer(self, logger: Logger3) -> int:
+        """ transfer the whole tree """
+        if self.sharding.shards > 1:
+            return self._save_sharded(logger)
+        return self._run_passes(logger)
+
+    def _run_passes(self, logger: Logger3, files_from: Optional[str] = None) -> int:
+        """ run rsync once, or once per delta class. Returns the worst rsync code. """
+        if self._fanout:
+            return self._run_fanout(logger, files_from=files_from)
+        if not self.delta:
+            return self._run_rsync(self._create_rsync_command(files_from=files_from), logger)
+        pattern_classes = [c for c in self.delta if c.patterns is not None]
+        size_classes = [c for c in self.delta if c.min_size is not None]
+        rsync_codes = []
+        for delta_pass in delta_passes(pattern_classes, size_classes):
+            rsync_cmd = self._create_rsync_command(files_from=files_from, delta_pass=delta_pass)
+            rsync_code = self._run_rsync(rsync_cmd, logger)
+            logger.actions.write(f'pass {delta_pass.name} finished with code {int(rsync_code)}.\n')
+            rsync_codes.append(rsync_code)
+        return max(rsync_codes)
+
+    def _read_batch_command(self, batch_filepath: str) -> List[str]:
+        """
+        rsync command replaying a batch on destination (sender side options do not apply).
+        Filter options are kept: with --delete, their receiver side rules (protect, e.g. of the age filter)
+        still apply to the replayed deletions.
+        """
+        rsync_cmd = self._create_rsync_command()
+        sender_options = ('--files-from=', '--from0', '--delete-missing-args', '--checksum', '--compress',
+                          '--skip-compress=')
+        options = [o for o in rsync_cmd[1:-2] if not o.startswith(sender_options)]
+        return [rsync_cmd[0]] + options + [f'--read-batch={batch_filepath}', rsync_cmd[-1]]
+
+    def _run_fanout(self, logger: Logger3, files_from: Optional[str] = None) -> int:
+        """
+        transfer to every destination, reading the source only once:
+        the first transfer records its changes (--write-batch), replayed on the other local destinations.
+        Remote destinations and snapshots (or all of them in parallel mode) get their own transfer,
+        concurrent with the first one, so that they share the source reads.
+        Progress and report listeners only follow the first destination.
+        A destination is fully transferred when its replay is not possible (first transfer failed) or fails.
+        Returns the worst rsync code.
+        """
+        replayable = self.fanout == 'batch' and not self.dryrun and not self.destination.snapshot
+        replayed = [f for f in self._fanout if replayable and not f.destination.remote and not f.destination.snapshot]
+        transferred = [f for f in self._fanout if f not in replayed]
+        filter_rules_filepath = self._filter_rules_filepath()  # source is only walked once
+        for fanout in self._fanout:
+            fanout._workdirpath = self._workdir
+            fanout._filter_rules_filepath_cache = filter_rules_filepath
+            fanout._throttling = getattr(self, '_throttling', None)
+            fanout._telemetry = getattr(self, '_telemetry', None)
+            fanout._processes = getattr(self, '_processes', None)
+        batch_filepath = path.join(self._workdir, 'batch')
+
+        def run_first() -> int:
+            rsync_cmd = self._create_rsync_command(files_from=files_from)
+            if not replayed:
+                return self._run_rsync(rsync_cmd, logger)
+            # only a complete transfer gives a batch worth a replay: the retries do not write it
+            attempt_codes = []
+            rsync_code = self._run_rsync(
+                rsync_cmd, logger, attempt_codes=attempt_codes,
+                first_cmd=rsync_cmd[:-2] + [f'--write-batch={batch_filepath}'] + rsync_cmd[-2:])
+            self._batch_failed = attempt_codes[0] != 0
+            return rsync_code
+
+        self._batch_failed = False
+        jobs = [run_first]
+        fanout_logs = []
+        for index, fanout in enumerate(transferred, 1):
+            actions_filepath = path.join(self._workdir, f'destination-{index}.log') if self._actions_filepath else None
+            rsync_cmd = fanout._create_rsync_command(files_from=files_from, actions_filepath=actions_filepath)
+            jobs.append(lambda f=fanout, c=rsync_cmd, i=index: f._run_rsync(c, logger, channel=i))
+            fanout_logs.append(actions_filepath)
+        with ThreadPoolExecutor(max_workers=len(jobs)) as pool:
+            rsync_codes = list(pool.map(lambda job: job(), jobs))
+
+        # merge action logs
+        for fanout, actions_filepath, rsync_code in zip(transferred, fanout_logs, rsync_codes[1:]):
+            if actions_filepath is not None and path.exists(actions_filepath):
+                with open(actions_filepath) as fanout_log:
+                    shutil.copyfileobj(fanout_log, logger.actions)
+            logger.actions.write(f'destination {fanout._destination_dirpath} finished with code {int(rsync_code)}.\n')
+
+        for fanout in replayed:
+            rsync_code = None
+            if not self._batch_failed:
+                rsync_code = fanout._run_rsync_once(fanout._read_batch_command(batch_filepath), logger)
+                logger.actions.write(f'destination {fanout._destination_dirpath} replayed with code {int(rsync_code)}.\n')
+            if rsync_code != 0:
+                rsync_code = fanout._run_rsync(fanout._create_rsync_command(files_from=files_from), logger)
+                logger.actions.write(f'destination {fanout._destination_dirpath} finished with code {int(rsync_code)}.\n')
+            rsync_codes.append(rsync_code)
+        return max(rsync_codes)
+
+    def _save_manifest(self, logger: Logger3) -> int:
+        """
+        only transfer the files which changed since last successful run, according to the manifest.
+        Every verify_every runs, let rsync checksum the whole tree.
+        """
+        with ManifestIndex(self._manifest_filepath) as manifest:
+            full = manifest.is_full_run(self.manifest.verify_every)
+            changes = manifest.scan(self._source_dirpath)
+            logger.actions.write(f'manifest: {len(changes.changed)} changed, {len(changes.deleted)} deleted'
+                                 f'{" (full verify)" if full else ""}.\n')
+            if full:
+                rsync_code = self._transfer(logger)
+            elif not changes.paths:
+                rsync_code = 0
+            else:
+                files_from = path.join(self._workdir, 'files-from.txt')
+                write_files_from(files_from, changes.paths)
+                rsync_code = self._run_passes(logger, files_from=files_from)
+            if rsync_code == 0 and not self.dryrun:
+                manifest.commit(changes, full=full)
+        return rsync_code
+
+    def _save_journal(self, logger: Logger3) -> int:
+        """
+        only transfer the paths recorded by the watcher since last successful run.
+        Fall back to a full scan if the journal cannot be trusted (missing, overflow, watcher restarted).
+        """
+        journal = ChangeJournal(self._journal_filepath, max_entries=self.journal.max_entries)
+        changes = journal.consume(self._source_dirpath)
+        if changes is None:
+            logger.actions.write('journal: missing or incomplete, full scan.\n')
+            rsync_code = self._transfer(logger)
+        else:
+            changed, deleted = changes
+            logger.actions.write(f'journal: {len(changed)} changed, {len(deleted)} deleted.\n')
+            rsync_code = 0
+            if changed or deleted:
+                files_from = path.join(self._workdir, 'files-from.txt')
+                write_files_from(files_from, sorted(changed + deleted))
+                rsync_code = self._run_passes(logger, files_from=files_from)
+        if rsync_code == 0 and not self.dryrun:
+            journal.commit()
+        return rsync_code
+
+    def _save_sharded(self, logger: Logger3) -> int:
+        """
+        split the source top-level entries into balanced shards, and run a bounded pool of rsync, one per shard.
+        Returns the worst rsync code.
+        """
+        entries = scan_top_level(self._source_dirpath, balance=self.sharding.balance)
+        shards = split_shards(entries, self.sharding.shards)
+        if len(shards) <= 1:
+            return self._run_rsync(self._create_rsync_command(), logger)
+
+        shard_cmds = []
+        shard_logs = []
+        for index in range(len(shards)):
+            first_rules, last_rules = shard_filter_rules(shards, index)
+            filter_filepaths = []
+            for name, rules in [('first', first_rules), ('last', last_rules)]:
+                filter_filepath = path.join(self._workdir, f'shard-{index}.{name}.filter')
+                write_rules(filter_filepath, rules)
+                filter_filepaths.append(filter_filepath)
+            # each shard gets its own partial dir and action log, to not mix up concurrent rsync
+            partial_dirpath = None
+            if self._partial_dirpath is not None:
+                partial_dirpath = self._partial_dirpath + f'shard-{index}/'
+            actions_filepath = None
+            if self._actions_filepath is not None:
+                actions_filepath = path.join(self._workdir, f'shard-{index}.log')
+            shard_logs.append(actions_filepath)
+            shard_cmds.append(self._create_rsync_command(
+                first_filter_filepaths=filter_filepaths[:1],
+                filter_filepaths=filter_filepaths[1:],
+                partial_dirpath=partial_dirpath,
+                actions_filepath=actions_filepath))
+
+        workers = self.sharding.workers or len(shard_cmds)
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            shard_codes = list(pool.map(lambda index: self._run_rsync(shard_cmds[index], logger, channel=index),
+                                        range(len(shard_cmds))))
+
+        # merge action logs and codes
+        for index, (actions_filepath, shard_code) in enumerate(zip(shard_logs, shard_codes)):
+            if actions_filepath is not None and path.exists(actions_filepath):
+                with open(actions_filepath) as shard_log:
+                    shutil.copyfileobj(shard_log, logger.actions)
+            logger.actions.write(f'shard {index} ({len(shards[index])} entries) finished with code {int(shard_code)}.\n')
+        return max(shard_codes)
 
 
 def main_cli():
-    CLI(Backup, as_positional=False, set_defaults={"subcommand": "save"})
+    from backup_rsync.daemon import DaemonCommand
+    from backup_rsync.jobs import JobsConfig
+    commands = {'backup': Backup, 'jobs': JobsConfig, 'daemon': DaemonCommand}
+    args = sys.argv[1:]
+    if not args or args[0] not in [*commands, '-h', '--help']:
+        args = ['backup'] + args  # backup is the default command (e.g. backup_cli --config backup.yaml)
+    CLI(commands, args=args, as_positional=False,
+        set_defaults={'backup.subcommand': 'save', 'jobs.subcommand': 'save', 'daemon.subcommand': 'serve'})
 
 
 if __name__ == '__main__':
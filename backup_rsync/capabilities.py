@@ -0,0 +1,38 @@
+import re
+from dataclasses import dataclass, field
+from functools import lru_cache
+from subprocess import run, DEVNULL, PIPE, SubprocessError
+from typing import List, Optional, Tuple
+
+
+@dataclass
+class RsyncCapabilities:
+    version: Tuple[int, ...] = ()
+    compressions: List[str] = field(default_factory=list)
+    checksums: List[str] = field(default_factory=list)
+
+
+def parse_version_output(output: str) -> RsyncCapabilities:
+    """ parse the output of rsync --version """
+    capabilities = RsyncCapabilities()
+    match = re.search(r'rsync\s+version\s+v?(\d+(?:\.\d+)*)', output)
+    if match:
+        capabilities.version = tuple(int(v) for v in match[1].split('.'))
+    # e.g. "Compress list:\n    zstd lz4 zlibx zlib none" (rsync >= 3.2)
+    for name, attribute in [('Compress', 'compressions'), ('Checksum', 'checksums')]:
+        match = re.search(rf'^{name} list:\s*\n(.+)$', output, re.MULTILINE)
+        if match:
+            setattr(capabilities, attribute, match[1].split())
+    return capabilities
+
+
+@lru_cache(maxsize=None)
+def probe_rsync(rsync_path: str = 'rsync') -> Optional[RsyncCapabilities]:
+    """ capabilities of the local rsync, or None if it cannot be run """
+    try:
+        result = run([rsync_path, '--version'], stdin=DEVNULL, stdout=PIPE, stderr=DEVNULL, timeout=10)
+    except (OSError, SubprocessError):
+        return None
+    if result.returncode != 0:
+        return None
+    return parse_version_output(result.stdout.decode(errors='replace'))
@@ -0,0 +1,221 @@
+import os
+import os.path as path
+import sqlite3
+import stat as st
+from dataclasses import dataclass, asdict
+from datetime import datetime
+from typing import Dict, List, Optional, Tuple
+from backup_rsync.manifest import walk_tree
+from backup_rsync.report import parse_change_line
+
+
+def format_timestamp(timestamp: datetime) -> str:
+    """ timestamps are stored as iso strings, so that they compare as text """
+    return timestamp.isoformat(timespec='seconds')
+
+
+@dataclass
+class Version:
+    path: str  # relative to the destination root
+    since: Optional[str]  # run that wrote this version (None: before the catalog)
+    until: Optional[str]  # run that replaced or deleted it (None: still current)
+    size: int
+    mtime: int
+    location: Optional[str]  # history directory it was moved to (None: destination, or snapshots)
+
+    def as_dict(self) -> Dict:
+        return asdict(self)
+
+
+class ChangeRecorder:
+    """ collects the files created, updated and deleted by rsync (itemized changes, see OUT_FORMAT) """
+    def __init__(self):
+        self.written = []
+        self.deleted = []
+
+    def feed(self, line: str, channel: int = 0):
+        change = parse_change_line(line)
+        if change is None:
+            return
+        item, name = change['item'], change['name']
+        if item == '*deleting':
+            self.deleted.append(name)
+        elif item[0] in '<>c' and item[1] == 'f':
+            self.written.append(name)
+
+    def close(self, code: int):
+        pass
+
+
+def _files(root_dirpath: str) -> Dict[str, Tuple[int, int]]:
+    """ {relative path: (size, mtime)} of the regular files of a tree """
+    if not path.isdir(root_dirpath):
+        return {}
+    return {rel_path: (stat.st_size, int(stat.st_mtime))
+            for rel_path, stat in walk_tree(root_dirpath) if st.S_ISREG(stat.st_mode)}
+
+
+class CatalogIndex:
+    """
+    catalog of the file versions of a destination: when each version was written and replaced,
+    and where it is kept, so that "which versions of this file" does not walk every timestamped directory.
+    Versions are only added, and closed when replaced (or forgotten with their history directory).
+    """
+    def __init__(self, filepath: str):
+        self._filepath = filepath
+        self._db = None
+
+    def __enter__(self):
+        os.makedirs(path.dirname(self._filepath) or '.', exist_ok=True)
+        self._db = sqlite3.connect(self._filepath)
+        self._db.execute('PRAGMA case_sensitive_like = ON')  # as paths, and so that prefixes use the index
+        self._db.execute('CREATE TABLE IF NOT EXISTS versions ('
+                         'path TEXT, since TEXT, until TEXT, size INTEGER, mtime INTEGER, location TEXT)')
+        self._db.execute('CREATE INDEX IF NOT EXISTS versions_path ON versions (path, until)')
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self._db.close()
+        self._db = None
+
+    def _close_current(self, rel_path: str, until: str, location: Optional[str] = None) -> int:
+        """ current version of the path is replaced (or deleted), returns the number of closed versions """
+        return self._db.execute('UPDATE versions SET until = ?, location = coalesce(?, location) '
+                                'WHERE path = ? AND until IS NULL', (until, location, rel_path)).rowcount
+
+    def _add(self, rel_path: str, since: Optional[str], until: Optional[str], size: int, mtime: int,
+             location: Optional[str] = None):
+        self._db.execute('INSERT INTO versions (path, since, until, size, mtime, location) VALUES (?, ?, ?, ?, ?, ?)',
+                         (rel_path, since, until, size, mtime, location))
+
+    def record_run(self, timestamp: datetime, destination_dirpath: str, history_dirpath: Optional[str],
+                   written: List[str], deleted: List[str], snapshot: bool = False):
+        """
+        record the changes of a run:
+            - previous versions moved to history_dirpath (if any) are closed there,
+            - deleted files and replaced files are closed,
+            - written files are new current versions.
+        A snapshot is a new directory, where rsync never deletes anything: current versions missing
+        from it are closed (files deleted from the source).
+        """
+        run = format_timestamp(timestamp)
+        with self._db:
+            if history_dirpath is not None:
+                location = history_dirpath.rstrip('/') + '/'
+                for rel_path, (size, mtime) in sorted(_files(history_dirpath).items()):
+                    if not self._close_current(rel_path, run, location=location):
+                        self._add(rel_path, None, run, size, mtime, location=location)
+            for rel_path in deleted:
+                self._close_current(rel_path.rstrip('/'), run)
+                # a deleted directory closes everything below
+                self._db.execute('UPDATE versions SET until = ? WHERE path LIKE ? ESCAPE ? AND until IS NULL',
+                                 (run, _like_prefix(rel_path.rstrip('/')), '\\'))
+            if snapshot:
+                files = _files(destination_dirpath)
+                current = [row[0] for row in self._db.execute('SELECT path FROM versions WHERE until IS NULL')]
+                for rel_path in current:
+                    if rel_path not in files:
+                        self._close_current(rel_path, run)
+            for rel_path in written:
+                try:
+                    stat = os.lstat(path.join(destination_dirpath, rel_path))
+                except OSError:
+                    continue
+                self._close_current(rel_path, run)
+                self._add(rel_path, run, None, stat.st_size, int(stat.st_mtime))
+
+    def reindex_snapshots(self, snapshots: List[Tuple[datetime, str]]):
+        """ rebuild from full snapshots (oldest first): a version lasts while its size and mtime stay """
+        with self._db:
+            self._db.execute('DELETE FROM versions')
+            previous = {}
+            for timestamp, dirpath in snapshots:
+                run = format_timestamp(timestamp)
+                files = _files(dirpath)
+                for rel_path in previous.keys() - files.keys():
+                    self._close_current(rel_path, run)
+                for rel_path, (size, mtime) in files.items():
+                    known = previous.get(rel_path)
+                    if known == (size, mtime):
+                        continue
+                    if known is not None:
+                        self._close_current(rel_path, run)
+                    self._add(rel_path, run, None, size, mtime)
+                previous = files
+
+    def reindex_history(self, histories: List[Tuple[datetime, str]], destination_dirpath: str):
+        """
+        rebuild from history directories (oldest first) and the destination:
+        a version found in a history directory was replaced by the run of that directory,
+        and was written by the previous run that replaced the same path (unknown for the first one).
+        """
+        with self._db:
+            self._db.execute('DELETE FROM versions')
+            replaced = {}  # path -> last run that replaced it
+            for timestamp, dirpath in histories:
+                run = format_timestamp(timestamp)
+                for rel_path, (size, mtime) in _files(dirpath).items():
+                    self._add(rel_path, replaced.get(rel_path), run, size, mtime, location=dirpath.rstrip('/') + '/')
+                    replaced[rel_path] = run
+            for rel_path, (size, mtime) in _files(destination_dirpath).items():
+                self._add(rel_path, replaced.get(rel_path), None, size, mtime)
+
+    def forget(self, location: str):
+        """ versions kept in a removed history directory (e.g. by retention) """
+        with self._db:
+            self._db.execute('DELETE FROM versions WHERE location = ?', (location.rstrip('/') + '/',))
+
+    def versions(self, pattern: str, at: Optional[datetime] = None) -> List[Version]:
+        """
+        versions of the paths matching a glob pattern (or below a directory), oldest first,
+        only the one current at a given time, if any.
+        """
+        pattern = pattern.strip('/')
+        query = ('SELECT path, since, until, size, mtime, location FROM versions '
+                 'WHERE (path GLOB ? OR path LIKE ? ESCAPE ?)')
+        parameters = [pattern, _like_prefix(pattern), '\\']
+        if at is not None:
+            query += ' AND (since IS NULL OR since <= ?) AND (until IS NULL OR until > ?)'
+            parameters += [format_timestamp(at)] * 2
+        query += ' ORDER BY path, until IS NULL, until'
+        return [Version(*row) for row in self._db.execute(query, parameters)]
+
+
+def _like_prefix(dirpath: str) -> str:
+    """ LIKE pattern of the paths below a directory """
+    escaped = dirpath.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+    return escaped + '/%'
+
+
+def locate(version: Version, destination_dirpath: str, snapshots: List[Tuple[datetime, str]],
+           at: Optional[datetime] = None) -> Optional[str]:
+    """
+    file path of a version: in its history directory, in the destination when current,
+    or in the most recent snapshot (before at) where it has the same size and mtime.
+    """
+    if version.location is not None:
+        return path.join(version.location, version.path)
+    if not snapshots:
+        return path.join(destination_dirpath, version.path) if version.until is None else None
+    for timestamp, dirpath in reversed(snapshots):
+        run = format_timestamp(timestamp)
+        if at is not None and run > format_timestamp(at):
+            continue
+        if version.until is not None and run >= version.until:
+            continue
+        if version.since is not None and run < version.since:
+            break
+        filepath = path.join(dirpath, version.path)
+        try:
+            stat = os.lstat(filepath)
+        except OSError:
+            continue
+        if (stat.st_size, int(stat.st_mtime)) == (version.size, version.mtime):
+            return filepath
+    return None
+
+
+def format_versions(versions: List[Version]) -> str:
+    lines = [f'{v.since or "?":<19}  {v.until or "current":<19}  {v.size:>14}  '
+             f'{datetime.fromtimestamp(v.mtime).isoformat(timespec="seconds")}  {v.path}' for v in versions]
+    return '\n'.join(lines)
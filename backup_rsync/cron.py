@@ -0,0 +1,89 @@
+from datetime import datetime, timedelta
+from typing import List, Set
+
+_ALIASES = {
+    '@hourly': '0 * * * *',
+    '@daily': '0 0 * * *',
+    '@midnight': '0 0 * * *',
+    '@weekly': '0 0 * * 0',
+    '@monthly': '0 0 1 * *',
+    '@yearly': '0 0 1 1 *',
+    '@annually': '0 0 1 1 *',
+}
+_MONTHS = ['jan', 'feb', 'mar', 'apr', 'may', 'jun', 'jul', 'aug', 'sep', 'oct', 'nov', 'dec']
+_DAYS = ['sun', 'mon', 'tue', 'wed', 'thu', 'fri', 'sat']
+# (low, high, names) for: minute, hour, day of month, month, day of week
+_FIELDS = [(0, 59, {}), (0, 23, {}), (1, 31, {}),
+           (1, 12, {name: i + 1 for i, name in enumerate(_MONTHS)}),
+           (0, 7, {name: i for i, name in enumerate(_DAYS)})]
+
+
+def _parse_value(text: str, names: dict) -> int:
+    text = text.lower()
+    if text in names:
+        return names[text]
+    if not text.isdigit():
+        raise ValueError(f'invalid cron value "{text}".')
+    return int(text)
+
+
+def _parse_field(text: str, low: int, high: int, names: dict) -> Set[int]:
+    """ e.g. "*", "*/15", "1-5", "mon-fri", "0,30", "8-18/2" """
+    values = set()
+    for part in text.split(','):
+        span, _, step = part.partition('/')
+        step = int(step) if step else 1
+        if span == '*':
+            start, end = low, high
+        elif '-' in span:
+            start, end = (_parse_value(v, names) for v in span.split('-', 1))
+        else:
+            start = _parse_value(span, names)
+            end = high if step > 1 else start
+        if not low <= start <= end <= high or step < 1:
+            raise ValueError(f'invalid cron field "{text}".')
+        values.update(range(start, end + 1, step))
+    return values
+
+
+class CronExpression:
+    """
+    standard 5 fields cron expression: minute hour day-of-month month day-of-week (or @daily, @hourly, ...).
+    As in cron, when both day fields are restricted, either of them matches.
+    """
+    def __init__(self, expression: str):
+        self.expression = expression
+        fields = _ALIASES.get(expression.strip(), expression).split()
+        if len(fields) != 5:
+            raise ValueError(f'cron expression "{expression}" must have 5 fields.')
+        sets: List[Set[int]] = [_parse_field(f, *spec) for f, spec in zip(fields, _FIELDS)]
+        self._minutes, self._hours, self._days, self._months, weekdays = sets
+        self._weekdays = {d % 7 for d in weekdays}  # 7 is sunday too
+        self._any_day = fields[2] == '*'
+        self._any_weekday = fields[4] == '*'
+
+    def _day_matches(self, day: datetime) -> bool:
+        if day.month not in self._months:
+            return False
+        in_days = day.day in self._days
+        in_weekdays = (day.weekday() + 1) % 7 in self._weekdays
+        if self._any_day or self._any_weekday:
+            return in_days and in_weekdays
+        return in_days or in_weekdays
+
+    def matches(self, moment: datetime) -> bool:
+        return moment.minute in self._minutes and moment.hour in self._hours and self._day_matches(moment)
+
+    def next_after(self, moment: datetime) -> datetime:
+        """ first matching minute strictly after moment """
+        moment = moment.replace(second=0, microsecond=0) + timedelta(minutes=1)
+        day = moment.replace(hour=0, minute=0)
+        for _ in range(366 * 8):  # covers leap days
+            if self._day_matches(day):
+                for hour in sorted(self._hours):
+                    for minute in sorted(self._minutes):
+                        candidate = day.replace(hour=hour, minute=minute)
+                        if candidate >= moment:
+                            return candidate
+            day += timedelta(days=1)
+        raise ValueError(f'cron expression "{self.expression}" never matches.')
@@ -0,0 +1,296 @@
+import os
+import os.path as path
+import json
+import signal
+import socket
+import socketserver
+import sys
+import threading
+from dataclasses import dataclass, field
+from datetime import datetime
+from functools import lru_cache
+from typing import Dict, List, Optional
+from jsonargparse import ArgumentParser, ActionConfigFile
+from backup_rsync.backup import Backup, Path_f
+from backup_rsync.cron import CronExpression
+
+
+@dataclass
+class Job:
+    config: Path_f  # backup config file (relative to the daemon config)
+    cron: str = '@daily'  # minute hour day-of-month month day-of-week
+    name: Optional[str] = None  # defaults to the config file path
+    lock: Optional[str] = None  # mutual exclusion group, defaults to the destination
+
+
+@dataclass
+class DaemonConfig:
+    jobs: List[Job] = field(default_factory=list)
+    socket: Optional[Path_f] = None  # unix socket exposing the jobs state
+    poll: float = 10.  # seconds between config changes checks
+
+
+@lru_cache(maxsize=None)
+def _parser(config_class) -> ArgumentParser:
+    parser = ArgumentParser(exit_on_error=False)
+    parser.add_argument('--config', action=ActionConfigFile)
+    parser.add_class_arguments(config_class)
+    return parser
+
+
+def parse_config(config_class, config_filepath: str):
+    """ parse (and check) a config file, to be instantiated later on (see instantiate) """
+    return _parser(config_class).parse_args(['--config', config_filepath])
+
+
+def instantiate(config_class, namespace):
+    """ create a new instance from parsed config (e.g. a Backup with its own timestamp) """
+    parser = _parser(config_class)
+    # instantiate_classes is deprecated since jsonargparse 4.49
+    init = (parser.instantiate if hasattr(parser, 'instantiate') else parser.instantiate_classes)(namespace)
+    return config_class(**{k: v for k, v in init.items(branches=True) if k != 'config'})
+
+
+def _mtime(filepath: str) -> Optional[float]:
+    try:
+        return os.stat(filepath).st_mtime
+    except OSError:
+        return None
+
+
+def _destination_key(backup: Backup) -> str:
+    """ identifies the destination, whatever the date template """
+    destination = Backup._template_path(backup.destination.path)
+    if backup.destination.remote:
+        destination = backup.server.url + ':' + destination
+    return destination
+
+
+class JobState:
+    """ a scheduled job: its parsed config (reloaded on change), and the state of its runs """
+    def __init__(self, job: Job):
+        self.set_job(job)
+        self.error: Optional[str] = None
+        self.state = 'idle'  # idle, waiting (for its lock) or running
+        self.runs = 0
+        self.last_start: Optional[datetime] = None
+        self.last_end: Optional[datetime] = None
+        self.last_code: Optional[int] = None
+
+    def set_job(self, job: Job):
+        self.job = job
+        self.cron = CronExpression(job.cron)
+        self.config_filepath = Backup._template_path(job.config)
+        self._namespace = None
+        self._mtime = None
+
+    def refresh(self) -> bool:
+        """ (re)parse the backup config if it changed, returns True if reloaded """
+        mtime = _mtime(self.config_filepath)
+        if mtime is not None and mtime == self._mtime:
+            return False
+        self._mtime = mtime
+        try:
+            self._namespace = parse_config(Backup, self.config_filepath)
+            instantiate(Backup, self._namespace)._check_server()  # check validity (no shared server)
+            self.error = None
+        except Exception as e:  # keep the previous valid config, if any
+            self.error = f'invalid config {self.config_filepath}: {e}'
+        return True
+
+    def backup(self) -> Backup:
+        if self._namespace is None:
+            raise ValueError(self.error)
+        return instantiate(Backup, self._namespace)
+
+    def as_dict(self, now: datetime) -> Dict:
+        def iso(moment):
+            return moment.isoformat(timespec='seconds') if moment else None
+
+        return dict(config=self.config_filepath, cron=self.cron.expression, state=self.state,
+                    runs=self.runs, last_start=iso(self.last_start), last_end=iso(self.last_end),
+                    last_code=self.last_code, next_run=iso(self.cron.next_after(now)), error=self.error)
+
+
+class Scheduler:
+    """
+    runs the backup jobs of the daemon config when their cron expression matches.
+    A job never runs twice at the same time, and jobs sharing a destination (or lock) run one after the other.
+    Configs are reloaded when they change.
+    """
+    def __init__(self, config_filepath: str):
+        self._config_filepath = path.abspath(config_filepath)
+        self._config_mtime = None
+        self.config: Optional[DaemonConfig] = None
+        self.jobs: Dict[str, JobState] = {}
+        self._locks: Dict[str, threading.Lock] = {}
+        self._lock = threading.Lock()
+        self._threads: List[threading.Thread] = []
+        self._stop = threading.Event()
+
+    def _log(self, message: str):
+        print(f'{datetime.now().isoformat(timespec="seconds")} {message}', flush=True)
+
+    def reload(self):
+        """ (re)load the daemon config and the jobs configs, if they changed """
+        mtime = _mtime(self._config_filepath)
+        if mtime != self._config_mtime:
+            self._config_mtime = mtime
+            try:
+                config = instantiate(DaemonConfig, parse_config(DaemonConfig, self._config_filepath))
+                jobs = {}
+                for job in config.jobs:
+                    CronExpression(job.cron)  # check validity
+                    name = job.name or Backup._template_path(job.config)
+                    if name in jobs:
+                        raise ValueError(f'duplicated job name {name}.')
+                    jobs[name] = job
+            except Exception as e:
+                if self.config is None:
+                    raise
+                self._log(f'invalid config {self._config_filepath}, keep previous one: {e}')
+            else:
+                with self._lock:
+                    previous, self.jobs = self.jobs, {}
+                    for name, job in jobs.items():
+                        state = previous.get(name)
+                        if state is None:
+                            state = JobState(job)
+                        elif state.job != job:
+                            state.set_job(job)  # keep the runs state
+                        self.jobs[name] = state
+                    self.config = config
+                self._log(f'loaded {len(jobs)} jobs from {self._config_filepath}.')
+        for name, state in list(self.jobs.items()):
+            if state.refresh():
+                self._log(f'job {name}: {state.error or "config loaded"}.')
+
+    def _group_lock(self, key: str) -> threading.Lock:
+        with self._lock:
+            return self._locks.setdefault(key, threading.Lock())
+
+    def start(self, name: str) -> bool:
+        """ start job in background (unless already started), returns True if started """
+        with self._lock:
+            state = self.jobs.get(name)
+            if state is None or state.state != 'idle':
+                return False
+            state.state = 'waiting'
+            self._threads = [t for t in self._threads if t.is_alive()]
+            thread = threading.Thread(target=self._run_job, args=(name, state), name=f'job-{name}')
+            self._threads.append(thread)
+        thread.start()
+        return True
+
+    def _run_job(self, name: str, state: JobState):
+        rsync_code = None
+        try:
+            backup = state.backup()
+            with self._group_lock(state.job.lock or _destination_key(backup)):
+                state.state, state.last_start = 'running', datetime.now()
+                self._log(f'job {name} started.')
+                rsync_code = backup.save()
+        except Exception as e:
+            self._log(f'job {name} failed: {e}')
+        finally:
+            state.state, state.last_end, state.last_code = 'idle', datetime.now(), rsync_code
+            state.runs += 1
+            self._log(f'job {name} finished with code {rsync_code}.')
+
+    def command(self, request: List[str]) -> Dict:
+        """ answer a client request: "status" or "run <job name>" """
+        if not request or request[0] == 'status':
+            now = datetime.now()
+            with self._lock:
+                return {name: state.as_dict(now) for name, state in self.jobs.items()}
+        if request[0] == 'run' and len(request) == 2:
+            if request[1] not in self.jobs:
+                return dict(error=f'unknown job {request[1]}')
+            return dict(started=self.start(request[1]))
+        return dict(error=f'unknown request {" ".join(request)}')
+
+    def tick(self, since: datetime, now: datetime):
+        """ start the jobs due in minutes ]since, now] (catch up minutes missed, e.g. on suspend) """
+        with self._lock:
+            jobs = list(self.jobs.items())
+        for name, state in jobs:
+            if state.cron.next_after(since) <= now and not self.start(name) and state.state != 'idle':
+                self._log(f'job {name} is still running, skipped.')
+
+    def run(self):
+        """ schedule jobs until interrupted (SIGINT or SIGTERM), then wait for running jobs """
+        self.reload()
+        server = self._serve()
+        last = datetime.now()
+        if threading.current_thread() is threading.main_thread():
+            signal.signal(signal.SIGTERM, lambda signum, frame: self._stop.set())
+        try:
+            while not self._stop.wait(min(self.config.poll, 60 - datetime.now().second + .01)):
+                self.reload()
+                now = datetime.now()
+                if now.replace(second=0, microsecond=0) > last.replace(second=0, microsecond=0):
+                    self.tick(last, now)
+                    last = now
+        except KeyboardInterrupt:
+            pass
+        finally:
+            if server is not None:
+                server.shutdown()
+                server.server_close()
+                os.remove(server.server_address)
+            self._log('stopped, waiting for running jobs.')
+            for thread in self._threads:
+                thread.join()
+
+    def _serve(self) -> Optional[socketserver.BaseServer]:
+        if self.config.socket is None:
+            return None
+        socket_filepath = Backup._template_path(self.config.socket)
+        if path.exists(socket_filepath):
+            os.remove(socket_filepath)  # left over
+        os.makedirs(path.dirname(socket_filepath), exist_ok=True)
+        scheduler = self
+
+        class Handler(socketserver.StreamRequestHandler):
+            def handle(self):
+                request = self.rfile.readline().decode(errors='replace').split()
+                self.wfile.write(json.dumps(scheduler.command(request)).encode() + b'\n')
+
+        server = socketserver.ThreadingUnixStreamServer(socket_filepath, Handler)
+        server.daemon_threads = True
+        os.chmod(socket_filepath, 0o600)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        return server
+
+
+def request(socket_filepath: str, *command: str) -> Dict:
+    """ send a request to a running daemon """
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as client:
+        client.connect(socket_filepath)
+        client.sendall(' '.join(command).encode() + b'\n')
+        with client.makefile('rb') as response:
+            return json.loads(response.readline())
+
+
+class DaemonCommand:
+    """ backup_cli daemon --daemon_config daemon.yaml [serve | status | run --job <job name>] """
+    def __init__(self, daemon_config: str):
+        self._config_filepath = daemon_config
+
+    def serve(self):
+        """ schedule the backup jobs, until interrupted """
+        Scheduler(self._config_filepath).run()
+
+    def _request(self, *command: str):
+        config = instantiate(DaemonConfig, parse_config(DaemonConfig, self._config_filepath))
+        if config.socket is None:
+            sys.exit('no socket in daemon config.')
+        print(json.dumps(request(Backup._template_path(config.socket), *command), indent=2))
+
+    def status(self):
+        """ jobs state of the running daemon, as json """
+        self._request('status')
+
+    def run(self, job: str):
+        """ start a job of the running daemon now """
+        self._request('run', job)
@@ -0,0 +1,221 @@
+import os
+import os.path as path
+import sqlite3
+import stat as st
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import dataclass, field
+from typing import Dict, List, Optional, Tuple
+from backup_rsync.manifest import hash_file, walk_tree
+
+_TMP_SUFFIX = '.dedup-tmp'
+
+
+def _hash_or_none(filepath: str) -> Optional[str]:
+    try:
+        return hash_file(filepath)
+    except OSError:
+        return None
+
+
+@dataclass
+class FileInfo:
+    filepath: str
+    size: int
+    mtime_ns: int
+    inode: int
+    device: int
+    mode: int
+    uid: int
+    gid: int
+    nlink: int
+    hash: Optional[str] = None
+
+    @property
+    def identity(self) -> Tuple:
+        """
+        files are only linked together if content, modification time, permissions and owner are the same:
+        links share their metadata, so that no copy changes
+        """
+        return self.device, self.size, self.hash, self.mtime_ns, self.mode, self.uid, self.gid
+
+
+@dataclass
+class DedupResult:
+    files: int = 0  # regular files scanned
+    hashed: int = 0  # files hashed during this pass (others known from index)
+    linked: int = 0  # paths replaced by a hard link
+    reclaimed: int = 0  # bytes freed
+    errors: List[str] = field(default_factory=list)
+
+    def as_dict(self) -> Dict:
+        return dict(files=self.files, hashed=self.hashed, linked=self.linked,
+                    reclaimed=self.reclaimed, errors=self.errors)
+
+
+class DedupIndex:
+    """
+    persistent index of file hashes in the backup tree (keyed by path, valid while size, mtime and inode match),
+    so that later dedup passes only hash new files.
+    """
+    def __init__(self, filepath: str):
+        self._filepath = filepath
+        self._db = None
+
+    def __enter__(self):
+        os.makedirs(path.dirname(self._filepath) or '.', exist_ok=True)
+        self._db = sqlite3.connect(self._filepath)
+        self._db.execute('CREATE TABLE IF NOT EXISTS files ('
+                         'path TEXT PRIMARY KEY, size INTEGER, mtime_ns INTEGER, inode INTEGER, hash TEXT)')
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self._db.close()
+        self._db = None
+
+    def lookup(self, files: List[FileInfo]):
+        """ fill in known hashes, and forget entries of paths that are gone """
+        known = {row[0]: row[1:] for row in self._db.execute('SELECT path, size, mtime_ns, inode, hash FROM files')}
+        for info in files:
+            row = known.pop(info.filepath, None)
+            if row is not None and tuple(row[:3]) == (info.size, info.mtime_ns, info.inode):
+                info.hash = row[3]
+        with self._db:
+            self._db.executemany('DELETE FROM files WHERE path = ?', [(p,) for p in known])
+
+    def record(self, files: List[FileInfo]):
+        with self._db:
+            self._db.executemany('INSERT OR REPLACE INTO files (path, size, mtime_ns, inode, hash) VALUES (?, ?, ?, ?, ?)',
+                                 [(f.filepath, f.size, f.mtime_ns, f.inode, f.hash) for f in files])
+
+
+def scan_files(root_dirpaths: List[str], min_size: int = 1, cleanup: bool = True) -> List[FileInfo]:
+    """
+    regular files of the given trees, at least min_size bytes.
+    Leftovers of an interrupted pass are skipped, and removed with cleanup.
+    """
+    files = []
+    for root_dirpath in root_dirpaths:
+        for rel_path, stat in walk_tree(root_dirpath):
+            if not st.S_ISREG(stat.st_mode):
+                continue
+            filepath = path.join(root_dirpath, rel_path)
+            if filepath.endswith(_TMP_SUFFIX):
+                if cleanup:
+                    os.remove(filepath)
+                continue
+            if stat.st_size < min_size:
+                continue
+            files.append(FileInfo(filepath=filepath, size=stat.st_size, mtime_ns=stat.st_mtime_ns,
+                                  inode=stat.st_ino, device=stat.st_dev, mode=st.S_IMODE(stat.st_mode),
+                                  uid=stat.st_uid, gid=stat.st_gid, nlink=stat.st_nlink))
+    return files
+
+
+def hash_files(files: List[FileInfo], workers: Optional[int] = None) -> int:
+    """
+    hash the files without known hash, in a pool of processes.
+    Files with a unique size cannot have duplicates and are not hashed.
+    Returns the number of files hashed.
+    """
+    sizes = {}
+    for info in files:
+        sizes[(info.device, info.size)] = sizes.get((info.device, info.size), 0) + 1
+    # a single hash per inode is enough
+    by_inode = {}
+    for info in files:
+        if info.hash is None and sizes[(info.device, info.size)] > 1:
+            by_inode.setdefault((info.device, info.inode), []).append(info)
+    if not by_inode:
+        return 0
+    groups = list(by_inode.values())
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        hashes = pool.map(_hash_or_none, [group[0].filepath for group in groups], chunksize=64)
+        for group, content_hash in zip(groups, hashes):
+            for info in group:
+                info.hash = content_hash
+    return len(groups)
+
+
+def replace_with_link(target_filepath: str, filepath: str):
+    """ atomically replace filepath by a hard link to target_filepath """
+    tmp_filepath = filepath + _TMP_SUFFIX
+    os.link(target_filepath, tmp_filepath)
+    try:
+        os.replace(tmp_filepath, filepath)
+    except OSError:
+        os.remove(tmp_filepath)
+        raise
+
+
+def link_duplicates(files: List[FileInfo], preferred_dirpath: Optional[str] = None,
+                    dryrun: bool = False) -> DedupResult:
+    """
+    replace identical files by hard links to a single copy.
+    The kept copy is preferably inside preferred_dirpath (e.g. the last snapshot), else the most linked one.
+    Files updated in place by later runs (e.g. latest, whose metadata rsync sets) must not be given:
+    the copies linked to them would change too.
+    """
+    result = DedupResult(files=len(files))
+    groups = {}
+    for info in files:
+        if info.hash is not None:
+            groups.setdefault(info.identity, []).append(info)
+    for group in groups.values():
+        inodes = {}
+        for info in group:
+            inodes.setdefault(info.inode, []).append(info)
+        if len(inodes) < 2:
+            continue
+
+        def preference(inode: int):
+            infos = inodes[inode]
+            preferred = preferred_dirpath is not None and any(
+                i.filepath.startswith(preferred_dirpath) for i in infos)
+            return preferred, infos[0].nlink
+
+        kept_inode = max(inodes, key=preference)
+        kept = inodes[kept_inode][0]
+        for inode, infos in inodes.items():
+            if inode == kept_inode:
+                continue
+            replaced = 0
+            for info in infos:
+                try:
+                    if not dryrun:
+                        replace_with_link(kept.filepath, info.filepath)
+                        info.inode = kept.inode
+                    replaced += 1
+                except OSError as e:
+                    result.errors.append(f'{info.filepath}: {e}')
+            result.linked += replaced
+            # the inode is only freed if all of its links were replaced
+            if replaced == infos[0].nlink:
+                result.reclaimed += infos[0].size
+    return result
+
+
+def dedup(root_dirpaths: List[str], index_filepath: str, preferred_dirpath: Optional[str] = None,
+          min_size: int = 1, workers: Optional[int] = None, dryrun: bool = False) -> DedupResult:
+    """
+    replace duplicate files across the given trees by hard links.
+    Hashes are recorded in the index before linking, so an interrupted pass resumes without hashing again.
+    """
+    files = scan_files(root_dirpaths, min_size=min_size, cleanup=not dryrun)
+    with DedupIndex(index_filepath) as index:
+        index.lookup(files)
+        hashed = hash_files(files, workers=workers)
+        index.record([f for f in files if f.hash is not None])
+        result = link_duplicates(files, preferred_dirpath=preferred_dirpath, dryrun=dryrun)
+        if not dryrun:
+            # linked paths changed inode
+            index.record([f for f in files if f.hash is not None])
+    result.hashed = hashed
+    return result
+
+
+def format_dedup(result: DedupResult) -> str:
+    text = (f'{result.files} files scanned, {result.hashed} hashed, {result.linked} linked, '
+            f'{result.reclaimed} bytes reclaimed.')
+    for error in result.errors:
+        text += f'\nerror: {error}'
+    return text
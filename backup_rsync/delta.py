@@ -0,0 +1,84 @@
+from dataclasses import dataclass, field
+from typing import List, Optional
+
+
+@dataclass
+class DeltaPass:
+    options: List[str] = field(default_factory=list)  # rsync options specific to this pass
+    rules: List[str] = field(default_factory=list)  # filter rules restricting this pass to its files
+    inplace: bool = False  # incompatible with --partial-dir
+
+    @property
+    def name(self) -> str:
+        return ' '.join(self.options) or 'default'
+
+
+def class_options(whole_file: Optional[bool] = None, inplace: bool = False, append_verify: bool = False,
+                  block_size: Optional[int] = None) -> List[str]:
+    options = []
+    if whole_file is not None:
+        options.append('--whole-file' if whole_file else '--no-whole-file')
+    if append_verify:
+        options.append('--append-verify')  # only send the end of files that grew
+    if inplace or append_verify:
+        options.append('--inplace')  # write destination file directly, instead of temp file and rename
+    if block_size is not None:
+        options.append(f'--block-size={int(block_size)}')
+    return options
+
+
+def delta_passes(pattern_classes: List, size_classes: List) -> List[DeltaPass]:
+    """
+    split a transfer into passes, one per file class, and a last one for the remaining files.
+    Pattern classes come first (a file belongs to the first matching class), each one only transferring
+    and deleting its files. Other files are then split by size (rsync --min-size / --max-size), those passes
+    deleting everything but the pattern classes files.
+    Classes are given as objects with patterns or min_size, and whole_file, inplace, append_verify, block_size.
+    """
+    passes = []
+    owned_rules = []  # rules of the previous pattern classes
+    for delta_class in pattern_classes:
+        rules = list(owned_rules)
+        rules.append('show */')  # traverse all directories
+        rules += [f'show {pattern}' for pattern in delta_class.patterns]
+        rules.append('hide *')
+        # extraneous directories may contain files of the class, the other files keep them from being removed
+        rules.append('risk */')
+        rules += [f'risk {pattern}' for pattern in delta_class.patterns]
+        rules.append('protect *')
+        passes.append(DeltaPass(options=class_options(delta_class.whole_file, delta_class.inplace,
+                                                      delta_class.append_verify, delta_class.block_size),
+                                rules=rules, inplace=delta_class.inplace or delta_class.append_verify))
+        for pattern in delta_class.patterns:
+            owned_rules += [f'hide {pattern}', f'protect {pattern}']
+
+    # largest first, each one up to the previous threshold
+    max_size = None
+    for delta_class in sorted(size_classes, key=lambda c: parse_size(c.min_size), reverse=True):
+        options = class_options(delta_class.whole_file, delta_class.inplace,
+                                delta_class.append_verify, delta_class.block_size)
+        options.append(f'--min-size={delta_class.min_size}')
+        if max_size is not None:
+            options.append(f'--max-size={max_size}-1')
+        passes.append(DeltaPass(options=options, rules=list(owned_rules),
+                                inplace=delta_class.inplace or delta_class.append_verify))
+        max_size = delta_class.min_size
+    default_options = [f'--max-size={max_size}-1'] if max_size is not None else []
+    passes.append(DeltaPass(options=default_options, rules=list(owned_rules)))
+    return passes
+
+
+_SIZE_UNITS = {'': 1, 'b': 1, 'k': 1 << 10, 'm': 1 << 20, 'g': 1 << 30, 't': 1 << 40, 'p': 1 << 50}
+
+
+def parse_size(size: str | int) -> int:
+    """ bytes of a rsync size (e.g. 100, 10K, 1.5G, 1GB is 1000^3) """
+    size = str(size).strip().lower()
+    decimal = size.endswith('b') and len(size) > 1 and size[-2] in 'kmgtp'
+    if decimal:
+        size = size[:-1]
+    unit = size[-1] if size and size[-1] in _SIZE_UNITS else ''
+    number = float(size[:len(size) - len(unit)])
+    if decimal:
+        return int(number * 1000 ** ('kmgtp'.index(unit) + 1))
+    return int(number * _SIZE_UNITS[unit])
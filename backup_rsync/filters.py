@@ -0,0 +1,192 @@
+import os
+import os.path as path
+import stat as st
+import time
+from typing import Dict, List, Optional, Set, Tuple
+from backup_rsync.manifest import walk_tree
+from backup_rsync.plan import is_excluded
+from backup_rsync.shard import escape_pattern
+
+# report buckets of files skipped by size or age
+MIN_SIZE, MAX_SIZE, MAX_AGE = 'min_size', 'max_size', 'max_age'
+# rsync checks every rule against every file: beyond, age filters would cost more than they save
+MAX_STALE_RULES = 100000
+
+
+def read_patterns(filepath: str) -> List[str]:
+    """
+    exclude patterns of a file, one per line (blank lines and # comments are skipped).
+    As in gitignore, !pattern includes again what previous patterns excluded (the last matching pattern wins).
+    """
+    patterns = []
+    with open(filepath) as patterns_file:
+        for line in patterns_file:
+            line = line.rstrip('\r\n')
+            if not line.strip() or line.lstrip().startswith('#'):
+                continue
+            patterns.append(line.rstrip())
+    return patterns
+
+
+def unique(patterns: List[str]) -> List[str]:
+    """ patterns without duplicates, first occurrence order """
+    return list(dict.fromkeys(patterns))
+
+
+def stale_paths(source_dirpath: str, max_age: float, now: Optional[float] = None) -> List[str]:
+    """
+    source files not modified for max_age days.
+    Directories without any recent file are given as a whole (with a trailing /), so that trees of old files
+    take a single rule, not one per file.
+    """
+    limit = (now or time.time()) - max_age * 86400
+    stale, fresh_dirpaths = [], set()
+    for rel_path, stat in walk_tree(source_dirpath):
+        if st.S_ISDIR(stat.st_mode):
+            continue
+        if stat.st_mtime < limit:
+            stale.append(rel_path)
+            continue
+        parent = path.dirname(rel_path)
+        while parent and parent not in fresh_dirpaths:
+            fresh_dirpaths.add(parent)
+            parent = path.dirname(parent)
+    paths = set()
+    for rel_path in stale:
+        top, parent = rel_path, path.dirname(rel_path)
+        while parent and parent not in fresh_dirpaths:
+            top, parent = parent + '/', path.dirname(parent)
+        paths.add(top)
+    return sorted(paths)
+
+
+def compile_rules(patterns: List[str], ignore_file: Optional[str] = None, stale: Optional[List[str]] = None) -> List[str]:
+    """
+    rsync filter rules (merge file syntax):
+        - patterns are excluded (and deleted from destination, as with --exclude), !patterns are included,
+          in reverse order, as the first matching rsync rule wins (the last matching pattern, see read_patterns),
+        - per-directory ignore files are merged while walking the source,
+        - stale files (and directories) are skipped: hidden from the transfer, but their copy is protected
+          from deletion. There are at most MAX_STALE_RULES of them.
+    """
+    if stale and len(stale) > MAX_STALE_RULES:
+        raise ValueError(f'Age filter skips {len(stale)} files and directories, more than {MAX_STALE_RULES}: '
+                         'exclude old trees with patterns instead.')
+    rules = []
+    for pattern in unique(reversed(patterns)):
+        rules.append(f'+ {pattern[1:]}' if pattern.startswith('!') else f'- {pattern}')
+    if ignore_file:
+        rules.append(f'dir-merge,- {ignore_file}')
+    for rel_path in stale or []:
+        pattern = '/' + escape_pattern(rel_path) + ('***' if rel_path.endswith('/') else '')
+        rules += [f'hide {pattern}', f'protect {pattern}']
+    return rules
+
+
+def write_rules(filepath: str, rules: List[str]):
+    with open(filepath, 'w') as rules_file:
+        rules_file.write(''.join(rule + '\n' for rule in rules))
+
+
+def _tree_size(dirpath: str) -> Tuple[int, int]:
+    """ (files, bytes) of a tree """
+    files, size = 0, 0
+    for _, stat in walk_tree(dirpath):
+        if not st.S_ISDIR(stat.st_mode):
+            files += 1
+            size += stat.st_size
+    return files, size
+
+
+def skipped_entries(source_dirpath: str, patterns: List[str], ignore_file: Optional[str] = None,
+                    min_size: Optional[int] = None, max_size: Optional[int] = None, max_age: Optional[float] = None,
+                    now: Optional[float] = None, ignored: Optional[List[str]] = None):
+    """
+    walk the source as rsync would with the compiled rules (see compile_rules) and size options,
+    yield (relative path, entry, stat, rule) of the skipped files and directories (not walked further),
+    rule being the first one skipping them: a pattern, "<ignore file>: <pattern>", or a size or age bucket.
+    Negations of ignore files, not supported by rsync, are added to ignored (if given).
+    """
+    age_limit = (now or time.time()) - max_age * 86400 if max_age is not None else None
+    device = os.lstat(source_dirpath).st_dev
+    # (directory, rules inherited from ignore files as (name, directory of the ignore file, pattern))
+    stack = [('', [])]
+    while stack:
+        rel_dirpath, inherited = stack.pop()
+        dirpath = path.join(source_dirpath, rel_dirpath)
+        local = list(inherited)
+        if ignore_file and path.isfile(path.join(dirpath, ignore_file)):
+            try:
+                name = path.join(rel_dirpath, ignore_file)
+                for p in read_patterns(path.join(dirpath, ignore_file)):
+                    if not p.startswith('!'):
+                        local.append((f'{name}: {p}', rel_dirpath, p))
+                    elif ignored is not None:
+                        ignored.append(f'{name}: {p}')
+            except OSError:
+                pass
+        try:
+            with os.scandir(dirpath) as it:
+                entries = list(it)
+        except OSError:
+            continue
+        for entry in entries:
+            rel_path = path.join(rel_dirpath, entry.name)
+            try:
+                stat = entry.stat(follow_symlinks=False)
+            except OSError:
+                continue
+            is_dir = st.S_ISDIR(stat.st_mode)
+            rule = None
+            if is_excluded(rel_path, is_dir, patterns):
+                rule = next(p for p in reversed(patterns) if is_excluded(rel_path, is_dir, [p]))
+            if rule is None:
+                rule = next((name for name, base, p in local
+                             if is_excluded(path.relpath(rel_path, base or '.'), is_dir, [p])), None)
+            if rule is None and not is_dir:
+                if max_size is not None and stat.st_size > max_size:
+                    rule = MAX_SIZE
+                elif min_size is not None and stat.st_size < min_size:
+                    rule = MIN_SIZE
+                elif age_limit is not None and stat.st_mtime < age_limit:
+                    rule = MAX_AGE
+            if rule is not None:
+                yield rel_path, entry, stat, rule
+            elif is_dir and stat.st_dev == device:
+                stack.append((rel_path, local))
+
+
+def skipped_paths(source_dirpath: str, patterns: List[str], ignore_file: Optional[str] = None,
+                  min_size: Optional[int] = None, max_size: Optional[int] = None,
+                  max_age: Optional[float] = None) -> Set[str]:
+    """ source files and directories rsync does not transfer (see skipped_entries) """
+    return {rel_path for rel_path, _, _, _ in skipped_entries(source_dirpath, patterns, ignore_file=ignore_file,
+                                                              min_size=min_size, max_size=max_size, max_age=max_age)}
+
+
+def excluded_report(source_dirpath: str, patterns: List[str], ignore_file: Optional[str] = None,
+                    min_size: Optional[int] = None, max_size: Optional[int] = None, max_age: Optional[float] = None,
+                    now: Optional[float] = None) -> Dict[str, Dict[str, int]]:
+    """
+    files and bytes excluded by each rule (the first matching one), walking the source as rsync would.
+    Rules of ignore files are named after the file (e.g. "photos/.backupignore: *.tmp").
+    rsync does not support negations in ignore files (only exclude patterns), they are reported as ignored.
+    Files skipped by size or age are counted in the min_size, max_size and max_age buckets.
+    """
+    report = {pattern: dict(files=0, bytes=0) for pattern in unique(patterns) if not pattern.startswith('!')}
+    ignored = []
+    for _, entry, stat, rule in skipped_entries(source_dirpath, patterns, ignore_file=ignore_file, min_size=min_size,
+                                                max_size=max_size, max_age=max_age, now=now, ignored=ignored):
+        files, size = _tree_size(entry.path) if st.S_ISDIR(stat.st_mode) else (1, stat.st_size)
+        counts = report.setdefault(rule, dict(files=0, bytes=0))
+        counts['files'] += files
+        counts['bytes'] += size
+    for name in ignored:
+        report.setdefault(f'{name} (ignored negation)', dict(files=0, bytes=0))
+    return report
+
+
+def format_report(report: Dict[str, Dict[str, int]]) -> str:
+    lines = [f'{counts["files"]:>10} files {counts["bytes"]:>16} bytes  {rule}'
+             for rule, counts in sorted(report.items(), key=lambda item: -item[1]['bytes'])]
+    return '\n'.join(lines)
@@ -0,0 +1,49 @@
+import os
+import os.path as path
+from datetime import datetime
+from typing import List, Tuple
+
+# marker beside a timestamped directory being written (e.g. a snapshot), removed once it is complete
+INCOMPLETE_SUFFIX = '.incomplete'
+
+
+def incomplete_marker(dirpath: str) -> str:
+    return dirpath.rstrip('/') + INCOMPLETE_SUFFIX
+
+
+def list_timestamped(template: str, complete: bool = False) -> List[Tuple[datetime, str]]:
+    """
+    list existing paths matching a strftime template (e.g. /backup/%Y-%m-%d-%H-%M),
+    with the timestamp parsed back from the path, sorted by timestamp.
+    With complete, paths still marked as incomplete (see incomplete_marker) are left out.
+    """
+    components = template.rstrip('/').split('/')
+    templated = [i for i, c in enumerate(components) if '%' in c]
+    if not templated:
+        return []
+    prefix = '/'.join(components[:templated[0]])
+    if not prefix:
+        prefix = '/' if template.startswith('/') else '.'
+    pattern = '/'.join(components[templated[0]:])
+    depth = len(components) - templated[0]
+    # walk down to the depth of the template
+    candidates = ['']
+    for _ in range(depth):
+        next_candidates = []
+        for candidate in candidates:
+            try:
+                names = os.listdir(path.join(prefix, candidate))
+            except OSError:
+                continue
+            next_candidates += [path.join(candidate, name) for name in names]
+        candidates = next_candidates
+    timestamped = []
+    for candidate in candidates:
+        try:
+            timestamp = datetime.strptime(candidate, pattern)
+        except ValueError:
+            continue
+        if complete and path.exists(incomplete_marker(path.join(prefix, candidate))):
+            continue
+        timestamped.append((timestamp, path.join(prefix, candidate)))
+    return sorted(timestamped)
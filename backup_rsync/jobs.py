@@ -0,0 +1,162 @@
+import os
+import os.path as path
+import json
+import threading
+import time
+from dataclasses import dataclass, field
+from datetime import datetime
+from typing import Dict, List, Optional
+from backup_rsync.backup import Backup, Server, Path_f
+from backup_rsync.progress import write_atomic
+
+
+@dataclass
+class Limits:
+    total: Optional[int] = None  # concurrent jobs overall (unlimited if None)
+    per_disk: Optional[int] = 1  # concurrent jobs reading or writing the same local disk
+    per_server: Optional[int] = 1  # concurrent jobs to the same remote server
+
+
+def _device(dirpath: str) -> int:
+    """ device of the directory, or of its nearest existing parent """
+    dirpath = path.abspath(dirpath)
+    while not path.exists(dirpath) and path.dirname(dirpath) != dirpath:
+        dirpath = path.dirname(dirpath)
+    return os.stat(dirpath).st_dev
+
+
+def resources(backup: Backup) -> List[str]:
+    """ the limited resources used by the backup: local disks (by device) and remote server """
+    used = []
+    endpoints = [(backup.source, backup._source_dirpath)]
+    endpoints += [(b.destination, b._destination_dirpath) for b in [backup] + backup._fanout]
+    for endpoint, dirpath in endpoints:
+        if endpoint.remote:
+            used.append(f'server:{backup.server.url}')
+        else:
+            used.append(f'disk:{_device(dirpath)}')
+    return sorted(set(used))
+
+
+def load_durations(state_filepath: Optional[str]) -> Dict[str, float]:
+    """ last observed duration of each job (see JobsConfig.state) """
+    if state_filepath is None or not path.exists(state_filepath):
+        return {}
+    with open(state_filepath) as state_file:
+        return {name: job['duration'] for name, job in json.load(state_file).items() if 'duration' in job}
+
+
+def run_jobs(jobs: Dict[str, Backup], limits: Limits, durations: Dict[str, float],
+             on_done=None) -> Dict[str, Dict]:
+    """
+    run the backups concurrently, within the limits.
+    Longest jobs (according to their previous durations, unknown first) are started first, to minimize the makespan.
+    Returns the result of each job.
+    """
+    pending = sorted(jobs, key=lambda name: -durations.get(name, float('inf')))
+    used = {name: resources(jobs[name]) for name in pending}
+    capacity = {'disk': limits.per_disk, 'server': limits.per_server}
+    running_on = {}  # resource -> count
+    results = {}
+    done = threading.Condition()
+    threads = []
+
+    def can_start(name: str) -> bool:
+        if limits.total is not None and len(threads) - len(results) >= limits.total:
+            return False
+        for resource in used[name]:
+            limit = capacity[resource.split(':')[0]]
+            if limit is not None and running_on.get(resource, 0) >= limit:
+                return False
+        return True
+
+    def run(name: str):
+        start, rsync_code, error = time.monotonic(), None, None
+        started = datetime.now()
+        try:
+            rsync_code = jobs[name].save()
+        except Exception as e:
+            error = str(e)
+        result = dict(code=rsync_code, start=started.isoformat(timespec='seconds'),
+                      duration=round(time.monotonic() - start, 3), error=error)
+        with done:
+            results[name] = result
+            for resource in used[name]:
+                running_on[resource] -= 1
+            done.notify()
+        if on_done is not None:
+            on_done(name, result)
+
+    with done:
+        while pending:
+            startable = next((name for name in pending if can_start(name)), None)
+            if startable is None:
+                done.wait()
+                continue
+            pending.remove(startable)
+            for resource in used[startable]:
+                running_on[resource] = running_on.get(resource, 0) + 1
+            thread = threading.Thread(target=run, args=(startable,), name=f'job-{startable}')
+            threads.append(thread)
+            thread.start()
+    for thread in threads:
+        thread.join()
+    return {name: results[name] for name in jobs}
+
+
+@dataclass
+class JobsConfig:
+    jobs: Dict[str, Backup]
+    servers: Dict[str, Server] = field(default_factory=dict)  # shared servers, referred by name in jobs
+    limits: Limits = field(default_factory=lambda: Limits())
+    state: Optional[Path_f] = None  # json file of jobs durations, for ordering
+    result: Optional[Path_f] = None  # json file of the aggregated result
+
+    def __post_init__(self):
+        for name, backup in self.jobs.items():
+            if isinstance(backup.server, str):
+                if backup.server not in self.servers:
+                    raise ValueError(f'Job {name} refers to unknown server {backup.server}.')
+                server = self.servers[backup.server]
+                for copy in [backup] + backup._fanout:
+                    copy.server = server
+                backup._check_server()
+        for limit in [self.limits.total, self.limits.per_disk, self.limits.per_server]:
+            if limit is not None and limit < 1:
+                raise ValueError('Limits must be at least 1.')
+        self._state_filepath = Backup._template_path(self.state) if self.state else None
+        self._result_filepath = Backup._template_path(self.result) if self.result else None
+
+    def debug(self):
+        for name, backup in self.jobs.items():
+            print(f'# {name} ({", ".join(resources(backup))})')
+            print(backup.rsync_command_pretty)
+
+    def save(self) -> int:
+        """ run all the jobs, returns the worst rsync code (255 if a job failed before rsync ends) """
+        state = {}
+        if self._state_filepath is not None and path.exists(self._state_filepath):
+            with open(self._state_filepath) as state_file:
+                state = json.load(state_file)
+        lock = threading.Lock()
+
+        def on_done(name: str, result: Dict):
+            print(f'{name}: finished with code {result["code"]} in {result["duration"]:.0f}s.', flush=True)
+            if self._state_filepath is None:
+                return
+            with lock:
+                if result['code'] == 0:  # durations of failed runs are meaningless
+                    state[name] = result
+                write_atomic(self._state_filepath, json.dumps(state, indent=2))
+
+        start = time.monotonic()
+        results = run_jobs(self.jobs, self.limits, load_durations(self._state_filepath), on_done=on_done)
+        codes = [255 if r['code'] is None else r['code'] for r in results.values()]
+        code = max(codes, default=0)
+        summary = dict(code=code, duration=round(time.monotonic() - start, 3),
+                       failed=sorted(name for name, c in zip(results, codes) if c != 0), jobs=results)
+        if self._result_filepath is not None:
+            write_atomic(self._result_filepath, json.dumps(summary, indent=2))
+        print(f'{len(results)} jobs finished with code {code} in {summary["duration"]:.0f}s'
+              f'{", failed: " + ", ".join(summary["failed"]) if summary["failed"] else ""}.')
+        return code
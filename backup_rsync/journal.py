@@ -0,0 +1,196 @@
+import os
+import os.path as path
+import fcntl
+import glob
+import queue
+import threading
+import time
+from datetime import datetime
+from subprocess import Popen, PIPE, DEVNULL
+from typing import List, Optional, Tuple
+
+# journal lines: "M relative/path" (created or modified), "D relative/path" (deleted), "# marker"
+_STARTED = '# started'
+_OVERFLOW = '# overflow'
+# inotify events, as reported by inotifywait
+_MODIFY_EVENTS = {'CREATE', 'CLOSE_WRITE', 'MOVED_TO', 'ATTRIB'}
+_DELETE_EVENTS = {'DELETE', 'MOVED_FROM'}
+
+
+class ChangeJournal:
+    """
+    compact journal of the paths changed in the source between runs.
+    It is written by the watcher (see watch), and consumed by the backup.
+    The journal is only trusted if the watcher is running (it holds the lock file),
+    and has been running since the previous consumption (no started marker), without overflow.
+    """
+    def __init__(self, filepath: str, max_entries: int = 100000):
+        self._filepath = filepath
+        self._max_entries = max_entries
+        self._lock_filepath = filepath + '.lock'
+        # writer state
+        self._inode = None
+        self._entries = 0
+        self._overflow = False
+
+    # writer side
+    def lock(self):
+        """ hold the watcher lock (for the lifetime of the process) """
+        os.makedirs(path.dirname(self._filepath) or '.', exist_ok=True)
+        self._lock_file = open(self._lock_filepath, 'a')
+        try:
+            fcntl.flock(self._lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            raise RuntimeError(f'journal {self._filepath} already has a watcher.')
+
+    def _open_current(self):
+        """
+        the journal, opened for appending and locked, so that it is not consumed while written.
+        A journal consumed after it was opened, but before it was locked, is not the current one anymore.
+        """
+        while True:
+            journal_file = open(self._filepath, 'a')
+            fcntl.flock(journal_file, fcntl.LOCK_EX)
+            try:
+                if os.stat(self._filepath).st_ino == os.fstat(journal_file.fileno()).st_ino:
+                    return journal_file
+            except FileNotFoundError:
+                pass
+            journal_file.close()
+
+    def append(self, records: List[Tuple[str, str]], marker: Optional[str] = None):
+        """ append (op, relative path) records, and marker if any """
+        with self._open_current() as journal_file:
+            inode = os.fstat(journal_file.fileno()).st_ino
+            if inode != self._inode:
+                # journal has been consumed: start a new one
+                self._inode, self._entries, self._overflow = inode, 0, False
+            if marker is not None:
+                journal_file.write(marker + '\n')
+            for op, relative_path in records:
+                if self._overflow:
+                    break
+                if self._entries >= self._max_entries:
+                    journal_file.write(_OVERFLOW + '\n')
+                    self._overflow = True
+                    break
+                journal_file.write(f'{op} {relative_path}\n')
+                self._entries += 1
+
+    # reader side
+    def _watcher_alive(self) -> bool:
+        if not path.exists(self._lock_filepath):
+            return False
+        with open(self._lock_filepath, 'a') as lock_file:
+            try:
+                fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                return True
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+            return False
+
+    def _consumed_filepaths(self) -> List[str]:
+        return sorted(glob.glob(glob.escape(self._filepath) + '.*.consumed'))
+
+    def consume(self, source_dirpath: str) -> Optional[Tuple[List[str], List[str]]]:
+        """
+        take over the current journal (along with the ones of failed runs),
+        and return the (changed, deleted) paths, or None if the journal cannot be trusted.
+        """
+        alive = self._watcher_alive()
+        if path.exists(self._filepath):
+            with open(self._filepath, 'a') as journal_file:
+                fcntl.flock(journal_file, fcntl.LOCK_EX)  # wait for the append in progress, if any
+                os.replace(self._filepath, f'{self._filepath}.{time.time_ns()}.consumed')
+        if alive:
+            open(self._filepath, 'a').close()  # empty journal: no change yet
+        consumed_filepaths = self._consumed_filepaths()
+        if not alive or not consumed_filepaths:
+            return None
+        last_op = {}
+        for consumed_filepath in consumed_filepaths:
+            with open(consumed_filepath, errors='surrogateescape') as journal_file:
+                for line in journal_file:
+                    line = line.rstrip('\n')
+                    if line.startswith('#'):
+                        if line.startswith(_STARTED) or line.startswith(_OVERFLOW):
+                            return None
+                        continue
+                    op, relative_path = line.split(' ', 1)
+                    last_op[relative_path] = op
+        changed, deleted = [], set()
+        for relative_path, op in sorted(last_op.items()):
+            if op == 'M' and path.lexists(path.join(source_dirpath, relative_path)):
+                changed.append(relative_path)
+            else:
+                deleted.add(relative_path)
+        # only list the top-most deleted paths, rsync deletes recursively
+        deleted = sorted(p for p in deleted if path.dirname(p) not in deleted)
+        return changed, deleted
+
+    def commit(self):
+        """ the consumed journals have been successfully backed up """
+        for consumed_filepath in self._consumed_filepaths():
+            os.remove(consumed_filepath)
+
+
+def _parse_event(line: str, source_dirpath: str) -> Optional[Tuple[str, str]]:
+    """ parse inotifywait line (format '%e|%w%f') into (op, relative path) """
+    events, _, event_path = line.rstrip('\n').partition('|')
+    events = set(events.split(','))
+    if 'Q_OVERFLOW' in events:
+        return 'overflow', ''
+    if not event_path.startswith(source_dirpath):
+        return None
+    relative_path = event_path[len(source_dirpath):].strip('/')
+    if not relative_path:
+        return None
+    if events & _DELETE_EVENTS:
+        return 'D', relative_path
+    if events & _MODIFY_EVENTS:
+        return 'M', relative_path
+    return None
+
+
+def watch(source_dirpath: str, journal: ChangeJournal, inotifywait_path: str = 'inotifywait',
+          flush_interval: float = 1.):
+    """ record changes of source into journal, using inotifywait (from inotify-tools), until interrupted """
+    journal.lock()
+    watcher = Popen([inotifywait_path, '--monitor', '--recursive', '--quiet',
+                     '--event', 'create,close_write,moved_to,moved_from,delete,attrib',
+                     '--format', '%e|%w%f', source_dirpath],
+                    stdin=DEVNULL, stdout=PIPE, text=True, errors='surrogateescape')
+    lines = queue.Queue()
+
+    def read_lines():
+        for watcher_line in watcher.stdout:
+            lines.put(watcher_line)
+        lines.put(None)  # watcher ended
+
+    threading.Thread(target=read_lines, daemon=True).start()
+    journal.append([], marker=f'{_STARTED} {datetime.now().isoformat()}')
+    records = []
+    last_flush = time.monotonic()
+    try:
+        while True:
+            try:
+                line = lines.get(timeout=flush_interval)
+            except queue.Empty:
+                line = ''
+            if line is None:
+                break
+            record = _parse_event(line, source_dirpath) if line else None
+            if record is not None and record[0] == 'overflow':
+                journal.append(records, marker=_OVERFLOW)
+                records = []
+            elif record is not None and (not records or records[-1] != record):
+                records.append(record)
+            if records and (time.monotonic() - last_flush >= flush_interval or len(records) >= 10000):
+                journal.append(records)
+                records = []
+                last_flush = time.monotonic()
+    finally:
+        journal.append(records)
+        watcher.terminate()
+        watcher.wait()
+    return watcher.returncode
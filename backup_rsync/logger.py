@@ -1,7 +1,57 @@
 import os
-from typing import Optional
+from typing import Dict, List, Optional
 import sys
 import os.path as path
+import glob
+import gzip
+import json
+import shutil
+import subprocess
+import threading
+from datetime import datetime
+
+_COMPRESSED_SUFFIX = {'gzip': '.gz', 'zstd': '.zst'}
+
+
+def index_filepath(actions_filepath: str) -> str:
+    """ the run index of an actions log """
+    return actions_filepath + '.idx'
+
+
+def read_index(actions_filepath: str) -> List[Dict]:
+    """ runs of the actions log, as {'run': isoformat start, 'offset': byte offset of the run header} """
+    filepath = index_filepath(actions_filepath)
+    if not path.exists(filepath):
+        return []
+    with open(filepath) as index_file:
+        return [json.loads(line) for line in index_file if line.strip()]
+
+
+def read_run(actions_filepath: str, run: int = -1) -> str:
+    """ section of the actions log written by the given run (index in read_index, last by default) """
+    runs = read_index(actions_filepath)
+    start = runs[run]['offset']
+    end = runs[run + 1]['offset'] if run != -1 and run + 1 < len(runs) else None
+    with open(actions_filepath, 'rb') as actions_file:
+        actions_file.seek(start)
+        content = actions_file.read() if end is None else actions_file.read(end - start)
+    return content.decode(errors='replace')
+
+
+def rotated_segments(actions_filepath: str) -> List[str]:
+    """ rotated segments of the actions log, oldest first """
+    segments = glob.glob(glob.escape(actions_filepath) + '.*-*')
+    return sorted(s for s in segments if not s.endswith('.idx'))
+
+
+def compress(filepath: str, algorithm: str):
+    """ compress the file beside (e.g. log.gz), then remove it """
+    if algorithm == 'zstd':
+        subprocess.run(['zstd', '-q', '--rm', '-f', filepath], check=True)
+        return
+    with open(filepath, 'rb') as source, gzip.open(filepath + '.gz', 'wb') as target:
+        shutil.copyfileobj(source, target)
+    os.remove(filepath)
 
 
 class Logger3:
@@ -21,8 +71,18 @@ class Logger3:
             self,
             actions_filepath: Optional[str],
             progress_filepath: Optional[str],
-            errors_filepath: Optional[str]
+            errors_filepath: Optional[str],
+            max_size: Optional[int] = None,
+            max_runs: Optional[int] = None,
+            keep: Optional[int] = None,
+            compression: Optional[str] = None,
+            index: bool = False
     ):
+        """
+        actions log is rotated before a run, if larger than max_size bytes or holding max_runs runs.
+        Rotated segments are compressed (gzip or zstd) in background, and only the last keep are kept.
+        index records the offset of each run in the actions log (always on with max_runs).
+        """
         # channel -> filepath
         self._log_filepath = {
             'actions': actions_filepath,
@@ -37,17 +97,34 @@ class Logger3:
 
         # filepath -> file
         self._log_files = {k: None for k in self._log_filepath.values()}
+        self._max_size = max_size
+        self._max_runs = max_runs
+        self._keep = keep
+        self._compression = compression
+        self._index = index or max_runs is not None
+        self._compressor = None
 
     def __enter__(self):
+        actions_filepath = self._log_filepath.get('actions')
+        if actions_filepath is not None:
+            self._rotate(actions_filepath)
         for filepath in self._log_files.keys():
             os.makedirs(path.dirname(filepath), exist_ok=True)
             self._log_files[filepath] = open(filepath, 'a')
+        if actions_filepath is not None and self._index:
+            with open(index_filepath(actions_filepath), 'a') as index_file:
+                run = dict(run=datetime.now().isoformat(timespec='seconds'),
+                           offset=self._log_files[actions_filepath].tell())
+                index_file.write(json.dumps(run) + '\n')
         return self
 
     def __exit__(self, exc_type, exc_val, exc_tb):
         for filepath, logfile in self._log_files.items():
             self._log_files[filepath].close()
             self._log_files[filepath] = None
+        if self._compressor is not None:
+            self._compressor.join()
+            self._compressor = None
         # remove progress file
         progress_filepath = self._log_filepath.get('progress')
         if progress_filepath is not None:
@@ -58,6 +135,42 @@ class Logger3:
             os.remove(errors_filepath)
         return True
 
+    def _should_rotate(self, actions_filepath: str) -> bool:
+        if not path.exists(actions_filepath):
+            return False
+        if self._max_size is not None and os.stat(actions_filepath).st_size >= self._max_size:
+            return True
+        if self._max_runs is not None and len(read_index(actions_filepath)) >= self._max_runs:
+            return True
+        return False
+
+    def _rotate(self, actions_filepath: str):
+        """ move the actions log (and its index) aside, then compress and prune segments in background """
+        if not self._should_rotate(actions_filepath):
+            return
+        segment_filepath = f'{actions_filepath}.{datetime.now():%Y%m%d-%H%M%S-%f}'
+        os.replace(actions_filepath, segment_filepath)
+        if path.exists(index_filepath(actions_filepath)):
+            os.replace(index_filepath(actions_filepath), index_filepath(segment_filepath))
+
+        def compress_and_prune():
+            if self._compression is not None:
+                try:
+                    compress(segment_filepath, self._compression)
+                except (OSError, subprocess.CalledProcessError) as e:
+                    print(f'failed to compress {segment_filepath}: {e}', file=sys.stderr)
+            if self._keep is not None:
+                segments = rotated_segments(actions_filepath)
+                for segment in segments[:max(len(segments) - self._keep, 0)]:
+                    os.remove(segment)
+                    segment_index = index_filepath(path.splitext(segment)[0] if segment.endswith(
+                        tuple(_COMPRESSED_SUFFIX.values())) else segment)
+                    if path.exists(segment_index):
+                        os.remove(segment_index)
+
+        self._compressor = threading.Thread(target=compress_and_prune, name='log-rotation')
+        self._compressor.start()
+
     def filepath(self, channel: str) -> Optional[str]:
         return self._log_filepath.get(channel)
 
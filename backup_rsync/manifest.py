@@ -0,0 +1,129 @@
+import os
+import os.path as path
+import sqlite3
+import hashlib
+import stat as st
+from datetime import datetime
+from typing import Dict, List, Tuple
+from dataclasses import dataclass, field
+
+
+def hash_file(filepath: str, chunk_size: int = 1 << 20) -> str:
+    """ hash file content by chunks (symlinks: hash the link target) """
+    digest = hashlib.blake2b(digest_size=16)
+    if path.islink(filepath):
+        digest.update(os.readlink(filepath).encode('utf-8', 'surrogateescape'))
+        return digest.hexdigest()
+    with open(filepath, 'rb') as f:
+        while chunk := f.read(chunk_size):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def walk_tree(root_dirpath: str):
+    """ yield (relative path, stat) of every entry, without following symlinks nor crossing filesystems """
+    device = os.lstat(root_dirpath).st_dev
+    stack = ['']
+    while stack:
+        rel_dirpath = stack.pop()
+        try:
+            with os.scandir(path.join(root_dirpath, rel_dirpath)) as it:
+                for entry in it:
+                    rel_path = path.join(rel_dirpath, entry.name)
+                    try:
+                        stat = entry.stat(follow_symlinks=False)
+                    except OSError:
+                        continue
+                    yield rel_path, stat
+                    if st.S_ISDIR(stat.st_mode) and stat.st_dev == device:
+                        stack.append(rel_path)
+        except OSError:
+            continue
+
+
+def write_files_from(filepath: str, paths: List[str]):
+    """ write a NUL separated list, for rsync --files-from with --from0 """
+    with open(filepath, 'wb') as f:
+        for p in paths:
+            f.write(os.fsencode(p) + b'\0')
+
+
+@dataclass
+class ChangeSet:
+    changed: List[str] = field(default_factory=list)  # new or modified paths
+    deleted: List[str] = field(default_factory=list)  # paths gone since last run
+    rows: Dict[str, Tuple[int, int, int, str]] = field(default_factory=dict)  # rows to update
+
+    @property
+    def paths(self) -> List[str]:
+        return sorted(self.changed + self.deleted)
+
+
+class ManifestIndex:
+    """
+    persistent index of source files (size, mtime, inode, hash) as seen by the last successful runs.
+    It is used to list the files that actually changed, instead of letting rsync checksum the whole tree.
+    """
+    def __init__(self, filepath: str):
+        self._filepath = filepath
+        self._db = None
+
+    def __enter__(self):
+        os.makedirs(path.dirname(self._filepath) or '.', exist_ok=True)
+        self._db = sqlite3.connect(self._filepath)
+        self._db.execute('CREATE TABLE IF NOT EXISTS files ('
+                         'path TEXT PRIMARY KEY, size INTEGER, mtime_ns INTEGER, inode INTEGER, hash TEXT)')
+        self._db.execute('CREATE TABLE IF NOT EXISTS runs ('
+                         'id INTEGER PRIMARY KEY AUTOINCREMENT, timestamp TEXT, full INTEGER)')
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self._db.close()
+        self._db = None
+
+    @property
+    def run_count(self) -> int:
+        return self._db.execute('SELECT COUNT(*) FROM runs').fetchone()[0]
+
+    def is_full_run(self, verify_every: int) -> bool:
+        """ first run, or every verify_every runs: let rsync checksum everything """
+        run_count = self.run_count
+        return run_count == 0 or (verify_every > 0 and run_count % verify_every == 0)
+
+    def scan(self, source_dirpath: str) -> ChangeSet:
+        """ compare source tree against index, only hashing files which metadata changed """
+        known = {row[0]: row[1:] for row in self._db.execute('SELECT path, size, mtime_ns, inode, hash FROM files')}
+        changes = ChangeSet()
+        for rel_path, stat in walk_tree(source_dirpath):
+            row = known.pop(rel_path, None)
+            if st.S_ISDIR(stat.st_mode):
+                # directories are only listed when new: they are recursed by rsync
+                if row is None:
+                    changes.changed.append(rel_path)
+                    changes.rows[rel_path] = (0, 0, stat.st_ino, '')
+                continue
+            metadata = (stat.st_size, stat.st_mtime_ns, stat.st_ino)
+            if row is not None and tuple(row[:3]) == metadata:
+                continue
+            try:
+                content_hash = hash_file(path.join(source_dirpath, rel_path))
+            except OSError:
+                continue  # vanished or unreadable, let rsync report it
+            changes.rows[rel_path] = metadata + (content_hash,)
+            if row is None or row[3] != content_hash:
+                changes.changed.append(rel_path)
+        # only list the top-most deleted paths, rsync deletes recursively
+        deleted = set(known)
+        changes.deleted = [p for p in deleted if path.dirname(p) not in deleted]
+        return changes
+
+    def commit(self, changes: ChangeSet, full: bool):
+        """ record changes of a successful run """
+        with self._db:
+            self._db.executemany('INSERT OR REPLACE INTO files (path, size, mtime_ns, inode, hash) VALUES (?, ?, ?, ?, ?)',
+                                 [(p,) + row for p, row in changes.rows.items()])
+            for p in changes.deleted:
+                like = p.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_') + '/%'
+                self._db.execute("DELETE FROM files WHERE path = ? OR path LIKE ? ESCAPE '\\'", (p, like))
+            self._db.execute('INSERT INTO runs (timestamp, full) VALUES (?, ?)',
+                             (datetime.now().isoformat(), int(full)))
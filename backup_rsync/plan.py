@@ -0,0 +1,157 @@
+import os
+import os.path as path
+import json
+import stat as st
+from fnmatch import fnmatchcase
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from typing import Dict, List, NamedTuple, Optional
+from backup_rsync.history import list_timestamped
+
+
+class Entry(NamedTuple):
+    is_dir: bool
+    size: int
+    mtime: int
+
+
+def is_excluded(relative_path: str, is_dir: bool, excludes: List[str]) -> bool:
+    """ approximation of rsync exclude patterns matching (!pattern includes again, the last matching one wins) """
+    name = path.basename(relative_path)
+    for pattern in reversed(excludes):
+        negated = pattern.startswith('!')
+        if negated:
+            pattern = pattern[1:]
+        if pattern.endswith('/'):
+            if not is_dir:
+                continue
+            pattern = pattern.rstrip('/')
+        if pattern.startswith('/'):
+            matched = fnmatchcase(relative_path, pattern[1:])
+        elif '/' in pattern:
+            matched = fnmatchcase(relative_path, pattern) or fnmatchcase(relative_path, '*/' + pattern)
+        else:
+            matched = fnmatchcase(name, pattern)
+        if matched:
+            return not negated
+    return False
+
+
+def _scan_dir(root_dirpath: str, relative_dirpath: str, device: int, excludes: List[str]):
+    """ list a single directory: returns sub-directories to scan, and entries """
+    subdirs, entries = [], {}
+    try:
+        with os.scandir(path.join(root_dirpath, relative_dirpath)) as it:
+            for dir_entry in it:
+                relative_path = path.join(relative_dirpath, dir_entry.name)
+                try:
+                    stat = dir_entry.stat(follow_symlinks=False)
+                except OSError:
+                    continue
+                is_dir = st.S_ISDIR(stat.st_mode)
+                if excludes and is_excluded(relative_path, is_dir, excludes):
+                    continue
+                entries[relative_path] = Entry(is_dir, 0 if is_dir else stat.st_size, int(stat.st_mtime))
+                if is_dir and stat.st_dev == device:
+                    subdirs.append(relative_path)
+    except OSError:
+        pass
+    return subdirs, entries
+
+
+def scan_trees(root_dirpaths: List[Optional[str]], excludes: List[List[str]], workers: int = 16) \
+        -> List[Dict[str, Entry]]:
+    """ walk several trees concurrently, with a pool of threads running os.scandir """
+    trees = [{} for _ in root_dirpaths]
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        pending = {}
+        for index, root_dirpath in enumerate(root_dirpaths):
+            if root_dirpath is not None and path.isdir(root_dirpath):
+                device = os.stat(root_dirpath).st_dev
+                future = pool.submit(_scan_dir, root_dirpath, '', device, excludes[index])
+                pending[future] = (index, device)
+        while pending:
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                index, device = pending.pop(future)
+                subdirs, entries = future.result()
+                trees[index].update(entries)
+                for subdir in subdirs:
+                    future = pool.submit(_scan_dir, root_dirpaths[index], subdir, device, excludes[index])
+                    pending[future] = (index, device)
+    return trees
+
+
+def compare_trees(source: Dict[str, Entry], destination: Dict[str, Entry], delete: bool = True) -> Dict:
+    """ what rsync (--update, without --checksum) would do, with counts and bytes per action """
+    plan = {action: {'files': 0, 'bytes': 0} for action in ('create', 'update', 'delete')}
+    plan['directories'] = {'create': 0, 'delete': 0}
+    for relative_path, src in source.items():
+        dst = destination.get(relative_path)
+        if src.is_dir:
+            if dst is None or not dst.is_dir:
+                plan['directories']['create'] += 1
+            continue
+        if dst is None or dst.is_dir:
+            action = 'create'
+        elif dst.mtime > src.mtime:
+            continue  # --update: newer on destination
+        elif dst.size != src.size or dst.mtime != src.mtime:
+            action = 'update'
+        else:
+            continue
+        plan[action]['files'] += 1
+        plan[action]['bytes'] += src.size
+    if delete:
+        for relative_path, dst in destination.items():
+            src = source.get(relative_path)
+            if src is not None and src.is_dir == dst.is_dir:
+                continue
+            if dst.is_dir:
+                plan['directories']['delete'] += 1
+            else:
+                plan['delete']['files'] += 1
+                plan['delete']['bytes'] += dst.size
+    return plan
+
+
+def estimate_throughput(report_template: Optional[str], last: int = 5) -> Optional[float]:
+    """ average throughput (bytes/s) of the last run reports (see RunReport) """
+    if report_template is None:
+        return None
+    report_filepaths = [p for _, p in list_timestamped(report_template)] or [report_template]
+    throughputs = []
+    for report_filepath in reversed(report_filepaths):
+        try:
+            with open(report_filepath) as report_file:
+                report = json.load(report_file)
+            transferred = report['created']['bytes'] + report['updated']['bytes']
+            if report.get('dryrun') or not report.get('wall_time') or transferred == 0:
+                continue
+            throughput = transferred / report['wall_time']
+        except (OSError, ValueError, KeyError, TypeError, AttributeError):
+            continue  # unreadable, or not a run report (e.g. written by another version)
+        throughputs.append(throughput)
+        if len(throughputs) >= last:
+            break
+    if not throughputs:
+        return None
+    return sum(throughputs) / len(throughputs)
+
+
+def format_plan(plan: Dict) -> str:
+    def human(size: float) -> str:
+        for unit in ['B', 'kB', 'MB', 'GB', 'TB']:
+            if size < 1024 or unit == 'TB':
+                return f'{size:.1f}{unit}' if unit != 'B' else f'{int(size)}B'
+            size /= 1024
+
+    lines = [f'{action:<8} {plan[action]["files"]:>12} files {human(plan[action]["bytes"]):>10}'
+             for action in ('create', 'update', 'delete')]
+    lines.append(f'{"dirs":<8} {plan["directories"]["create"]:>12} created {plan["directories"]["delete"]:>8} deleted')
+    if plan.get('eta') is not None:
+        hours, seconds = divmod(int(plan['eta']), 3600)
+        lines.append(f'{"eta":<8} {hours:>9}:{seconds // 60:02d}:{seconds % 60:02d} '
+                     f'(at {human(plan["throughput"])}/s)')
+    else:
+        lines.append(f'{"eta":<8} {"unknown":>12} (no previous run report)')
+    return '\n'.join(lines)
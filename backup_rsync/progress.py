@@ -0,0 +1,141 @@
+import os
+import os.path as path
+import re
+import codecs
+import json
+import time
+import tempfile
+import threading
+from datetime import datetime
+from typing import Dict, List, Optional
+
+# e.g. "  1,234,567  45%   12.34MB/s    0:01:23 (xfr#12, to-chk=100/2000)"
+_PROGRESS_LINE = re.compile(
+    r'^\s*(?P<bytes>[\d,]+)\s+(?P<percent>\d+)%\s+(?P<rate>[\d.,]+)(?P<unit>[kMGTP]?B)/s'
+    r'\s+(?P<eta>\d+:\d{2}:\d{2})'
+    r'(?:\s+\((?:xfr#(?P<xfr>\d+),\s*)?(?:ir|to)-chk=(?P<to_check>\d+)/(?P<total>\d+)\))?')
+_UNITS = {'B': 1, 'kB': 1 << 10, 'MB': 1 << 20, 'GB': 1 << 30, 'TB': 1 << 40, 'PB': 1 << 50}
+
+
+def parse_progress_line(line: str) -> Optional[Dict]:
+    """ parse a rsync (--info=progress2) progress line, or None if line is not a progress line """
+    match = _PROGRESS_LINE.match(line)
+    if match is None:
+        return None
+    hours, minutes, seconds = (int(v) for v in match['eta'].split(':'))
+    progress = {
+        'bytes': int(match['bytes'].replace(',', '')),
+        'percent': int(match['percent']),
+        'rate': float(match['rate'].replace(',', '')) * _UNITS[match['unit']],
+        'eta': hours * 3600 + minutes * 60 + seconds,
+    }
+    if match['to_check'] is not None:
+        progress['files'] = int(match['xfr'] or 0)
+        progress['to_check'] = int(match['to_check'])
+        progress['total'] = int(match['total'])
+    return progress
+
+
+def write_atomic(filepath: str, content: str):
+    """ write a file, so that readers never see it partially written """
+    dirpath = path.dirname(filepath) or '.'
+    os.makedirs(dirpath, exist_ok=True)
+    fd, tmp_filepath = tempfile.mkstemp(dir=dirpath, prefix='.' + path.basename(filepath) + '.')
+    try:
+        with os.fdopen(fd, 'w') as f:
+            f.write(content)
+        os.replace(tmp_filepath, filepath)
+    except BaseException:
+        os.remove(tmp_filepath)
+        raise
+
+
+class ProgressMonitor:
+    """
+    turns rsync progress lines into structured events:
+        - status: small json file, atomically rewritten (at most every interval seconds)
+        - events: json lines stream, one event (at most every interval seconds)
+    Several rsync may report to the same monitor (e.g. shards), each on its own channel.
+    """
+    def __init__(
+            self,
+            status_filepath: Optional[str] = None,
+            events_filepath: Optional[str] = None,
+            interval: float = 1.0
+    ):
+        self._status_filepath = status_filepath
+        self._events_filepath = events_filepath
+        self._interval = interval
+        self._started = time.monotonic()
+        self._started_at = datetime.now().isoformat()
+        self._last_emit = None
+        self._channels = {}
+        self._lock = threading.Lock()
+
+    def _aggregate(self) -> Dict:
+        channels = list(self._channels.values())
+        elapsed = time.monotonic() - self._started
+        status = {
+            'started': self._started_at,
+            'updated': datetime.now().isoformat(),
+            'elapsed': round(elapsed, 3),
+            'bytes': sum(c['bytes'] for c in channels),
+            'rate': sum(c['rate'] for c in channels),
+            'eta': max((c['eta'] for c in channels), default=0),
+        }
+        if channels and all('to_check' in c for c in channels):
+            status['files'] = sum(c['files'] for c in channels)
+            status['files_per_sec'] = round(status['files'] / elapsed, 3) if elapsed > 0 else 0.
+            status['to_check'] = sum(c['to_check'] for c in channels)
+            status['total'] = sum(c['total'] for c in channels)
+        return status
+
+    def _emit(self, status: Dict):
+        if self._status_filepath is not None:
+            write_atomic(self._status_filepath, json.dumps(status, indent=2) + '\n')
+        if self._events_filepath is not None:
+            os.makedirs(path.dirname(self._events_filepath) or '.', exist_ok=True)
+            with open(self._events_filepath, 'a') as events_file:
+                events_file.write(json.dumps(status) + '\n')
+
+    def feed(self, line: str, channel: int = 0):
+        """ give a line of rsync output """
+        progress = parse_progress_line(line)
+        if progress is None:
+            return
+        with self._lock:
+            self._channels[channel] = progress
+            now = time.monotonic()
+            if self._last_emit is not None and now - self._last_emit < self._interval:
+                return
+            self._last_emit = now
+            self._emit(dict(self._aggregate(), state='running'))
+
+    def close(self, code: int):
+        """ emit the final status """
+        with self._lock:
+            self._emit(dict(self._aggregate(), state='finished', code=int(code)))
+
+
+def pump(stream, output, listeners: List, channel: int = 0, chunk_size: int = 1 << 16):
+    """
+    read rsync stdout incrementally until closed, and give every line to the listeners (see ProgressMonitor.feed).
+    Complete lines are copied to output, progress updates (ending with \\r) are only given to the listeners.
+    """
+    decoder = codecs.getincrementaldecoder('utf-8')(errors='replace')
+    pending = ''
+    while chunk := stream.read1(chunk_size):
+        pending += decoder.decode(chunk)
+        lines = re.split(r'(?<=[\r\n])', pending)
+        pending = lines.pop()  # incomplete line (or empty)
+        for line in lines:
+            for listener in listeners:
+                listener.feed(line, channel)
+            if line.endswith('\n'):
+                output.write(line)
+    pending += decoder.decode(b'', final=True)
+    if pending:
+        for listener in listeners:
+            listener.feed(pending, channel)
+        output.write(pending)
+    output.flush()
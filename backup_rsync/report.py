@@ -0,0 +1,179 @@
+import os
+import os.path as path
+import re
+import json
+import threading
+from datetime import datetime
+from typing import Dict, Optional
+from backup_rsync.progress import write_atomic
+
+# output format, given to rsync as --out-format: itemized changes, file length, file name
+OUT_FORMAT = '%i %l %n%L'
+# e.g. ">f+++++++++ 1234 dir/file.txt" or "*deleting   0 dir/file.txt"
+_ITEMIZE_LINE = re.compile(r'^(?P<item>[<>ch.*][^\s]{8}[^\s]?[^\s]?\s*) (?P<size>\d+) (?P<name>.+?)(?: -> .*)?\n$')
+# e.g. "Number of created files: 1,234 (reg: 1,000, dir: 234)", "Total bytes sent: 155"
+_STATS_LINE = re.compile(r'^(?P<key>[A-Z][A-Za-z ]+): (?P<value>[\d,]+)\b')
+_STATS_KEYS = {
+    'Number of files': 'files',
+    'Number of created files': 'created_files',
+    'Number of deleted files': 'deleted_files',
+    'Number of regular files transferred': 'transferred_files',
+    'Total file size': 'total_size',
+    'Total transferred file size': 'transferred_size',
+    'Literal data': 'literal_data',
+    'Matched data': 'matched_data',
+    'File list size': 'file_list_size',
+    'Total bytes sent': 'bytes_sent',
+    'Total bytes received': 'bytes_received',
+}
+_ACTIONS = ('created', 'updated', 'deleted')
+
+
+def parse_change_line(line: str) -> Optional[Dict]:
+    """ parse an itemized change line (see OUT_FORMAT), or None if line is not one """
+    match = _ITEMIZE_LINE.match(line)
+    if match is None:
+        return None
+    return dict(item=match['item'].strip(), size=int(match['size']), name=match['name'])
+
+
+def _counter() -> Dict:
+    return {action: {'files': 0, 'bytes': 0} for action in _ACTIONS}
+
+
+class RunReport:
+    """
+    gathers rsync --stats and itemized changes (see OUT_FORMAT) into a machine-readable report.
+    Several rsync may report to the same report (e.g. shards), stats are summed.
+    With paths, changes are kept by path, so that a path counts once over the attempts of a transfer (see merge).
+    """
+    def __init__(self, paths: bool = False):
+        self.stats = {key: 0 for key in _STATS_KEYS.values()}
+        self.changes = _counter()
+        self.directories = {}  # top-level dir -> changes
+        self.deleted_paths = []
+        self.started = datetime.now()
+        self.finished = None
+        self.code = None
+        self.attempts = []  # failed attempts, that were retried: their code and stats
+        self._paths = {} if paths else None  # path -> (action, size)
+        self._lock = threading.Lock()
+
+    def _count(self, action: str, name: str, size: int):
+        if self._paths is not None:
+            self._paths[name] = (action, size)
+            return
+        top_level = name.split('/', 1)[0] if '/' in name.rstrip('/') else '.'
+        directory = self.directories.setdefault(top_level, _counter())
+        for counter in (self.changes, directory):
+            counter[action]['files'] += 1
+            counter[action]['bytes'] += size
+
+    def feed(self, line: str, channel: int = 0):
+        """ give a line of rsync output """
+        if not line.endswith('\n'):
+            return
+        with self._lock:
+            change = parse_change_line(line)
+            if change is not None:
+                item, name, size = change['item'], change['name'], change['size']
+                if item == '*deleting':
+                    self.deleted_paths.append(name)
+                    if not name.endswith('/'):
+                        self._count('deleted', name, 0)
+                elif item[0] in '<>' and item[1] == 'f':
+                    self._count('created' if item[2:] == '+' * len(item[2:]) else 'updated', name, size)
+                return
+            match = _STATS_LINE.match(line)
+            if match is not None and match['key'] in _STATS_KEYS:
+                self.stats[_STATS_KEYS[match['key']]] += int(match['value'].replace(',', ''))
+
+    def retried(self, code: int):
+        """ the attempt failed and is retried: its stats are recorded apart, and the next attempt starts them again """
+        with self._lock:
+            self.attempts.append(dict(code=int(code), stats=self.stats))
+            self.stats = {key: 0 for key in _STATS_KEYS.values()}
+
+    def merge(self, other: 'RunReport', channel: int = 0):
+        """ add the changes (each path once) and stats of the last attempt of a transfer reported with paths """
+        with self._lock:
+            for name, (action, size) in other._paths.items():
+                self._count(action, name, size)
+            for key, value in other.stats.items():
+                self.stats[key] += value
+            self.deleted_paths += list(dict.fromkeys(other.deleted_paths))
+            self.attempts += [dict(attempt, channel=channel) for attempt in other.attempts]
+
+    def resolve_deleted(self, history_dirpath: Optional[str]):
+        """ deleted files have been moved to history, get their size back from there """
+        if history_dirpath is None:
+            return
+        with self._lock:
+            for name in self.deleted_paths:
+                filepath = path.join(history_dirpath, name)
+                if path.isfile(filepath) and not path.islink(filepath):
+                    size = os.lstat(filepath).st_size
+                    top_level = name.split('/', 1)[0] if '/' in name else '.'
+                    self.changes['deleted']['bytes'] += size
+                    self.directories[top_level]['deleted']['bytes'] += size
+
+    def close(self, code: int):
+        self.finished = datetime.now()
+        self.code = int(code)
+
+    @property
+    def speedup(self) -> Optional[float]:
+        exchanged = self.stats['bytes_sent'] + self.stats['bytes_received']
+        if exchanged == 0:
+            return None
+        return round(self.stats['total_size'] / exchanged, 2)
+
+    def as_dict(self, **context) -> Dict:
+        return dict(
+            context,
+            started=self.started.isoformat(),
+            finished=self.finished.isoformat() if self.finished else None,
+            wall_time=round((self.finished - self.started).total_seconds(), 3) if self.finished else None,
+            code=self.code,
+            stats=self.stats,
+            speedup=self.speedup,
+            **self.changes,
+            directories=self.directories,
+            attempts=self.attempts,
+        )
+
+    def write_json(self, filepath: str, **context):
+        write_atomic(filepath, json.dumps(self.as_dict(**context), indent=2) + '\n')
+
+    def write_prometheus(self, filepath: str, **labels):
+        """ write metrics in node_exporter textfile collector format """
+        def escape(value) -> str:
+            return str(value).replace('\\', r'\\').replace('"', r'\"').replace('\n', r'\n')
+
+        def format_labels(**extra) -> str:
+            return '{' + ','.join(f'{k}="{escape(v)}"' for k, v in dict(labels, **extra).items()) + '}'
+
+        metrics = [
+            ('last_run_timestamp_seconds', 'gauge', 'End time of the last backup run.',
+             [({}, self.finished.timestamp())]),
+            ('exit_code', 'gauge', 'rsync exit code of the last backup run.', [({}, self.code)]),
+            ('duration_seconds', 'gauge', 'Wall time of the last backup run.',
+             [({}, (self.finished - self.started).total_seconds())]),
+            ('files', 'gauge', 'Files per action in the last backup run.',
+             [({'action': a}, self.changes[a]['files']) for a in _ACTIONS]),
+            ('bytes', 'gauge', 'Bytes per action in the last backup run.',
+             [({'action': a}, self.changes[a]['bytes']) for a in _ACTIONS]),
+            ('data_bytes', 'gauge', 'Literal and matched data of the last backup run.',
+             [({'kind': 'literal'}, self.stats['literal_data']), ({'kind': 'matched'}, self.stats['matched_data'])]),
+            ('network_bytes', 'gauge', 'Bytes sent and received by the last backup run.',
+             [({'direction': 'sent'}, self.stats['bytes_sent']),
+              ({'direction': 'received'}, self.stats['bytes_received'])]),
+            ('speedup_ratio', 'gauge', 'rsync speedup of the last backup run.', [({}, self.speedup or 0)]),
+        ]
+        lines = []
+        for name, kind, help_text, samples in metrics:
+            lines.append(f'# HELP backup_rsync_{name} {help_text}')
+            lines.append(f'# TYPE backup_rsync_{name} {kind}')
+            for extra, value in samples:
+                lines.append(f'backup_rsync_{name}{format_labels(**extra)} {value}')
+        write_atomic(filepath, '\n'.join(lines) + '\n')
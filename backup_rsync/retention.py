@@ -0,0 +1,103 @@
+import os
+import os.path as path
+import shutil
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from typing import Callable, Dict, List, Optional, Tuple
+from backup_rsync.history import incomplete_marker, list_timestamped
+
+# GFS periods: key of the period a timestamp belongs to
+PERIODS: Dict[str, Callable[[datetime], Tuple]] = {
+    'daily': lambda t: (t.year, t.month, t.day),
+    'weekly': lambda t: tuple(t.isocalendar()[:2]),
+    'monthly': lambda t: (t.year, t.month),
+    'yearly': lambda t: (t.year,),
+}
+
+
+def select_kept(timestamps: List[datetime], last: int = 1, **counts: Optional[int]) -> List[datetime]:
+    """
+    timestamps to keep: the last ones, plus the most recent of each of the last daily, weekly, monthly and yearly periods
+    (grandfather-father-son). e.g. select_kept(timestamps, last=3, daily=7, weekly=4).
+    """
+    newest_first = sorted(timestamps, reverse=True)
+    kept = set(newest_first[:last])
+    for period, count in counts.items():
+        if not count:
+            continue
+        seen = set()
+        for timestamp in newest_first:
+            key = PERIODS[period](timestamp)
+            if key in seen:
+                continue
+            seen.add(key)
+            kept.add(timestamp)
+            if len(seen) >= count:
+                break
+    return sorted(kept)
+
+
+def expired_paths(template: str, last: int = 1, **counts: Optional[int]) -> List[str]:
+    """
+    existing paths matching the strftime template, but not kept by the policy, oldest first.
+    Incomplete paths (e.g. snapshots of failed runs) are never kept.
+    """
+    timestamped = list_timestamped(template)
+    complete = list_timestamped(template, complete=True)
+    kept = set(select_kept([t for t, _ in complete], last=last, **counts))
+    return [p for t, p in timestamped if (t, p) not in complete or t not in kept]
+
+
+def remove_tree(dirpath: str, pool: ThreadPoolExecutor):
+    """ remove a directory, its top-level entries being removed concurrently by the pool """
+    if not path.isdir(dirpath) or path.islink(dirpath):
+        os.remove(dirpath)
+        return
+    futures = []
+    for entry in os.scandir(dirpath):
+        if entry.is_dir(follow_symlinks=False):
+            futures.append(pool.submit(shutil.rmtree, entry.path))
+        else:
+            futures.append(pool.submit(os.remove, entry.path))
+    for future in futures:
+        future.result()
+    os.rmdir(dirpath)
+
+
+def prune(paths: List[str], workers: int = 4) -> List[str]:
+    """ remove the paths (oldest first, and their incomplete marker), with bounded concurrency. Returns the errors. """
+    errors = []
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        for expired in paths:
+            try:
+                remove_tree(expired, pool)
+                if path.exists(incomplete_marker(expired)):
+                    os.remove(incomplete_marker(expired))
+            except OSError as e:
+                errors.append(f'{expired}: {e}')
+    return errors
+
+
+class Pruner:
+    """ prune paths in a background thread (e.g. during the next transfer) """
+    def __init__(self, paths: List[str], workers: int = 4):
+        self.paths = paths
+        self.errors = []
+        self._workers = workers
+        self._thread = None
+
+    def __enter__(self):
+        if self.paths:
+            self._thread = threading.Thread(target=self.run, name='retention', daemon=True)
+            self._thread.start()
+        return self
+
+    def run(self):
+        """ prune now (blocking) """
+        self.errors = prune(self.paths, workers=self._workers)
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
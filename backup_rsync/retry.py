@@ -0,0 +1,72 @@
+import re
+import os.path as path
+import threading
+from typing import List, Optional, Set
+
+# e.g. 'rsync: [sender] send_files failed to open "/src/file": Permission denied (13)'
+_QUOTED_PATH = re.compile(r'"(?P<path>[^"]+)"')
+# e.g. 'file has vanished: "/src/file"'
+_VANISHED = re.compile(r'^(?:rsync: )?file has vanished: ')
+# e.g. 'rsync error: some files/attrs were not transferred (see previous errors) (code 23) at main.c(1338)'
+_SUMMARY = re.compile(r'^rsync (?:error|warning): .*\(code \d+\)')
+# receiver temporary file, e.g. "dir/.file.Xa8d7c"
+_TEMP_NAME = re.compile(r'^\.(?P<name>.+)\.[A-Za-z0-9]{6}$')
+
+
+class FailedPaths:
+    """
+    collects the paths rsync failed to transfer, from its errors output (see ProgressMonitor.feed).
+    When an error cannot be related to a path (e.g. connection lost), the whole transfer must be retried.
+    """
+    def __init__(self, root_dirpaths: List[str]):
+        self._root_dirpaths = [p for p in root_dirpaths if p]
+        self.paths: Set[str] = set()
+        self.vanished: Set[str] = set()
+        self.full = False
+        self._lock = threading.Lock()
+
+    def _relative(self, error_path: str) -> Optional[str]:
+        """ path relative to transfer root, or None if it is out of the transfer """
+        for root_dirpath in self._root_dirpaths:
+            if error_path.startswith(root_dirpath):
+                error_path = error_path[len(root_dirpath):]
+                break
+        else:
+            if error_path.startswith('/'):
+                return None
+        dirname, basename = path.split(error_path.rstrip('/'))
+        match = _TEMP_NAME.match(basename)
+        if match:
+            basename = match['name']
+        return path.join(dirname, basename) or None
+
+    def feed(self, line: str, channel: int = 0):
+        """ give a line of rsync errors output """
+        line = line.strip()
+        if not line or _SUMMARY.match(line):
+            return
+        match = _QUOTED_PATH.search(line)
+        with self._lock:
+            relative_path = self._relative(match['path']) if match else None
+            if relative_path is None:
+                if line.startswith('rsync'):
+                    self.full = True
+            elif _VANISHED.match(line):
+                self.vanished.add(relative_path)
+            else:
+                self.paths.add(relative_path)
+
+    def close(self, code: int):
+        pass
+
+    @property
+    def retry_paths(self) -> List[str]:
+        return sorted(self.paths - self.vanished)
+
+
+def with_files_from(rsync_cmd: List[str], files_from: str) -> List[str]:
+    """ restrict rsync command to a NUL separated list of paths (replacing previous list, if any) """
+    options = [o for o in rsync_cmd[1:-2] if not o.startswith('--files-from=')]
+    options += [f'--files-from={files_from}', '--from0']
+    options = list(dict.fromkeys(options))
+    return rsync_cmd[:1] + options + rsync_cmd[-2:]
@@ -0,0 +1,124 @@
+import socket
+import tempfile
+import time
+from shlex import quote
+from subprocess import Popen, DEVNULL, PIPE, TimeoutExpired
+from typing import List, Optional
+
+
+def read_secret(password_filepath: str) -> str:
+    """ password of a --password-file (its first line) """
+    with open(password_filepath) as password_file:
+        return password_file.readline().rstrip('\r\n')
+
+
+def daemon_config(module: str, module_dirpath: str, username: str, read_only: bool = False) -> str:
+    """
+    module section of the rsyncd.conf of a temporary daemon, run as the user that starts it
+    (no chroot, symlinks kept as is). It only serves the remote endpoint directory, to an authenticated user.
+    Address, allowed host, ids and secrets file are appended by daemon_script, as they are only known on the daemon host.
+    """
+    lines = [f'[{module}]',
+             f'    path = {module_dirpath}',
+             f'    read only = {"yes" if read_only else "no"}',
+             '    munge symlinks = no',
+             f'    auth users = {username}']
+    return ''.join(line + '\n' for line in lines)
+
+
+def daemon_script(rsync_path: str, config: str, port: int, username: str, remote: bool) -> str:
+    """
+    shell script that runs rsync --daemon until its stdin is closed, then removes its config.
+    The same script is run locally (sh -c) or on the server (as the ssh remote command).
+    The secret is the first line of stdin (never in a command line), written to a private secrets file.
+    The daemon only listens on the interface the client reaches (remote: from $SSH_CONNECTION, local: loopback),
+    and only accepts that client.
+    """
+    if remote:
+        # $SSH_CONNECTION: client address, client port, server address, server port
+        addresses = 'set -- $SSH_CONNECTION && c=$1 && a=$3 && [ -n "$a" ]'
+    else:
+        addresses = 'c=127.0.0.1 && a=127.0.0.1'
+    write_config = ('printf "use chroot = no\\naddress = %s\\n" "$a"; '
+                    f'printf %s {quote(config)}; '
+                    'printf "    hosts allow = %s\\n    hosts deny = *\\n    uid = %s\\n    gid = %s\\n'
+                    '    secrets file = %s/secrets\\n" "$c" "$(id -u)" "$(id -g)" "$d"')
+    script = (f'd=$(mktemp -d) && IFS= read -r s && {addresses}'
+              f' && {{ {write_config}; }} > "$d/rsyncd.conf"'
+              f' && (umask 077 && printf "%s:%s\\n" {quote(username)} "$s" > "$d/secrets") && unset s'
+              f' || {{ rm -rf "$d"; exit 1; }}; '
+              f'{quote(rsync_path)} --daemon --no-detach --port={int(port)} --config="$d/rsyncd.conf" & p=$!;'
+              f' cat > /dev/null; kill $p; wait $p; rm -rf "$d"')
+    return script
+
+
+def is_listening(host: str, port: int, timeout: float = 1.) -> bool:
+    try:
+        with socket.create_connection((host, port), timeout=timeout):
+            return True
+    except OSError:
+        return False
+
+
+class RsyncDaemon:
+    """
+    temporary rsync daemon, started on enter (locally, or on the server through ssh) and stopped on exit.
+    Ready when its port accepts connections.
+    """
+    def __init__(self, cmd: List[str], host: str, port: int, secret: str, timeout: float = 30.):
+        self._cmd = cmd
+        self._secret = secret
+        self._host = host
+        self._port = port
+        self._timeout = timeout
+        self._process = None
+        self.error = None
+
+    def __enter__(self):
+        if is_listening(self._host, self._port):
+            self.error = f'port {self._port} already in use on {self._host}'
+            return self
+        self._errors_file = tempfile.TemporaryFile()  # not a pipe: nobody reads it while the daemon runs
+        try:
+            self._process = Popen(self._cmd, stdin=PIPE, stdout=DEVNULL, stderr=self._errors_file)
+            self._process.stdin.write(self._secret.encode() + b'\n')  # see daemon_script
+            self._process.stdin.flush()
+        except OSError as e:
+            self.error = str(e)
+            self._errors_file.close()
+            if self._process is not None:
+                self._process.kill()
+                self._process.wait()
+                self._process = None
+            return self
+        deadline = time.monotonic() + self._timeout
+        while time.monotonic() < deadline:
+            if self._process.poll() is not None:
+                self._errors_file.seek(0)
+                self.error = self._errors_file.read().decode(errors='replace').strip() or 'daemon exited'
+                self._errors_file.close()
+                self._process.stdin.close()
+                self._process = None
+                break
+            if is_listening(self._host, self._port):
+                break
+            time.sleep(.1)
+        else:
+            self.error = 'timeout'
+        return self
+
+    @property
+    def running(self) -> bool:
+        return self._process is not None and self.error is None
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        if self._process is None:
+            return
+        self._process.stdin.close()  # script stops the daemon and removes its config
+        try:
+            self._process.wait(timeout=self._timeout)
+        except TimeoutExpired:
+            self._process.kill()
+            self._process.wait()
+        self._errors_file.close()
+        self._process = None
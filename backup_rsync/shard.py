@@ -0,0 +1,97 @@
+import os
+from typing import List, Tuple
+
+
+def _tree_size(dirpath: str) -> int:
+    """ estimate the byte count of a tree, without following symlinks nor crossing filesystems """
+    total = 0
+    device = os.lstat(dirpath).st_dev
+    stack = [dirpath]
+    while stack:
+        try:
+            with os.scandir(stack.pop()) as it:
+                for entry in it:
+                    try:
+                        stat = entry.stat(follow_symlinks=False)
+                    except OSError:
+                        continue
+                    if entry.is_dir(follow_symlinks=False):
+                        if stat.st_dev == device:
+                            stack.append(entry.path)
+                    else:
+                        total += stat.st_size
+        except OSError:
+            continue
+    return total
+
+
+def scan_top_level(dirpath: str, balance: str = 'directory') -> List[Tuple[str, int]]:
+    """
+    list the top-level entries of the source directory, with their weight:
+        - directory: every entry weights 1
+        - size: every entry weights its estimated byte count
+    """
+    entries = []
+    with os.scandir(dirpath) as it:
+        for entry in it:
+            weight = 1
+            if balance == 'size':
+                if entry.is_dir(follow_symlinks=False):
+                    weight = _tree_size(entry.path)
+                else:
+                    weight = entry.stat(follow_symlinks=False).st_size
+            entries.append((entry.name, weight))
+    return sorted(entries)
+
+
+def split_shards(entries: List[Tuple[str, int]], count: int) -> List[List[str]]:
+    """
+    balance weighted entries into (at most) count shards, heaviest first into the lightest shard.
+    Names with a newline always go to the first shard (see shard_filter_rules).
+    """
+    shards = [[] for _ in range(count)]
+    loads = [0] * count
+    for name, weight in sorted(entries, key=lambda e: (-e[1], e[0])):
+        lightest = 0 if '\n' in name else loads.index(min(loads))
+        shards[lightest].append(name)
+        loads[lightest] += weight
+    return [sorted(s) for s in shards if s]
+
+
+def escape_pattern(name: str) -> str:
+    """ escape wildcards, so the rsync filter rule matches the name literally """
+    for c in '\\*?[':
+        name = name.replace(c, '\\' + c)
+    return name
+
+
+def shard_filter_rules(shards: List[List[str]], index: int) -> Tuple[List[str], List[str]]:
+    """
+    filter rules restricting a transfer to the top-level entries of shard index, as (first rules, last rules):
+    first rules come before any other filter rule (e.g. includes of exclude patterns), last rules after them.
+        - entries of other shards are hidden on the sender side and protected on the receiver side (first rules),
+          so --delete (and --backup-dir) only act on the entries owned by that shard,
+        - the first shard also owns the top-level entries unknown when shards were split: created since,
+          or only existing on the destination (to be deleted),
+        - the other shards show and risk their own entries, then hide and protect any other one (last rules).
+    A filter rule cannot contain a newline: names with newlines are always in the first shard (see split_shards),
+    and only hidden by the final rules of the others.
+    """
+    first_rules = []
+    for other_index, other in enumerate(shards):
+        if other_index == index:
+            continue
+        for name in other:
+            if '\n' in name:
+                continue
+            pattern = '/' + escape_pattern(name)
+            first_rules.append(f'hide {pattern}')
+            first_rules.append(f'protect {pattern}')
+    last_rules = []
+    if index > 0:
+        for name in shards[index]:
+            pattern = '/' + escape_pattern(name)
+            last_rules.append(f'show {pattern}')
+            last_rules.append(f'risk {pattern}')
+        last_rules += ['hide /*', 'protect /*']
+    return first_rules, last_rules
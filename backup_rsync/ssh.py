@@ -0,0 +1,67 @@
+import os.path as path
+import time
+from subprocess import Popen, DEVNULL, PIPE, TimeoutExpired, run
+from typing import List
+
+
+class SshMaster:
+    """
+    ssh master connection (ControlMaster), shared by all the ssh clients using the same control_path.
+    The connection is opened on enter, and closed on exit.
+    If the master cannot be established, clients just fall back to their own connection.
+    """
+    def __init__(self, ssh_cmd: List[str], host: str, control_path: str, timeout: float = 30.):
+        self._ssh_cmd = ssh_cmd
+        self._host = host
+        self._control_path = control_path
+        self._timeout = timeout
+        self._process = None
+        self.error = None
+
+    def _control(self, command: str) -> bool:
+        result = run([self._ssh_cmd[0], '-o', f'ControlPath={self._control_path}', '-O', command, self._host],
+                     stdin=DEVNULL, stdout=DEVNULL, stderr=DEVNULL)
+        return result.returncode == 0
+
+    def __enter__(self):
+        master_cmd = self._ssh_cmd + [
+            '-M', '-N',
+            '-o', f'ControlPath={self._control_path}',
+            '-o', 'ControlPersist=no',
+            '-o', 'BatchMode=yes',
+            self._host
+        ]
+        try:
+            self._process = Popen(master_cmd, stdin=DEVNULL, stdout=DEVNULL, stderr=PIPE)
+        except OSError as e:
+            self.error = str(e)
+            return self
+        deadline = time.monotonic() + self._timeout
+        while time.monotonic() < deadline:
+            if self._process.poll() is not None:
+                self.error = self._process.stderr.read().decode(errors='replace').strip()
+                self._process = None
+                break
+            if path.exists(self._control_path) and self._control('check'):
+                break
+            time.sleep(.1)
+        else:
+            self.error = 'timeout'
+        return self
+
+    @property
+    def connected(self) -> bool:
+        return self._process is not None and self.error is None
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        if self._process is None:
+            return
+        if not self._control('exit'):
+            self._process.terminate()
+        try:
+            self._process.wait(timeout=self._timeout)
+        except TimeoutExpired:
+            self._process.kill()
+            self._process.wait()
+        self._process.stderr.close()
+        self._process = None
@@ -0,0 +1,143 @@
+import os
+import json
+import threading
+import time
+from typing import Dict, Optional
+from backup_rsync.progress import write_atomic
+from backup_rsync.throttle import descendants
+
+_CLOCK_TICKS = os.sysconf('SC_CLK_TCK') if hasattr(os, 'sysconf') else 100
+MAX_SAMPLES = 10000  # beyond, samples are decimated and the interval doubled
+
+
+def read_process(pid: int) -> Optional[Dict]:
+    """ cpu time (s), io bytes and memory (bytes) of a process, from /proc/<pid>/{stat,io,status}, None if gone """
+    sample = {}
+    try:
+        with open(f'/proc/{pid}/stat') as stat_file:
+            # utime and stime are the 12th and 13th fields after the command name (in parentheses)
+            fields = stat_file.read().rsplit(')', 1)[1].split()
+        sample['cpu'] = (int(fields[11]) + int(fields[12])) / _CLOCK_TICKS
+        with open(f'/proc/{pid}/status') as status_file:
+            for line in status_file:
+                if line.startswith(('VmRSS:', 'VmHWM:')):
+                    key = 'rss' if line.startswith('VmRSS') else 'peak_rss'
+                    sample[key] = int(line.split()[1]) * 1024
+    except (OSError, IndexError, ValueError):
+        return None
+    try:
+        with open(f'/proc/{pid}/io') as io_file:
+            for line in io_file:
+                key, value = line.split(':')
+                if key in ('read_bytes', 'write_bytes'):
+                    sample[key] = int(value)
+    except (OSError, ValueError):
+        pass  # not readable (e.g. other user, or kernel without task io accounting)
+    return sample
+
+
+class Telemetry:
+    """
+    samples the resources of running rsync processes and their children (e.g. rsync receiver, ssh),
+    as a time series of cpu %, read and written bytes, rss and peak rss.
+    Resources of exited processes are completed with their rusage (see add_usage).
+    """
+    def __init__(self, interval: float = 1.):
+        self.interval = interval
+        self.samples = []
+        self.usage = dict(runs=0, cpu_user=0., cpu_system=0., peak_rss=0, blocks_read=0, blocks_written=0)
+        self._roots = set()
+        self._processes = {}  # pid -> last sample, exited processes included (counters are cumulative)
+        self._last = None  # (time, total cpu)
+        self._start = time.monotonic()
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._loop, name='telemetry', daemon=True)
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self._stop.set()
+        self._thread.join()
+
+    def attach(self, pid: int):
+        with self._lock:
+            self._roots.add(pid)
+        self.sample()
+
+    def detach(self, pid: int):
+        self.sample()
+        with self._lock:
+            self._roots.discard(pid)
+
+    def add_usage(self, usage):
+        """ add the resource usage of an exited rsync (and its waited children), from os.wait4 """
+        with self._lock:
+            self.usage['runs'] += 1
+            self.usage['cpu_user'] += usage.ru_utime
+            self.usage['cpu_system'] += usage.ru_stime
+            self.usage['peak_rss'] = max(self.usage['peak_rss'], usage.ru_maxrss * 1024)  # linux: kB
+            self.usage['blocks_read'] += usage.ru_inblock
+            self.usage['blocks_written'] += usage.ru_oublock
+
+    def sample(self):
+        with self._lock:
+            pids = set()
+            for root in self._roots:
+                pids.update([root] + descendants(root))
+            now = time.monotonic()
+            rss = 0
+            for pid in pids:
+                process = read_process(pid)
+                if process is not None:
+                    self._processes[pid] = process
+                    rss += process.get('rss', 0)
+            totals = {key: sum(p.get(key, 0) for p in self._processes.values())
+                      for key in ('cpu', 'read_bytes', 'write_bytes')}
+            cpu_percent = 0.
+            if self._last is not None and now > self._last[0]:
+                cpu_percent = 100. * (totals['cpu'] - self._last[1]) / (now - self._last[0])
+            self._last = (now, totals['cpu'])
+            self.samples.append(dict(
+                time=round(now - self._start, 3), processes=len(pids), cpu_percent=round(cpu_percent, 1),
+                read_bytes=totals['read_bytes'], write_bytes=totals['write_bytes'], rss=rss,
+                peak_rss=max((p.get('peak_rss', 0) for p in self._processes.values()), default=0)))
+            if len(self.samples) > MAX_SAMPLES:
+                self.samples = self.samples[::2]
+                self.interval *= 2
+
+    def _loop(self):
+        while not self._stop.wait(self.interval):
+            if self._roots:
+                self.sample()
+
+    def summary(self) -> Dict:
+        with self._lock:
+            samples = list(self.samples)
+            usage = dict(self.usage)
+        summary = dict(
+            duration=round(time.monotonic() - self._start, 3),
+            cpu_user=round(usage['cpu_user'], 3),
+            cpu_system=round(usage['cpu_system'], 3),
+            max_cpu_percent=max((s['cpu_percent'] for s in samples), default=0.),
+            max_rss=max((s['rss'] for s in samples), default=0),
+            peak_rss=max([usage['peak_rss']] + [s['peak_rss'] for s in samples]),
+            read_bytes=samples[-1]['read_bytes'] if samples else 0,
+            write_bytes=samples[-1]['write_bytes'] if samples else 0,
+            blocks_read=usage['blocks_read'],
+            blocks_written=usage['blocks_written'],
+            runs=usage['runs'])
+        return summary
+
+    def format_summary(self) -> str:
+        summary = self.summary()
+        return (f'telemetry: cpu {summary["cpu_user"]:.1f}s user {summary["cpu_system"]:.1f}s system '
+                f'(max {summary["max_cpu_percent"]:.0f}%), peak rss {summary["peak_rss"] >> 20} MiB, '
+                f'read {summary["read_bytes"] >> 20} MiB, written {summary["write_bytes"] >> 20} MiB.')
+
+    def write(self, filepath: str):
+        """ summary and time series, as json """
+        os.makedirs(os.path.dirname(filepath) or '.', exist_ok=True)
+        write_atomic(filepath, json.dumps(dict(summary=self.summary(), samples=self.samples), indent=1))
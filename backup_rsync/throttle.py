@@ -0,0 +1,220 @@
+import os
+import signal
+import threading
+import time
+from datetime import datetime, time as daytime
+from subprocess import run, DEVNULL
+from typing import Dict, List, Optional
+
+IONICE_CLASSES = {'realtime': 1, 'best-effort': 2, 'idle': 3}
+
+
+def _parse_time(value: str) -> daytime:
+    hours, minutes = value.split(':')
+    return daytime(int(hours), int(minutes))
+
+
+def active_window(windows: List, now: datetime):
+    """ first window (with start and end 'HH:MM' attributes, possibly over midnight, whole day if equal) containing now, if any """
+    current = now.time()
+    for window in windows:
+        start, end = _parse_time(window.start), _parse_time(window.end)
+        if start == end:
+            return window  # whole day
+        if start < end:
+            if start <= current < end:
+                return window
+        elif current >= start or current < end:
+            return window
+    return None
+
+
+def effective_policy(schedule, now: datetime) -> Dict:
+    """ schedule settings, overridden by the active window (if any) """
+    policy = {key: getattr(schedule, key) for key in ('bwlimit', 'nice', 'ionice', 'ionice_level')}
+    policy['pause'] = False
+    window = active_window(schedule.windows, now)
+    if window is not None:
+        for key in policy:
+            value = getattr(window, key)
+            if value is not None:
+                policy[key] = value
+    return policy
+
+
+def descendants(pid: int) -> List[int]:
+    """ all the descendant processes of pid (e.g. rsync receiver, ssh helper) """
+    children = {}
+    for entry in os.listdir('/proc'):
+        if not entry.isdigit():
+            continue
+        try:
+            with open(f'/proc/{entry}/stat') as stat_file:
+                stat = stat_file.read()
+        except OSError:
+            continue
+        # ppid is the 2nd field after the command name (in parentheses)
+        ppid = int(stat.rsplit(')', 1)[1].split()[1])
+        children.setdefault(ppid, []).append(int(entry))
+    found, stack = [], [pid]
+    while stack:
+        for child in children.get(stack.pop(), []):
+            found.append(child)
+            stack.append(child)
+    return found
+
+
+def set_priority(pids: List[int], nice: Optional[int], ionice: Optional[str], ionice_level: Optional[int]) -> List[str]:
+    """
+    apply cpu and io priorities to processes (using ionice from util-linux), returns the errors
+    (e.g. only root can lower nice values)
+    """
+    errors = []
+    for pid in pids:
+        if nice is not None:
+            try:
+                os.setpriority(os.PRIO_PROCESS, pid, nice)
+            except OSError as e:
+                errors.append(f'cannot set nice {nice}: {e.strerror}')
+    if ionice is not None and pids:
+        ionice_cmd = ['ionice', '-c', str(IONICE_CLASSES[ionice])]
+        if ionice_level is not None and ionice != 'idle':
+            ionice_cmd += ['-n', str(ionice_level)]
+        try:
+            if run(ionice_cmd + ['-p'] + [str(pid) for pid in pids],
+                   stdin=DEVNULL, stdout=DEVNULL, stderr=DEVNULL).returncode != 0:
+                errors.append(f'cannot set ionice {ionice}')
+        except OSError as e:
+            errors.append(f'cannot set ionice {ionice}: {e.strerror}')
+    return errors
+
+
+def command_name(pid: int) -> Optional[str]:
+    try:
+        with open(f'/proc/{pid}/comm') as comm_file:
+            return comm_file.read().rstrip('\n')
+    except OSError:
+        return None
+
+
+class DiskBusy:
+    """ ratio of time the block device was busy, since last call (from /proc/diskstats) """
+    def __init__(self, device: str):
+        self._device = device
+        self._last = None
+
+    def _io_ticks(self) -> Optional[int]:
+        with open('/proc/diskstats') as diskstats:
+            for line in diskstats:
+                fields = line.split()
+                if fields[2] == self._device:
+                    return int(fields[12])  # milliseconds spent doing I/Os
+        return None
+
+    def __call__(self) -> float:
+        now, ticks = time.monotonic(), self._io_ticks()
+        last, self._last = self._last, (now, ticks)
+        if ticks is None or last is None or last[1] is None or now <= last[0]:
+            return 0.
+        return (ticks - last[1]) / 1000. / (now - last[0])
+
+
+class Throttler:
+    """
+    applies the schedule (priorities, time windows, adaptive pauses) to running rsync processes and their children.
+    Adaptive throttling pauses processes (SIGSTOP) while load average or disk busy ratio are above the limits.
+    Only local rsync processes are paused, not their transport (ssh keeps the connection alive),
+    and never longer than max_pause seconds in a row (e.g. within the rsync I/O timeout).
+    Priorities that cannot be applied are reported to errors (once each).
+    """
+    def __init__(self, schedule, max_pause: Optional[float] = None, errors=None):
+        self._schedule = schedule
+        self._max_pause = max_pause
+        self._errors = errors
+        self._reported = set()
+        self._disk_busy = DiskBusy(schedule.disk) if schedule.disk else None
+        self._processes = {}  # pid -> (applied pids, applied policy)
+        self._paused = False
+        self._paused_since = None
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._loop, daemon=True)
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self._stop.set()
+        self._thread.join()
+
+    def attach(self, pid: int):
+        with self._lock:
+            self._processes[pid] = (set(), None)
+        self._apply(check_pause=True)
+
+    def detach(self, pid: int):
+        with self._lock:
+            self._processes.pop(pid, None)
+
+    def _should_pause(self, policy: Dict) -> bool:
+        if policy['pause']:
+            return True
+        if self._schedule.max_load is not None and os.getloadavg()[0] > self._schedule.max_load:
+            return True
+        if self._disk_busy is not None and self._schedule.max_busy is not None:
+            return self._disk_busy() > self._schedule.max_busy
+        return False
+
+    def _signal(self, pids, signum):
+        for pid in pids:
+            try:
+                os.kill(pid, signum)
+            except OSError:
+                pass
+
+    def _pause(self, pids, paused: bool):
+        """ stop (or continue) the rsync processes among pids (see _processes) """
+        if paused:
+            names = {command_name(pid) for pid in self._processes}
+            pids = [pid for pid in pids if pid in self._processes or command_name(pid) in names]
+        self._signal(pids, signal.SIGSTOP if paused else signal.SIGCONT)
+
+    def _set_priority(self, pids, policy: Dict):
+        for error in set_priority(pids, policy['nice'], policy['ionice'], policy['ionice_level']):
+            if self._errors is not None and error not in self._reported:
+                self._reported.add(error)
+                self._errors.write(f'throttle: {error}.\n')
+
+    def _apply(self, check_pause: bool = False):
+        policy = effective_policy(self._schedule, datetime.now())
+        with self._lock:
+            for pid, (applied_pids, applied_policy) in list(self._processes.items()):
+                pids = set([pid] + descendants(pid))
+                if policy != applied_policy:
+                    self._set_priority(sorted(pids), policy)
+                elif pids - applied_pids:
+                    self._set_priority(sorted(pids - applied_pids), policy)
+                self._processes[pid] = (pids, policy)
+                if self._paused:
+                    self._pause(pids - applied_pids, True)
+            if not check_pause:
+                return
+            paused = self._should_pause(policy)
+            if (paused and self._paused and self._max_pause is not None
+                    and time.monotonic() - self._paused_since >= self._max_pause):
+                paused = False  # resumed for an interval, before the other side times out
+            if paused != self._paused:
+                self._paused = paused
+                self._paused_since = time.monotonic() if paused else None
+                for pids, _ in self._processes.values():
+                    self._pause(pids, paused)
+
+    def _loop(self):
+        while not self._stop.wait(self._schedule.interval):
+            self._apply(check_pause=True)
+        # never leave processes stopped
+        with self._lock:
+            self._paused = False
+            for pids, _ in self._processes.values():
+                self._signal(pids, signal.SIGCONT)
@@ -0,0 +1,152 @@
+import os
+import os.path as path
+import json
+import hashlib
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import dataclass, field
+from typing import Dict, List, Optional, Set, Tuple
+from backup_rsync.manifest import hash_file
+from backup_rsync.plan import scan_trees
+from backup_rsync.progress import write_atomic
+
+
+@dataclass
+class VerifyResult:
+    checked: int = 0  # files hashed and compared
+    bytes: int = 0  # bytes hashed on each side
+    skipped: int = 0  # files modified since transfer (size or time differ)
+    mismatched: List[str] = field(default_factory=list)  # content differs
+    missing: List[str] = field(default_factory=list)  # missing on destination
+    errors: List[str] = field(default_factory=list)  # could not be read
+
+    @property
+    def ok(self) -> bool:
+        return not (self.mismatched or self.missing or self.errors)
+
+    def as_dict(self) -> Dict:
+        return dict(ok=self.ok, checked=self.checked, bytes=self.bytes, skipped=self.skipped,
+                    mismatched=sorted(self.mismatched), missing=sorted(self.missing), errors=sorted(self.errors))
+
+
+def in_sample(relative_path: str, sample: float, rotation: int) -> bool:
+    """
+    whether the file is part of the sample: files are spread over round(1 / sample) buckets (by path hash),
+    and rotation selects the bucket (e.g. the day), so that all files get verified after as many rotations.
+    """
+    if sample >= 1.:
+        return True
+    buckets = max(1, round(1. / sample))
+    digest = hashlib.blake2b(os.fsencode(relative_path), digest_size=8).digest()
+    return int.from_bytes(digest, 'big') % buckets == rotation % buckets
+
+
+def _hash_or_error(filepath: str) -> Tuple[Optional[str], Optional[str]]:
+    try:
+        return hash_file(filepath), None
+    except OSError as e:
+        return None, str(e)
+
+
+def _hash_all(filepaths: List[str], workers: Optional[int]) -> List[Tuple[Optional[str], Optional[str]]]:
+    """ hash files in a pool of processes (by chunks, memory is bounded whatever the file size) """
+    if not filepaths:
+        return []
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        return list(pool.map(_hash_or_error, filepaths, chunksize=16))
+
+
+def _is_below(relative_path: str, dirpaths: Set[str]) -> bool:
+    """ whether the path or one of its parents is in dirpaths """
+    while relative_path:
+        if relative_path in dirpaths:
+            return True
+        relative_path = path.dirname(relative_path)
+    return False
+
+
+def verify_trees(source_dirpath: str, destination_dirpath: str, excludes: List[str], sample: float = 1.,
+                 rotation: int = 0, workers: Optional[int] = None,
+                 skipped: Optional[Set[str]] = None) -> Tuple[VerifyResult, Dict[str, List]]:
+    """
+    hash the (sampled) files of source and destination and compare them.
+    skipped are source files and directories not transferred (e.g. by size or ignore files, see skipped_paths).
+    Returns the result, and the manifest of verified destination files {path: [size, mtime, hash]}.
+    """
+    source, destination = scan_trees([source_dirpath, destination_dirpath], excludes=[excludes, []],
+                                     workers=workers or 16)
+    result = VerifyResult()
+    pairs = []
+    for relative_path, entry in sorted(source.items()):
+        if entry.is_dir or not in_sample(relative_path, sample, rotation):
+            continue
+        if skipped and _is_below(relative_path, skipped):
+            continue
+        copy = destination.get(relative_path)
+        if copy is None:
+            result.missing.append(relative_path)
+        elif (copy.size, copy.mtime) != (entry.size, entry.mtime):
+            result.skipped += 1  # source changed since transfer
+        else:
+            pairs.append((relative_path, entry))
+    filepaths = [path.join(root, p) for p, _ in pairs for root in (source_dirpath, destination_dirpath)]
+    hashes = _hash_all(filepaths, workers)
+    manifest = {}
+    for index, (relative_path, entry) in enumerate(pairs):
+        (source_hash, source_error), (destination_hash, destination_error) = hashes[2 * index: 2 * index + 2]
+        if source_error or destination_error:
+            result.errors.append(f'{relative_path}: {source_error or destination_error}')
+            continue
+        result.checked += 1
+        result.bytes += entry.size
+        if source_hash != destination_hash:
+            result.mismatched.append(relative_path)
+        else:
+            manifest[relative_path] = [entry.size, entry.mtime, destination_hash]
+    return result, manifest
+
+
+def verify_manifest(destination_dirpath: str, manifest: Dict[str, List], sample: float = 1.,
+                    rotation: int = 0, workers: Optional[int] = None) -> VerifyResult:
+    """ hash the (sampled) destination files, and compare them against a previous manifest """
+    result = VerifyResult()
+    pairs = []
+    for relative_path, (size, mtime, expected_hash) in sorted(manifest.items()):
+        if not in_sample(relative_path, sample, rotation):
+            continue
+        filepath = path.join(destination_dirpath, relative_path)
+        try:
+            stat = os.lstat(filepath)
+        except OSError:
+            result.missing.append(relative_path)
+            continue
+        if (stat.st_size, int(stat.st_mtime)) != (size, mtime):
+            result.skipped += 1  # updated since the manifest
+            continue
+        pairs.append((relative_path, size, expected_hash))
+    hashes = _hash_all([path.join(destination_dirpath, p) for p, _, _ in pairs], workers)
+    for (relative_path, size, expected_hash), (content_hash, error) in zip(pairs, hashes):
+        if error:
+            result.errors.append(f'{relative_path}: {error}')
+            continue
+        result.checked += 1
+        result.bytes += size
+        if content_hash != expected_hash:
+            result.mismatched.append(relative_path)
+    return result
+
+
+def write_manifest(filepath: str, manifest: Dict[str, List]):
+    write_atomic(filepath, json.dumps(manifest, sort_keys=True))
+
+
+def read_manifest(filepath: str) -> Dict[str, List]:
+    with open(filepath) as manifest_file:
+        return json.load(manifest_file)
+
+
+def format_verify(result: VerifyResult) -> str:
+    text = (f'{result.checked} files verified ({result.bytes} bytes), {result.skipped} modified since transfer: '
+            f'{len(result.mismatched)} mismatched, {len(result.missing)} missing, {len(result.errors)} errors.')
+    for name, paths in [('mismatched', result.mismatched), ('missing', result.missing), ('error', result.errors)]:
+        text += ''.join(f'\n{name}: {p}' for p in sorted(paths))
+    return text
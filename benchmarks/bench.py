@@ -0,0 +1,149 @@
+"""
+benchmark of backup configurations on synthetic trees.
+
+    python -m benchmarks.bench run --variants benchmarks/variants.yaml --output results.json
+    python -m benchmarks.bench compare --before before.json --after after.json
+"""
+import os
+import os.path as path
+import sys
+import json
+import stat
+import subprocess
+import tempfile
+import time
+from typing import Dict, List, Optional
+import yaml
+from jsonargparse import CLI
+from backup_rsync.capabilities import probe_rsync
+from benchmarks.tree import TreeSpec, ChurnSpec, generate_tree, apply_churn
+
+_REPO_DIRPATH = path.dirname(path.dirname(path.abspath(__file__)))
+# ssh stand-in: runs the remote command locally, so that remote transfers go through the rsync protocol
+# without a sshd (options are skipped, host is the first argument not starting with -)
+_FAKE_SSH = '''#!/bin/sh
+while [ $# -gt 0 ]; do
+  case "$1" in
+    -p|-i|-c|-o|-l) shift 2;;
+    -*) shift;;
+    *) shift; break;;
+  esac
+done
+exec sh -c "$*"
+'''
+
+
+def _git_commit() -> Optional[str]:
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=path.dirname(__file__), capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def _variant_config(variant: Dict, source_dirpath: str, work_dirpath: str) -> Dict:
+    """ backup config of a variant: paths are set in the work directory, remote goes through the ssh stand-in """
+    config = dict(variant.get('config', {}))
+    destination = dict(config.pop('destination', {}))
+    destination['path'] = path.join(work_dirpath, destination.get('path', 'latest'))
+    for key in ['history', 'partial']:
+        if key in destination:
+            destination[key] = path.join(work_dirpath, destination[key])
+    config['source'] = {'path': source_dirpath}
+    config['destination'] = destination
+    if variant.get('transport') == 'ssh':
+        ssh_filepath = path.join(work_dirpath, 'ssh')
+        with open(ssh_filepath, 'w') as ssh_file:
+            ssh_file.write(_FAKE_SSH)
+        os.chmod(ssh_filepath, os.stat(ssh_filepath).st_mode | stat.S_IEXEC)
+        destination['remote'] = True
+        config['server'] = {'url': 'localhost', 'sshpath': ssh_filepath, **config.get('server', {})}
+    return config
+
+
+def measure(config_filepath: str) -> Dict:
+    """ run backup_cli save in a child process, and measure its resources (including rsync and ssh) """
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join(filter(None, [_REPO_DIRPATH, os.environ.get('PYTHONPATH')])))
+    with tempfile.TemporaryFile() as errors_file:
+        start = time.monotonic()
+        process = subprocess.Popen([sys.executable, '-c', 'from backup_rsync.backup import main_cli; main_cli()',
+                                    '--config', config_filepath, 'save'],
+                                   stdout=subprocess.DEVNULL, stderr=errors_file, env=env)
+        # wait4 gives the resources of that child and of its own waited children (rsync, ssh)
+        _, status, usage = os.wait4(process.pid, 0)
+        wall = time.monotonic() - start
+        process.returncode = os.waitstatus_to_exitcode(status)
+        errors_file.seek(0)
+        errors = errors_file.read().decode(errors='replace')
+    return dict(wall=round(wall, 3),
+                cpu_user=round(usage.ru_utime, 3),
+                cpu_system=round(usage.ru_stime, 3),
+                peak_rss=usage.ru_maxrss * 1024,  # linux: kB
+                bytes_read=usage.ru_inblock * 512,  # from disk, not from page cache
+                bytes_written=usage.ru_oublock * 512,
+                code=process.returncode,
+                errors=errors[-2000:] if process.returncode else '')
+
+
+def run_variant(variant: Dict, tree: TreeSpec, churn: ChurnSpec, runs: int = 1) -> Dict:
+    """ initial backup of a fresh tree, then incremental backups after churn """
+    with tempfile.TemporaryDirectory(prefix='backup_rsync-bench-') as work_dirpath:
+        source_dirpath = path.join(work_dirpath, 'source')
+        generate_tree(source_dirpath, tree)
+        config_filepath = path.join(work_dirpath, 'config.yaml')
+        with open(config_filepath, 'w') as config_file:
+            yaml.safe_dump(_variant_config(variant, source_dirpath, work_dirpath), config_file)
+        result = dict(initial=measure(config_filepath), incremental=[])
+        for run in range(runs):
+            apply_churn(source_dirpath, tree, ChurnSpec(**{**churn.as_dict(), 'seed': churn.seed + run}))
+            result['incremental'].append(measure(config_filepath))
+    return result
+
+
+def run(variants: str, output: Optional[str] = None, tree: Optional[TreeSpec] = None,
+        churn: Optional[ChurnSpec] = None, runs: int = 1, only: Optional[List[str]] = None):
+    """
+    run every variant (yaml list of {name, config, transport}) on the same synthetic tree,
+    and write the measures as json (to compare across commits).
+    """
+    tree = tree or TreeSpec()
+    churn = churn or ChurnSpec()
+    with open(variants) as variants_file:
+        variant_list = yaml.safe_load(variants_file)
+    capabilities = probe_rsync()
+    results = dict(commit=_git_commit(), python=sys.version.split()[0],
+                   rsync='.'.join(map(str, capabilities.version)) if capabilities else None,
+                   tree=tree.as_dict(), churn=churn.as_dict(), variants={})
+    for variant in variant_list:
+        if only and variant['name'] not in only:
+            continue
+        print(f'{variant["name"]} ...', file=sys.stderr, flush=True)
+        results['variants'][variant['name']] = run_variant(variant, tree, churn, runs=runs)
+    text = json.dumps(results, indent=2)
+    if output is None:
+        print(text)
+    else:
+        with open(output, 'w') as output_file:
+            output_file.write(text + '\n')
+
+
+def compare(before: str, after: str, metric: str = 'wall'):
+    """ print the ratio after / before of a metric, for each variant of both results """
+    with open(before) as before_file, open(after) as after_file:
+        results = [json.load(before_file), json.load(after_file)]
+    print(f'{results[0]["commit"]} -> {results[1]["commit"]} ({metric})')
+    for name, variant in results[1]['variants'].items():
+        previous = results[0]['variants'].get(name)
+        if previous is None:
+            continue
+        for stage in ['initial', 'incremental']:
+            values = []
+            for result in [previous, variant]:
+                measures = result[stage] if isinstance(result[stage], list) else [result[stage]]
+                values.append(sum(m[metric] for m in measures) / max(len(measures), 1))
+            ratio = values[1] / values[0] if values[0] else float('nan')
+            print(f'{name:<24} {stage:<12} {values[0]:>14.3f} {values[1]:>14.3f} {ratio:>8.2f}x')
+
+
+if __name__ == '__main__':
+    CLI([run, compare], as_positional=False)
@@ -0,0 +1,109 @@
+import os
+import os.path as path
+import random
+from dataclasses import dataclass, asdict
+from typing import Dict, List
+
+_CHUNK_SIZE = 1 << 20
+
+
+@dataclass
+class TreeSpec:
+    seed: int = 0
+    tiny_files: int = 10000  # number of small files
+    tiny_size: int = 512  # max size of small files (bytes)
+    huge_files: int = 2  # number of large files
+    huge_size: int = 64 << 20  # size of large files (bytes)
+    depth: int = 6  # directory nesting
+    fanout: int = 8  # sub-directories per directory
+
+    def as_dict(self) -> Dict:
+        return asdict(self)
+
+
+@dataclass
+class ChurnSpec:
+    seed: int = 1
+    modify: float = 0.01  # ratio of small files rewritten
+    touch: float = 0.01  # ratio of small files with only a new modification time
+    create: float = 0.01  # ratio of small files added
+    delete: float = 0.01  # ratio of small files removed
+    append: int = 1 << 20  # bytes appended to each large file
+
+    def as_dict(self) -> Dict:
+        return asdict(self)
+
+
+def _directories(spec: TreeSpec, rng: random.Random) -> List[str]:
+    """ a random tree of relative directory paths, up to spec.depth levels """
+    directories = ['']
+    level = ['']
+    for _ in range(spec.depth):
+        next_level = []
+        for parent in level:
+            for index in range(rng.randint(1, spec.fanout)):
+                next_level.append(path.join(parent, f'd{index}'))
+        # keep the tree bounded: deep levels only expand a few directories
+        level = rng.sample(next_level, min(len(next_level), spec.fanout ** 2))
+        directories += next_level
+    return directories
+
+
+def _write_random(filepath: str, size: int, rng: random.Random, mode: str = 'wb'):
+    with open(filepath, mode) as f:
+        while size > 0:
+            chunk = min(size, _CHUNK_SIZE)
+            f.write(rng.randbytes(chunk))
+            size -= chunk
+
+
+def tiny_paths(spec: TreeSpec) -> List[str]:
+    """ relative paths of the small files of the tree (reproducible from spec) """
+    rng = random.Random(spec.seed)
+    directories = _directories(spec, rng)
+    return [path.join(rng.choice(directories), f'f{index}.dat') for index in range(spec.tiny_files)]
+
+
+def generate_tree(root_dirpath: str, spec: TreeSpec):
+    """ write a reproducible synthetic tree: many small files, deeply nested, and a few large files """
+    rng = random.Random(spec.seed + 1)
+    for rel_path in tiny_paths(spec):
+        filepath = path.join(root_dirpath, rel_path)
+        os.makedirs(path.dirname(filepath), exist_ok=True)
+        _write_random(filepath, rng.randint(0, spec.tiny_size), rng)
+    for index in range(spec.huge_files):
+        filepath = path.join(root_dirpath, 'huge', f'h{index}.bin')
+        os.makedirs(path.dirname(filepath), exist_ok=True)
+        _write_random(filepath, spec.huge_size, rng)
+
+
+def apply_churn(root_dirpath: str, spec: TreeSpec, churn: ChurnSpec) -> Dict[str, int]:
+    """ change the tree as between two runs (reproducible), returns the count of each change """
+    rng = random.Random(churn.seed)
+    existing = [p for p in tiny_paths(spec) if path.exists(path.join(root_dirpath, p))]
+    rng.shuffle(existing)
+    counts = {}
+    cursor = 0
+    for change in ['modify', 'touch', 'delete']:
+        count = int(len(existing) * getattr(churn, change))
+        for rel_path in existing[cursor:cursor + count]:
+            filepath = path.join(root_dirpath, rel_path)
+            if change == 'modify':
+                _write_random(filepath, rng.randint(1, spec.tiny_size), rng)
+            elif change == 'touch':
+                os.utime(filepath)
+            else:
+                os.remove(filepath)
+        counts[change] = count
+        cursor += count
+    directories = sorted({path.dirname(p) for p in existing})
+    counts['create'] = int(spec.tiny_files * churn.create)
+    for index in range(counts['create']):
+        filepath = path.join(root_dirpath, rng.choice(directories), f'n{churn.seed}-{index}.dat')
+        _write_random(filepath, rng.randint(0, spec.tiny_size), rng)
+    counts['append'] = 0
+    if churn.append:
+        for index in range(spec.huge_files):
+            _write_random(path.join(root_dirpath, 'huge', f'h{index}.bin'), churn.append, rng, mode='ab')
+            counts['append'] += 1
+    return counts
@@ -1,11 +1,54 @@
+import asyncio
+import contextlib
+import fnmatch
+import gzip
+import io
+import json
 import os
-import unittest
-from backup_rsync.backup import Backup, Startpoint, Endpoint, Server, Logging, Path_f
+import os.path as path
+import re
+import shutil
+import signal
+import socket
+import subprocess
 import sys
 import tempfile
-import os.path as path
+import threading
+import time
+import unittest
 from datetime import datetime
 
+from backup_rsync.aio import run_async
+from backup_rsync.backup import (Backup, Startpoint, Endpoint, Server, Logging, Sharding, Path_f, Compression, Retry,
+                                 Schedule, Window, Rotation, Dedup, Retention, DeltaClass, Verification, Filters,
+                                 Daemon, Catalog)
+from backup_rsync.capabilities import parse_version_output, probe_rsync
+from backup_rsync.catalog import CatalogIndex, locate
+from backup_rsync.cron import CronExpression
+from backup_rsync.daemon import Scheduler, request
+from backup_rsync.dedup import dedup
+from backup_rsync.delta import delta_passes, parse_size
+from backup_rsync.filters import read_patterns, compile_rules, excluded_report, stale_paths, MAX_STALE_RULES
+from backup_rsync.history import list_timestamped
+from backup_rsync.jobs import JobsConfig, Limits, resources, run_jobs
+from backup_rsync.journal import ChangeJournal, _parse_event
+from backup_rsync.logger import Logger3, read_index, read_run, rotated_segments
+from backup_rsync.manifest import ManifestIndex
+from backup_rsync.plan import Entry, compare_trees, estimate_throughput, is_excluded, scan_trees
+from backup_rsync.progress import ProgressMonitor, parse_progress_line, pump
+from backup_rsync.report import RunReport
+from backup_rsync.retention import select_kept, expired_paths, prune
+from backup_rsync.retry import FailedPaths, with_files_from
+from backup_rsync.rsyncd import RsyncDaemon, daemon_config, daemon_script, is_listening
+from backup_rsync.shard import scan_top_level, split_shards, shard_filter_rules
+from backup_rsync.ssh import SshMaster
+from backup_rsync.telemetry import Telemetry, read_process
+from backup_rsync.throttle import Throttler, active_window, effective_policy, descendants
+from backup_rsync.verify import in_sample, verify_trees, verify_manifest
+
+from benchmarks.bench import run_variant
+from benchmarks.tree import TreeSpec, ChurnSpec, generate_tree, apply_churn
+
 
 class TestCommandFormat(unittest.TestCase):
     def test_minimal(self):
@@ -25,7 +68,6 @@ class TestCommandFormat(unittest.TestCase):
             cmd.remove('--progress')
             cmd.remove('--update')
             cmd.remove('--recursive')
-            cmd.remove('--compress')
             cmd.remove('--checksum')
             cmd.remove('--links')
             cmd.remove('--times')
@@ -185,6 +227,118 @@ class TestCommandFormat(unittest.TestCase):
         cmd = br._create_rsync_command()
         self.assertIn('--rsh=ssh --rsync-path="/rsyncpath"', cmd)
 
+    def test_remote_ciphers(self):
+        br = Backup(
+            source=Startpoint('/source'),
+            destination=Endpoint('/destination', remote=True),
+            server=Server('url', ciphers='aes128-gcm@openssh.com')
+        )
+        cmd = br._create_rsync_command()
+        self.assertIn('--rsh=ssh -c aes128-gcm@openssh.com', cmd)
+
+    def test_remote_multiplex(self):
+        br = Backup(
+            source=Startpoint('/source'),
+            destination=Endpoint('/destination', remote=True),
+            server=Server('url', username='user', multiplex=True)
+        )
+        cmd = br._create_rsync_command()
+        self.assertIn(f'--rsh=ssh -o ControlMaster=no -o ControlPath={br._ssh_control_path}', cmd)
+        self.assertEqual(cmd.pop(), 'user@url:/destination/')
+        # printed command keeps the whole ssh command, and tells the control path does not outlive the run
+        self.assertIn(f"--rsh='ssh -o ControlMaster=no -o ControlPath={br._ssh_control_path}'", str(br))
+        self.assertIn('# ssh ControlPath is the master connection of a run', br.rsync_command_pretty)
+
+    def test_ssh_master_fallback(self):
+        with SshMaster(['/nonexistent/ssh'], 'url', '/nonexistent/ssh.sock') as master:
+            self.assertFalse(master.connected)
+            self.assertIsNotNone(master.error)
+
+    def test_remote_daemon(self):
+        br = Backup(
+            source=Startpoint('/source'),
+            destination=Endpoint('/destination', remote=True),
+            server=Server('url', username='user', timeout=10,
+                          daemon=Daemon(module='backup', port=8730, password_file='/secret'))
+        )
+        cmd = br._create_rsync_command()
+        self.assertIn('--password-file=/secret', cmd)
+        self.assertIn('--contimeout=10', cmd)
+        self.assertFalse(any(o.startswith('--rsh') for o in cmd))
+        self.assertEqual(cmd.pop(), 'rsync://user@url:8730/backup/destination/')
+        with self.assertRaises(ValueError):
+            Backup(source=Startpoint('/source'), destination=Endpoint('/destination', remote=True),
+                   server=Server('url', multiplex=True, daemon=Daemon()))
+        with self.assertRaises(ValueError):
+            Backup(source=Startpoint('/source'), destination=Endpoint('/destination', remote=True),
+                   server=Server('url', daemon=Daemon(spawn='remote', password_file='/secret')))
+        with self.assertRaises(ValueError):
+            Backup(source=Startpoint('/source'), destination=Endpoint('/destination', remote=True),
+                   server=Server('url', username='user', daemon=Daemon(spawn='remote')))
+        with self.assertRaises(ValueError):
+            Backup(source=Startpoint('/source'), destination=Endpoint('/destination', remote=True),
+                   server=Server('url', username='user', daemon=Daemon(spawn='local', password_file='/secret')))
+        with self.assertRaises(ValueError):
+            Backup(source=Startpoint('/source'),
+                   destination=Endpoint('/destination', remote=True, history='/history/%Y'),
+                   server=Server('url', username='user', daemon=Daemon(spawn='remote', password_file='/secret')))
+
+    def test_remote_daemon_spawn(self):
+        br = Backup(
+            source=Startpoint('/source'),
+            destination=Endpoint('/destination', remote=True, history='/destination/.history/%Y/',
+                                 partial='/destination/.partial/'),
+            server=Server('url', username='user',
+                          daemon=Daemon(module='backup', port=8730, password_file='/secret', spawn='remote'))
+        )
+        cmd = br._create_rsync_command()
+        self.assertIn(f'--backup-dir=/.history/{datetime.now().year}/', cmd)
+        self.assertIn('--partial-dir=/.partial/', cmd)
+        self.assertEqual(cmd.pop(), 'rsync://user@url:8730/backup/')  # module is the destination
+
+    def test_compress_remote(self):
+        br = Backup(
+            source=Startpoint('/source'),
+            destination=Endpoint('/destination', remote=True),
+            server=Server('url')
+        )
+        self.assertIn('--compress', br._create_rsync_command())
+
+    def test_compress_local_forced(self):
+        br = Backup(
+            source=Startpoint('/source'),
+            destination=Endpoint('/destination'),
+            compression=Compression(enabled=True, level=3, skip=['jpg', '.mp4'])
+        )
+        cmd = br._create_rsync_command()
+        self.assertIn('--compress', cmd)
+        self.assertIn('--compress-level=3', cmd)
+        self.assertIn('--skip-compress=jpg/mp4', cmd)
+
+    def test_compress_algorithm_unsupported(self):
+        probe_rsync.cache_clear()
+        br = Backup(
+            source=Startpoint('/source'),
+            destination=Endpoint('/destination', remote=True),
+            server=Server('url'),
+            compression=Compression(algorithm='zstd'),
+            rsync_local_path='/nonexistent/rsync'
+        )
+        # rsync cannot be probed: trust the config
+        self.assertIn('--compress-choice=zstd', br._create_rsync_command())
+
+    def test_parse_version(self):
+        capabilities = parse_version_output(
+            'rsync  version 3.2.7  protocol version 31\n'
+            'Copyright (C) 1996-2022 by Andrew Tridgell, Wayne Davison, and others.\n'
+            'Checksum list:\n'
+            '    xxh128 xxh3 xxh64 (xxhash) md5 md4 sha1 none\n'
+            'Compress list:\n'
+            '    zstd lz4 zlibx zlib none\n')
+        self.assertEqual(capabilities.version, (3, 2, 7))
+        self.assertEqual(capabilities.compressions, ['zstd', 'lz4', 'zlibx', 'zlib', 'none'])
+        self.assertIn('xxh128', capabilities.checksums)
+
     def test_relative_path_f(self):
         root_path = '/root/path'
         br = Backup(
@@ -242,6 +396,1655 @@ class TestCommandFormat(unittest.TestCase):
         self.assertIn('--itemize-changes', cmd)
 
 
+class TestSnapshot(unittest.TestCase):
+    def setUp(self):
+        self._tmp_dir = tempfile.TemporaryDirectory()
+        self.root_dirpath = self._tmp_dir.name
+        for name in ['2024-07-21-10-00', '2024-07-22-10-00', 'latest']:
+            os.makedirs(path.join(self.root_dirpath, name))
+
+    def tearDown(self):
+        self._tmp_dir.cleanup()
+
+    def test_list_timestamped(self):
+        timestamped = list_timestamped(path.join(self.root_dirpath, '%Y-%m-%d-%H-%M'))
+        self.assertEqual([t for t, _ in timestamped], [datetime(2024, 7, 21, 10, 0), datetime(2024, 7, 22, 10, 0)])
+        self.assertEqual(timestamped[-1][1], path.join(self.root_dirpath, '2024-07-22-10-00'))
+
+    def test_link_dest(self):
+        br = Backup(
+            source=Startpoint('/source'),
+            destination=Endpoint(path.join(self.root_dirpath, '%Y-%m-%d-%H-%M'), snapshot=True),
+        )
+        cmd = br._create_rsync_command()
+        self.assertIn(f'--link-dest={self.root_dirpath}/2024-07-22-10-00/', cmd)
+        self.assertEqual(cmd.pop(), br._timestamp.strftime(f'{self.root_dirpath}/%Y-%m-%d-%H-%M/'))
+
+    def test_first_snapshot(self):
+        br = Backup(
+            source=Startpoint('/source'),
+            destination=Endpoint(path.join(self.root_dirpath, 'snapshots', '%Y-%m-%d-%H-%M'), snapshot=True),
+        )
+        cmd = br._create_rsync_command()
+        self.assertFalse([o for o in cmd if o.startswith('--link-dest')])
+
+    def test_incomplete(self):
+        # a snapshot of a failed run is neither a --link-dest base, nor kept by retention
+        os.makedirs(path.join(self.root_dirpath, '2024-07-23-10-00'))
+        open(path.join(self.root_dirpath, '2024-07-23-10-00.incomplete'), 'w').close()
+        template = path.join(self.root_dirpath, '%Y-%m-%d-%H-%M')
+        br = Backup(source=Startpoint('/source'), destination=Endpoint(template, snapshot=True))
+        self.assertEqual(br._link_dest_dirpath, f'{self.root_dirpath}/2024-07-22-10-00/')
+        self.assertEqual(expired_paths(template, last=1), [path.join(self.root_dirpath, name)
+                                                           for name in ['2024-07-21-10-00', '2024-07-23-10-00']])
+        prune(expired_paths(template, last=1))
+        self.assertEqual(sorted(os.listdir(self.root_dirpath)), ['2024-07-22-10-00', 'latest'])
+
+    def test_mark_incomplete(self):
+        rsync_filepath = path.join(self.root_dirpath, 'rsync')
+        with open(rsync_filepath, 'w') as f:
+            f.write('#!/bin/sh\nfor a; do d=$a; done; mkdir -p "$d"; exit $(cat "$0.code")\n')
+        os.chmod(rsync_filepath, 0o755)
+        actions_filepath = path.join(self.root_dirpath, 'actions.log')
+        br = Backup(source=Startpoint(self.root_dirpath), rsync_local_path=rsync_filepath,
+                    destination=Endpoint(path.join(self.root_dirpath, 'snapshots', '%Y-%m-%d-%H-%M'), snapshot=True),
+                    logging=Logging(actions=Path_f(actions_filepath)))
+        marker = br._destination_dirpath.rstrip('/') + '.incomplete'
+        for code, incomplete in [(23, True), (0, False)]:
+            with open(rsync_filepath + '.code', 'w') as f:
+                f.write(str(code))
+            self.assertEqual(br.save(), code)
+            self.assertEqual(path.exists(marker), incomplete)
+            with open(actions_filepath) as f:
+                self.assertEqual(f.read().count('snapshot left incomplete'), 1)
+
+    def test_snapshot_no_template(self):
+        with self.assertRaises(ValueError):
+            Backup(
+                source=Startpoint('/source'),
+                destination=Endpoint('/destination', snapshot=True),
+            )
+
+
+class TestSharding(unittest.TestCase):
+    def test_split_balanced(self):
+        entries = [('a', 10), ('b', 1), ('c', 5), ('d', 5), ('e', 1)]
+        shards = split_shards(entries, 2)
+        self.assertEqual(shards, [['a', 'b'], ['c', 'd', 'e']])
+
+    def test_split_more_shards_than_entries(self):
+        shards = split_shards([('a', 1), ('b', 1)], 4)
+        self.assertEqual(shards, [['a'], ['b']])
+
+    def test_filter_rules(self):
+        shards = [['a'], ['b*']]
+        self.assertEqual(shard_filter_rules(shards, 0), (['hide /b\\*', 'protect /b\\*'], []))
+        self.assertEqual(shard_filter_rules(shards, 1), (['hide /a', 'protect /a'],
+                                                         ['show /b\\*', 'risk /b\\*', 'hide /*', 'protect /*']))
+
+    @staticmethod
+    def _transferred(shards, name: str):
+        """ shards whose rules let a top-level name through (first matching sender side rule) """
+        transferred = []
+        for index in range(len(shards)):
+            first_rules, last_rules = shard_filter_rules(shards, index)
+            for rule in first_rules + last_rules:
+                kind, pattern = rule.split(' ', 1)
+                if kind in ('hide', 'show') and fnmatch.fnmatchcase('/' + name, pattern.replace('\\', '')):
+                    if kind == 'show':
+                        transferred.append(index)
+                    break
+            else:
+                transferred.append(index)
+        return transferred
+
+    def test_unknown_names(self):
+        shards = split_shards([('d', 1), ('g', 1), ('a\nb', 1), ('c', 1)], 3)
+        self.assertEqual(shards, [['a\nb', 'g'], ['c'], ['d']])
+        # every top-level name is transferred by exactly one shard, even when created after the scan
+        for name in ['a\nb', 'c', 'd', 'g', 'new', 'd2']:
+            self.assertEqual(len(self._transferred(shards, name)), 1, name)
+        self.assertEqual(self._transferred(shards, 'new'), [0])
+        self.assertEqual(self._transferred(shards, 'a\nb'), [0])
+
+    def test_scan_size(self):
+        with tempfile.TemporaryDirectory() as root:
+            os.makedirs(path.join(root, 'dir', 'sub'))
+            with open(path.join(root, 'dir', 'sub', 'f'), 'w') as f:
+                f.write('x' * 10)
+            with open(path.join(root, 'file'), 'w') as f:
+                f.write('x' * 3)
+            self.assertEqual(scan_top_level(root, balance='size'), [('dir', 10), ('file', 3)])
+            self.assertEqual(scan_top_level(root, balance='directory'), [('dir', 1), ('file', 1)])
+
+    def test_remote_source(self):
+        with self.assertRaises(ValueError):
+            Backup(
+                source=Startpoint('/source', remote=True),
+                destination=Endpoint('/destination'),
+                server=Server('url'),
+                sharding=Sharding(shards=2)
+            )
+
+    def test_shard_command(self):
+        br = Backup(
+            source=Startpoint('/source'),
+            destination=Endpoint('/destination', partial='/partial'),
+            exclude='single',
+        )
+        cmd = br._create_rsync_command(first_filter_filepaths=['/shard.first.filter'],
+                                       filter_filepaths=['/shard.last.filter'], partial_dirpath='/partial/shard-1/')
+        self.assertIn('--partial-dir=/partial/shard-1/', cmd)
+        # filter rules must come after the excludes
+        self.assertLess(cmd.index('--exclude=single'), cmd.index('--filter=merge /shard.first.filter'))
+        # compiled rules come between the first and last shard rules
+        br = Backup(source=Startpoint('/source'), destination=Endpoint('/destination'), exclude=['*.log', '!keep.log'])
+        cmd = br._create_rsync_command(first_filter_filepaths=['/shard.first.filter'],
+                                       filter_filepaths=['/shard.last.filter'])
+        self.assertEqual([o for o in cmd if o.startswith('--filter=')][0::2],
+                         ['--filter=merge /shard.first.filter', '--filter=merge /shard.last.filter'])
+
+
+class TestDelta(unittest.TestCase):
+    def test_parse_size(self):
+        self.assertEqual(parse_size(100), 100)
+        self.assertEqual(parse_size('10K'), 10240)
+        self.assertEqual(parse_size('1.5g'), 3 << 29)
+        self.assertEqual(parse_size('1GB'), 1000 ** 3)
+
+    def test_passes(self):
+        passes = delta_passes([DeltaClass(patterns=['*.img'], inplace=True)],
+                              [DeltaClass(min_size='100M', whole_file=True), DeltaClass(min_size='1G', block_size=65536)])
+        self.assertEqual(len(passes), 4)
+        self.assertEqual(passes[0].options, ['--inplace'])
+        self.assertTrue(passes[0].inplace)
+        self.assertEqual(passes[0].rules, ['show */', 'show *.img', 'hide *', 'risk */', 'risk *.img', 'protect *'])
+        # largest first
+        self.assertEqual(passes[1].options, ['--block-size=65536', '--min-size=1G'])
+        self.assertEqual(passes[2].options, ['--whole-file', '--min-size=100M', '--max-size=1G-1'])
+        self.assertEqual(passes[3].options, ['--max-size=100M-1'])
+        for delta_pass in passes[1:]:
+            self.assertEqual(delta_pass.rules, ['hide *.img', 'protect *.img'])
+
+    def test_command(self):
+        br = Backup(source=Startpoint('/source'), destination=Endpoint('/destination', partial='/partial'),
+                    delta=[DeltaClass(patterns=['*.img'], append_verify=True)])
+        pattern_pass, default_pass = delta_passes([br.delta[0]], [])
+        cmd = br._create_rsync_command(delta_pass=pattern_pass)
+        self.assertIn('--append-verify', cmd)
+        self.assertNotIn('--partial-dir=/partial/', cmd)  # incompatible with inplace
+        self.assertEqual(cmd[-3], '--filter=protect *')
+        cmd = br._create_rsync_command(delta_pass=default_pass)
+        self.assertIn('--partial-dir=/partial/', cmd)
+        self.assertEqual(cmd[-4:-2], ['--filter=hide *.img', '--filter=protect *.img'])
+
+    def test_invalid(self):
+        with self.assertRaises(ValueError):
+            Backup(source=Startpoint('/source'), destination=Endpoint('/destination'),
+                   delta=[DeltaClass(patterns=['*.img'], min_size='1G')])
+        with self.assertRaises(ValueError):
+            Backup(source=Startpoint('/source'), destination=Endpoint('/destination'),
+                   delta=[DeltaClass(min_size='1G')], sharding=Sharding(shards=2))
+
+    @unittest.skipIf(sys.platform.startswith('win'), 'no shell script on windows')
+    def test_save(self):
+        with tempfile.TemporaryDirectory() as tmp_dirpath:
+            # rsync stand-in, recording its calls
+            rsync_filepath = path.join(tmp_dirpath, 'rsync')
+            with open(rsync_filepath, 'w') as f:
+                f.write(f'#!/bin/sh\necho "$@" >> {tmp_dirpath}/calls.txt\nexit 0\n')
+            os.chmod(rsync_filepath, 0o755)
+            br = Backup(source=Startpoint(tmp_dirpath), destination=Endpoint(path.join(tmp_dirpath, 'dst')),
+                        rsync_local_path=rsync_filepath,
+                        delta=[DeltaClass(patterns=['*.img'], inplace=True), DeltaClass(min_size='1G')])
+            self.assertEqual(br.save(), 0)
+            with open(path.join(tmp_dirpath, 'calls.txt')) as f:
+                calls = f.readlines()
+            self.assertEqual(len(calls), 3)
+            self.assertIn('--inplace', calls[0])
+            self.assertIn('--min-size=1G', calls[1])
+            self.assertIn('--max-size=1G-1', calls[2])
+
+
+class TestManifest(unittest.TestCase):
+    def setUp(self):
+        self._tmp_dir = tempfile.TemporaryDirectory()
+        self.src_dirpath = path.join(self._tmp_dir.name, 'source')
+        self.manifest_filepath = path.join(self._tmp_dir.name, 'manifest.sqlite')
+        os.makedirs(path.join(self.src_dirpath, 'dir'))
+        for name in ['a', 'dir/b']:
+            with open(path.join(self.src_dirpath, name), 'w') as f:
+                f.write(name)
+
+    def tearDown(self):
+        self._tmp_dir.cleanup()
+
+    def test_scan(self):
+        with ManifestIndex(self.manifest_filepath) as manifest:
+            self.assertTrue(manifest.is_full_run(verify_every=3))
+            changes = manifest.scan(self.src_dirpath)
+            self.assertEqual(changes.paths, ['a', 'dir', 'dir/b'])
+            manifest.commit(changes, full=True)
+            self.assertFalse(manifest.is_full_run(verify_every=3))
+            # nothing changed
+            self.assertEqual(manifest.scan(self.src_dirpath).paths, [])
+            # touched only, same content
+            os.utime(path.join(self.src_dirpath, 'a'), (0, 0))
+            changes = manifest.scan(self.src_dirpath)
+            self.assertEqual(changes.paths, [])
+            self.assertIn('a', changes.rows)
+            # modified and deleted
+            with open(path.join(self.src_dirpath, 'a'), 'w') as f:
+                f.write('modified')
+            os.remove(path.join(self.src_dirpath, 'dir/b'))
+            os.rmdir(path.join(self.src_dirpath, 'dir'))
+            changes = manifest.scan(self.src_dirpath)
+            self.assertEqual(changes.changed, ['a'])
+            self.assertEqual(changes.deleted, ['dir'])
+            manifest.commit(changes, full=False)
+            self.assertEqual(manifest.scan(self.src_dirpath).paths, [])
+            manifest.commit(changes, full=False)
+            self.assertTrue(manifest.is_full_run(verify_every=3))
+
+    def test_files_from_command(self):
+        br = Backup(
+            source=Startpoint('/source'),
+            destination=Endpoint('/destination'),
+        )
+        cmd = br._create_rsync_command(files_from='/files-from.txt')
+        self.assertNotIn('--checksum', cmd)
+        self.assertIn('--files-from=/files-from.txt', cmd)
+        self.assertIn('--from0', cmd)
+        self.assertIn('--delete-missing-args', cmd)
+
+
+class TestProgress(unittest.TestCase):
+    def test_parse_progress2(self):
+        progress = parse_progress_line('      1,234,567  45%   12.00MB/s    0:01:23 (xfr#12, to-chk=100/2000)')
+        self.assertEqual(progress, {
+            'bytes': 1234567, 'percent': 45, 'rate': 12. * (1 << 20), 'eta': 83,
+            'files': 12, 'to_check': 100, 'total': 2000})
+
+    def test_parse_ir_chk(self):
+        progress = parse_progress_line('  32,768   0%    1.00kB/s    0:00:00 (xfr#1, ir-chk=1000/1002)')
+        self.assertEqual(progress['to_check'], 1000)
+        self.assertEqual(progress['rate'], 1024.)
+
+    def test_parse_other(self):
+        self.assertIsNone(parse_progress_line('sending incremental file list\n'))
+        self.assertIsNone(parse_progress_line('dir/file.txt\n'))
+
+    def test_pump(self):
+        with tempfile.TemporaryDirectory() as tmp_dirpath:
+            status_filepath = path.join(tmp_dirpath, 'status.json')
+            events_filepath = path.join(tmp_dirpath, 'events.jsonl')
+            monitor = ProgressMonitor(status_filepath=status_filepath, events_filepath=events_filepath, interval=0)
+            output = io.StringIO()
+            stdout = io.BufferedReader(io.BytesIO(
+                b'file.txt\n'
+                b'      1,000  10%    1.00kB/s    0:00:09 (xfr#1, to-chk=9/10)\r'
+                b'     10,000 100%    1.00kB/s    0:00:00 (xfr#2, to-chk=0/10)\n'))
+            pump(stdout, output, [monitor])
+            monitor.close(0)
+            # progress updates are not kept in output
+            self.assertEqual(output.getvalue(),
+                             'file.txt\n     10,000 100%    1.00kB/s    0:00:00 (xfr#2, to-chk=0/10)\n')
+            with open(status_filepath) as status_file:
+                status = json.load(status_file)
+            self.assertEqual(status['state'], 'finished')
+            self.assertEqual(status['bytes'], 10000)
+            self.assertEqual(status['to_check'], 0)
+            with open(events_filepath) as events_file:
+                self.assertEqual(len(events_file.readlines()), 3)
+
+    def test_progress2_option(self):
+        br = Backup(
+            source=Startpoint('/source'),
+            destination=Endpoint('/destination'),
+            logging=Logging(status='/status.json')
+        )
+        self.assertIn('--info=progress2', br._create_rsync_command())
+
+
+class TestReport(unittest.TestCase):
+    OUTPUT = [
+        'sending incremental file list\n',
+        'cd+++++++++ 4096 dir/\n',
+        '>f+++++++++ 100 dir/new.txt\n',
+        '>f.st...... 50 dir/updated.txt\n',
+        '>f+++++++++ 10 top.txt\n',
+        '*deleting   0 old/gone.txt\n',
+        '.d..t...... 4096 dir/\n',
+        'Number of files: 1,234 (reg: 1,000, dir: 234)\n',
+        'Number of created files: 2 (reg: 2)\n',
+        'Number of deleted files: 1 (reg: 1)\n',
+        'Total file size: 2,000 bytes\n',
+        'Literal data: 150 bytes\n',
+        'Matched data: 10 bytes\n',
+        'Total bytes sent: 300\n',
+        'Total bytes received: 100\n',
+        'sent 300 bytes  received 100 bytes  800.00 bytes/sec\n',
+    ]
+
+    def make_report(self) -> RunReport:
+        report = RunReport()
+        for line in self.OUTPUT:
+            report.feed(line)
+        report.close(0)
+        return report
+
+    def test_changes(self):
+        report = self.make_report().as_dict()
+        self.assertEqual(report['created'], {'files': 2, 'bytes': 110})
+        self.assertEqual(report['updated'], {'files': 1, 'bytes': 50})
+        self.assertEqual(report['deleted'], {'files': 1, 'bytes': 0})
+        self.assertEqual(report['directories']['dir']['created'], {'files': 1, 'bytes': 100})
+        self.assertEqual(report['directories']['.']['created'], {'files': 1, 'bytes': 10})
+        self.assertEqual(report['directories']['old']['deleted']['files'], 1)
+
+    def test_stats(self):
+        report = self.make_report()
+        self.assertEqual(report.stats['files'], 1234)
+        self.assertEqual(report.stats['literal_data'], 150)
+        self.assertEqual(report.stats['bytes_sent'], 300)
+        self.assertEqual(report.speedup, 5.)
+
+    def test_resolve_deleted(self):
+        report = self.make_report()
+        with tempfile.TemporaryDirectory() as history_dirpath:
+            os.makedirs(path.join(history_dirpath, 'old'))
+            with open(path.join(history_dirpath, 'old', 'gone.txt'), 'w') as f:
+                f.write('x' * 42)
+            report.resolve_deleted(history_dirpath)
+        self.assertEqual(report.changes['deleted']['bytes'], 42)
+
+    def test_prometheus(self):
+        report = self.make_report()
+        with tempfile.TemporaryDirectory() as tmp_dirpath:
+            metrics_filepath = path.join(tmp_dirpath, 'backup.prom')
+            report.write_prometheus(metrics_filepath, destination='/dst')
+            with open(metrics_filepath) as f:
+                metrics = f.read()
+        self.assertIn('backup_rsync_exit_code{destination="/dst"} 0\n', metrics)
+        self.assertIn('backup_rsync_files{destination="/dst",action="created"} 2\n', metrics)
+
+
+class TestRetry(unittest.TestCase):
+    def test_failed_paths(self):
+        failed = FailedPaths(['/source/', '/destination/'])
+        failed.feed('rsync: [sender] send_files failed to open "/source/dir/a": Permission denied (13)\n')
+        failed.feed('rsync: [receiver] rename "/destination/dir/.b.Xa8d7c" -> "dir/b": No such file (2)\n')
+        failed.feed('file has vanished: "/source/c"\n')
+        failed.feed('rsync error: some files/attrs were not transferred (see previous errors) (code 23) at main.c(1338)\n')
+        self.assertFalse(failed.full)
+        self.assertEqual(failed.retry_paths, ['dir/a', 'dir/b'])
+        self.assertEqual(failed.vanished, {'c'})
+
+    def test_failed_connection(self):
+        failed = FailedPaths(['/source/', '/destination/'])
+        failed.feed('rsync: connection unexpectedly closed (0 bytes received so far) [sender]\n')
+        self.assertTrue(failed.full)
+
+    def test_with_files_from(self):
+        cmd = ['rsync', '--checksum', '--files-from=/old', '--from0', '/source/', '/destination/']
+        self.assertEqual(with_files_from(cmd, '/new'),
+                         ['rsync', '--checksum', '--from0', '--files-from=/new', '/source/', '/destination/'])
+
+    @unittest.skipIf(sys.platform.startswith('win'), 'no shell script on windows')
+    def test_retry_failed_paths(self):
+        with tempfile.TemporaryDirectory() as tmp_dirpath:
+            # rsync stand-in: fails on first call, succeeds after
+            rsync_filepath = path.join(tmp_dirpath, 'rsync')
+            calls_filepath = path.join(tmp_dirpath, 'calls.txt')
+            with open(rsync_filepath, 'w') as f:
+                f.write('#!/bin/sh\n'
+                        f'echo "$@" >> {calls_filepath}\n'
+                        f'[ "$(wc -l < {calls_filepath})" -gt 1 ] && exit 0\n'
+                        'echo \'rsync: [sender] send_files failed to open "/source/a": Permission denied (13)\' >&2\n'
+                        'exit 23\n')
+            os.chmod(rsync_filepath, 0o755)
+            br = Backup(
+                source=Startpoint('/source'),
+                destination=Endpoint('/destination'),
+                logging=Logging(actions=path.join(tmp_dirpath, 'actions.txt')),
+                retry=Retry(attempts=3, delay=0),
+                rsync_local_path=rsync_filepath
+            )
+            br.save()
+            with open(calls_filepath) as f:
+                calls = f.readlines()
+            self.assertEqual(len(calls), 2)
+            self.assertNotIn('--files-from', calls[0])
+            self.assertIn('--files-from', calls[1])
+            with open(path.join(tmp_dirpath, 'actions.txt')) as f:
+                actions = f.read()
+            self.assertIn('retry 1/2 (1 failed paths)', actions)
+            self.assertIn('rsync finished with code 0.', actions)
+
+    @unittest.skipIf(sys.platform.startswith('win'), 'no shell script on windows')
+    def test_retry_report(self):
+        with tempfile.TemporaryDirectory() as tmp_dirpath:
+            # rsync stand-in: both attempts transfer "a", the first one fails
+            rsync_filepath = path.join(tmp_dirpath, 'rsync')
+            calls_filepath = path.join(tmp_dirpath, 'calls.txt')
+            with open(rsync_filepath, 'w') as f:
+                f.write('#!/bin/sh\n'
+                        f'echo "$@" >> {calls_filepath}\n'
+                        'echo ">f+++++++++ 10 a"\n'
+                        'echo "Total bytes sent: 100"\n'
+                        f'[ "$(wc -l < {calls_filepath})" -gt 1 ] && exit 0\n'
+                        'echo \'rsync: [sender] send_files failed to open "/source/a": Permission denied (13)\' >&2\n'
+                        'exit 23\n')
+            os.chmod(rsync_filepath, 0o755)
+            report_filepath = path.join(tmp_dirpath, 'report.json')
+            br = Backup(
+                source=Startpoint('/source'),
+                destination=Endpoint('/destination'),
+                logging=Logging(report=report_filepath),
+                retry=Retry(attempts=3, delay=0),
+                rsync_local_path=rsync_filepath
+            )
+            br.save()
+            with open(report_filepath) as f:
+                report = json.load(f)
+            self.assertEqual(report['created'], {'files': 1, 'bytes': 10})
+            self.assertEqual(report['stats']['bytes_sent'], 100)
+            self.assertEqual(len(report['attempts']), 1)
+            self.assertEqual(report['attempts'][0]['code'], 23)
+            self.assertEqual(report['attempts'][0]['stats']['bytes_sent'], 100)
+
+
+class TestJournal(unittest.TestCase):
+    def setUp(self):
+        self._tmp_dir = tempfile.TemporaryDirectory()
+        self.src_dirpath = path.join(self._tmp_dir.name, 'source') + '/'
+        self.journal_filepath = path.join(self._tmp_dir.name, 'journal.txt')
+        os.makedirs(path.join(self.src_dirpath, 'dir'))
+        with open(path.join(self.src_dirpath, 'dir', 'a'), 'w') as f:
+            f.write('a')
+
+    def tearDown(self):
+        self._tmp_dir.cleanup()
+
+    def test_parse_event(self):
+        self.assertEqual(_parse_event(f'CLOSE_WRITE,CLOSE|{self.src_dirpath}dir/a\n', self.src_dirpath), ('M', 'dir/a'))
+        self.assertEqual(_parse_event(f'DELETE,ISDIR|{self.src_dirpath}old\n', self.src_dirpath), ('D', 'old'))
+        self.assertEqual(_parse_event('Q_OVERFLOW|\n', self.src_dirpath), ('overflow', ''))
+
+    def test_no_watcher(self):
+        journal = ChangeJournal(self.journal_filepath)
+        self.assertIsNone(journal.consume(self.src_dirpath))
+
+    def test_consume(self):
+        watcher = ChangeJournal(self.journal_filepath)
+        watcher.lock()
+        watcher.append([], marker='# started now')
+        journal = ChangeJournal(self.journal_filepath)
+        # first run after watcher started: full scan
+        self.assertIsNone(journal.consume(self.src_dirpath))
+        journal.commit()
+        watcher.append([('M', 'dir/a'), ('M', 'dir/gone'), ('D', 'old'), ('D', 'old/file')])
+        self.assertEqual(journal.consume(self.src_dirpath), (['dir/a'], ['dir/gone', 'old']))
+        # failed run: consumed journal kept for next run
+        watcher.append([('M', 'dir')])
+        self.assertEqual(journal.consume(self.src_dirpath), (['dir', 'dir/a'], ['dir/gone', 'old']))
+        journal.commit()
+        self.assertEqual(journal.consume(self.src_dirpath), ([], []))
+
+    def test_consume_while_appending(self):
+        watcher = ChangeJournal(self.journal_filepath)
+        watcher.lock()
+        watcher.append([], marker='# started now')
+        journal = ChangeJournal(self.journal_filepath)
+        self.assertIsNone(journal.consume(self.src_dirpath))  # first run: full scan
+        journal.commit()
+        appending = watcher._open_current()  # an append in progress
+        results = []
+        consumer = threading.Thread(target=lambda: results.append(journal.consume(self.src_dirpath)))
+        consumer.start()
+        time.sleep(.2)
+        appending.write('M dir/a\n')
+        appending.close()
+        consumer.join()
+        self.assertEqual(results, [(['dir/a'], [])])  # not lost in the consumed journal
+        watcher.append([('D', 'old')])  # goes to the new journal
+        self.assertEqual(journal.consume(self.src_dirpath), (['dir/a'], ['old']))
+
+    def test_overflow(self):
+        watcher = ChangeJournal(self.journal_filepath, max_entries=1)
+        watcher.lock()
+        watcher.append([('M', 'dir/a'), ('M', 'dir/b')])
+        journal = ChangeJournal(self.journal_filepath)
+        self.assertIsNone(journal.consume(self.src_dirpath))
+
+
+class TestPlan(unittest.TestCase):
+    def test_excluded(self):
+        self.assertTrue(is_excluded('dir/@eaDir', True, ['@eaDir']))
+        self.assertTrue(is_excluded('Thumbs.db', False, ['*.db']))
+        self.assertFalse(is_excluded('dir/file', False, ['dir/']))
+        self.assertTrue(is_excluded('dir', True, ['dir/']))
+        self.assertFalse(is_excluded('sub/dir', True, ['/dir']))
+
+    def test_compare(self):
+        source = {
+            'dir': Entry(True, 0, 0),
+            'dir/new': Entry(False, 10, 100),
+            'same': Entry(False, 5, 100),
+            'changed': Entry(False, 7, 200),
+            'older': Entry(False, 7, 100),
+        }
+        destination = {
+            'same': Entry(False, 5, 100),
+            'changed': Entry(False, 5, 100),
+            'older': Entry(False, 5, 200),
+            'gone': Entry(False, 3, 100),
+            'gone_dir': Entry(True, 0, 100),
+        }
+        plan = compare_trees(source, destination)
+        self.assertEqual(plan['create'], {'files': 1, 'bytes': 10})
+        self.assertEqual(plan['update'], {'files': 1, 'bytes': 7})
+        self.assertEqual(plan['delete'], {'files': 1, 'bytes': 3})
+        self.assertEqual(plan['directories'], {'create': 1, 'delete': 1})
+
+    def test_scan(self):
+        with tempfile.TemporaryDirectory() as root:
+            os.makedirs(path.join(root, 'src', 'dir', '@eaDir'))
+            with open(path.join(root, 'src', 'dir', 'file'), 'w') as f:
+                f.write('12345')
+            source, destination = scan_trees([path.join(root, 'src'), path.join(root, 'missing')],
+                                             excludes=[['@eaDir'], []])
+        self.assertEqual(sorted(source), ['dir', 'dir/file'])
+        self.assertEqual(source['dir/file'].size, 5)
+        self.assertEqual(destination, {})
+
+    def test_throughput(self):
+        with tempfile.TemporaryDirectory() as root:
+            for name, wall_time in [('2024-07-21-10-00', 10), ('2024-07-22-10-00', 30)]:
+                os.makedirs(path.join(root, name))
+                with open(path.join(root, name, '_report.json'), 'w') as f:
+                    json.dump({'created': {'bytes': 600}, 'updated': {'bytes': 0}, 'wall_time': wall_time}, f)
+            self.assertEqual(estimate_throughput(path.join(root, '%Y-%m-%d-%H-%M', '_report.json')), 40.)
+            self.assertIsNone(estimate_throughput(path.join(root, 'missing.json')))
+            # reports of another format are skipped
+            for name, report in [('2024-07-23-10-00', {'wall_time': 5}), ('2024-07-24-10-00', [1, 2]),
+                                 ('2024-07-25-10-00', {'created': {'bytes': '1'}, 'updated': {'bytes': 0}})]:
+                os.makedirs(path.join(root, name))
+                with open(path.join(root, name, '_report.json'), 'w') as f:
+                    json.dump(report, f)
+            self.assertEqual(estimate_throughput(path.join(root, '%Y-%m-%d-%H-%M', '_report.json')), 40.)
+
+
+class TestSchedule(unittest.TestCase):
+    SCHEDULE = Schedule(
+        bwlimit='100M',
+        nice=10,
+        windows=[
+            Window(start='08:00', end='19:00', bwlimit='1M', ionice='idle'),
+            Window(start='22:00', end='02:00', nice=0),
+        ]
+    )
+
+    def test_active_window(self):
+        windows = self.SCHEDULE.windows
+        self.assertIs(active_window(windows, datetime(2024, 7, 22, 12, 0)), windows[0])
+        self.assertIs(active_window(windows, datetime(2024, 7, 22, 1, 0)), windows[1])
+        self.assertIs(active_window(windows, datetime(2024, 7, 22, 23, 0)), windows[1])
+        self.assertIsNone(active_window(windows, datetime(2024, 7, 22, 20, 0)))
+
+    def test_effective_policy(self):
+        policy = effective_policy(self.SCHEDULE, datetime(2024, 7, 22, 12, 0))
+        self.assertEqual(policy, {'bwlimit': '1M', 'nice': 10, 'ionice': 'idle', 'ionice_level': None, 'pause': False})
+        policy = effective_policy(self.SCHEDULE, datetime(2024, 7, 22, 20, 0))
+        self.assertEqual(policy['bwlimit'], '100M')
+
+    def test_bwlimit(self):
+        br = Backup(
+            source=Startpoint('/source'),
+            destination=Endpoint('/destination'),
+            schedule=Schedule(bwlimit='10M')
+        )
+        self.assertIn('--bwlimit=10M', br._create_rsync_command())
+
+    @unittest.skipIf(not sys.platform.startswith('linux'), 'needs /proc')
+    def test_throttle_process(self):
+        process = subprocess.Popen(['sh', '-c', 'sleep 10 & wait'])
+        try:
+            time.sleep(.2)
+            self.assertTrue(descendants(process.pid))
+            schedule = Schedule(nice=5, windows=[Window(start='00:00', end='00:00', pause=True)], interval=.1)
+            with Throttler(schedule) as throttler:
+                throttler.attach(process.pid)
+                self.assertEqual(os.getpriority(os.PRIO_PROCESS, process.pid), 5)
+                for _ in range(50):
+                    with open(f'/proc/{process.pid}/stat') as stat_file:
+                        state = stat_file.read().rsplit(')', 1)[1].split()[0]
+                    if state == 'T':
+                        break
+                    time.sleep(.02)
+                self.assertEqual(state, 'T')  # stopped
+                [child] = descendants(process.pid)
+                self.assertNotEqual(self._state(child), 'T')  # not rsync (e.g. ssh): keeps running
+                throttler.detach(process.pid)
+            # pauses are interrupted after max_pause
+            with Throttler(schedule, max_pause=.2) as throttler:
+                throttler.attach(process.pid)
+                states = set()
+                for _ in range(50):
+                    states.add(self._state(process.pid))
+                    time.sleep(.02)
+                throttler.detach(process.pid)
+            self.assertIn('T', states)
+            self.assertGreater(len(states), 1)
+        finally:
+            process.send_signal(signal.SIGCONT)
+            process.kill()
+            process.wait()
+
+    @staticmethod
+    def _state(pid: int) -> str:
+        with open(f'/proc/{pid}/stat') as stat_file:
+            return stat_file.read().rsplit(')', 1)[1].split()[0]
+
+    @unittest.skipIf(not sys.platform.startswith('linux') or os.geteuid() == 0, 'needs /proc, and not root')
+    def test_throttle_errors(self):
+        errors = io.StringIO()
+        with Throttler(Schedule(nice=-5, interval=.1), errors=errors) as throttler:
+            throttler.attach(os.getpid())
+            throttler.attach(os.getpid())
+            throttler.detach(os.getpid())
+        self.assertEqual(errors.getvalue().count('throttle: cannot set nice -5'), 1)
+
+
+class TestCron(unittest.TestCase):
+    def test_matches(self):
+        cron = CronExpression('*/15 8-18 * * mon-fri')
+        self.assertTrue(cron.matches(datetime(2024, 7, 22, 8, 45)))  # monday
+        self.assertFalse(cron.matches(datetime(2024, 7, 22, 8, 40)))
+        self.assertFalse(cron.matches(datetime(2024, 7, 21, 8, 45)))  # sunday
+
+    def test_days_either(self):
+        cron = CronExpression('0 0 1 * 0')  # 1st of month or sunday
+        self.assertTrue(cron.matches(datetime(2024, 8, 1)))  # thursday
+        self.assertTrue(cron.matches(datetime(2024, 7, 21)))  # sunday
+        self.assertFalse(cron.matches(datetime(2024, 7, 22)))
+
+    def test_next_after(self):
+        self.assertEqual(CronExpression('@daily').next_after(datetime(2024, 7, 22, 13, 20, 12)),
+                         datetime(2024, 7, 23))
+        self.assertEqual(CronExpression('30 2 29 2 *').next_after(datetime(2024, 7, 22)),
+                         datetime(2028, 2, 29, 2, 30))
+
+    def test_invalid(self):
+        for expression in ['* * * *', '60 * * * *', '* * 0 * *', 'a * * * *']:
+            with self.assertRaises(ValueError):
+                CronExpression(expression)
+
+
+@unittest.skipIf(sys.platform.startswith('win'), 'no unix socket on windows')
+class TestDaemon(unittest.TestCase):
+    def setUp(self):
+        self._tmp_dir = tempfile.TemporaryDirectory()
+        self.tmp_dirpath = self._tmp_dir.name
+        # rsync stand-in: slow, and records concurrent runs
+        self.rsync_filepath = path.join(self.tmp_dirpath, 'rsync')
+        with open(self.rsync_filepath, 'w') as f:
+            f.write('#!/bin/sh\n'
+                    f'mkdir {self.tmp_dirpath}/running || echo concurrent >> {self.tmp_dirpath}/concurrent.txt\n'
+                    'sleep 0.3\n'
+                    f'rmdir {self.tmp_dirpath}/running\n')
+        os.chmod(self.rsync_filepath, 0o755)
+        for name in ['a', 'b']:
+            with open(path.join(self.tmp_dirpath, f'{name}.yaml'), 'w') as f:
+                f.write(f'source.path: "/source/{name}"\n'
+                        f'destination.path: "shared"\n'
+                        f'rsync_local_path: "{self.rsync_filepath}"\n')
+        self.config_filepath = path.join(self.tmp_dirpath, 'daemon.yaml')
+        with open(self.config_filepath, 'w') as f:
+            f.write('socket: "daemon.sock"\n'
+                    'jobs:\n'
+                    '  - {config: "a.yaml", name: "a", cron: "0 2 * * *"}\n'
+                    '  - {config: "b.yaml", name: "b", cron: "@hourly"}\n')
+
+    def tearDown(self):
+        self._tmp_dir.cleanup()
+
+    def _wait_idle(self, scheduler):
+        for thread in list(scheduler._threads):
+            thread.join()
+
+    def test_destination_exclusion(self):
+        scheduler = Scheduler(self.config_filepath)
+        scheduler.reload()
+        self.assertTrue(scheduler.start('a'))
+        self.assertFalse(scheduler.start('a'))  # already started
+        self.assertTrue(scheduler.start('b'))
+        self._wait_idle(scheduler)
+        self.assertFalse(path.exists(path.join(self.tmp_dirpath, 'concurrent.txt')))
+        status = scheduler.command(['status'])
+        self.assertEqual(status['a']['last_code'], 0)
+        self.assertEqual(status['b']['runs'], 1)
+
+    def test_tick(self):
+        scheduler = Scheduler(self.config_filepath)
+        scheduler.reload()
+        scheduler.tick(datetime(2024, 7, 22, 1, 59, 30), datetime(2024, 7, 22, 2, 0, 10))
+        self._wait_idle(scheduler)
+        status = scheduler.command(['status'])
+        self.assertEqual((status['a']['runs'], status['b']['runs']), (1, 1))
+        scheduler.tick(datetime(2024, 7, 22, 2, 0, 10), datetime(2024, 7, 22, 2, 1, 10))
+        self._wait_idle(scheduler)
+        self.assertEqual(scheduler.command(['status'])['a']['runs'], 1)
+
+    def test_reload(self):
+        scheduler = Scheduler(self.config_filepath)
+        scheduler.reload()
+        with open(self.config_filepath, 'a') as f:
+            f.write('  - {config: "a.yaml", name: "c", cron: "0 3 * * *"}\n')
+        os.utime(self.config_filepath, (0, 0))
+        scheduler.reload()
+        self.assertEqual(sorted(scheduler.jobs), ['a', 'b', 'c'])
+        with open(path.join(self.tmp_dirpath, 'b.yaml'), 'a') as f:
+            f.write('unknown: 1\n')
+        os.utime(path.join(self.tmp_dirpath, 'b.yaml'), (0, 0))
+        scheduler.reload()
+        self.assertIn('invalid config', scheduler.command(['status'])['b']['error'])
+
+    def test_socket(self):
+        scheduler = Scheduler(self.config_filepath)
+        scheduler.reload()
+        server = scheduler._serve()
+        try:
+            socket_filepath = path.join(self.tmp_dirpath, 'daemon.sock')
+            self.assertEqual(request(socket_filepath, 'run', 'a'), {'started': True})
+            self._wait_idle(scheduler)
+            self.assertEqual(request(socket_filepath, 'status')['a']['runs'], 1)
+            self.assertIn('error', request(socket_filepath, 'run', 'unknown'))
+        finally:
+            server.shutdown()
+            server.server_close()
+
+
+@unittest.skipIf(sys.platform.startswith('win'), 'no shell script on windows')
+class TestJobs(unittest.TestCase):
+    def setUp(self):
+        self._tmp_dir = tempfile.TemporaryDirectory()
+        self.tmp_dirpath = self._tmp_dir.name
+        # rsync stand-in: slow, and records concurrent runs and order
+        self.rsync_filepath = path.join(self.tmp_dirpath, 'rsync')
+        with open(self.rsync_filepath, 'w') as f:
+            f.write('#!/bin/sh\n'
+                    'for last; do :; done\n'
+                    f'echo "$last" >> {self.tmp_dirpath}/order.txt\n'
+                    f'mkdir {self.tmp_dirpath}/running 2> /dev/null || echo concurrent >> {self.tmp_dirpath}/concurrent.txt\n'
+                    'sleep 0.2\n'
+                    f'rmdir {self.tmp_dirpath}/running 2> /dev/null\n'
+                    'exit 0\n')
+        os.chmod(self.rsync_filepath, 0o755)
+
+    def tearDown(self):
+        self._tmp_dir.cleanup()
+
+    def _backup(self, name: str, **kwargs):
+        return Backup(source=Startpoint(self.tmp_dirpath), destination=Endpoint(path.join(self.tmp_dirpath, name)),
+                      rsync_local_path=self.rsync_filepath, **kwargs)
+
+    def test_shared_server(self):
+        jobs = JobsConfig(jobs={'a': self._backup('a', server='nas')}, servers={'nas': Server('nas.local')})
+        self.assertEqual(jobs.jobs['a'].server.url, 'nas.local')
+        with self.assertRaises(ValueError):
+            JobsConfig(jobs={'a': self._backup('a', server='unknown')})
+        # not resolved by a jobs config
+        with self.assertRaises(ValueError):
+            Backup(source=Startpoint(self.tmp_dirpath), destination=Endpoint('/backup', remote=True),
+                   server='nas').rsync_command_pretty
+        # checks depending on the server, once resolved
+        with self.assertRaises(ValueError):
+            JobsConfig(jobs={'a': self._backup('a', server='nas')},
+                       servers={'nas': Server('nas.local', multiplex=True, daemon=Daemon())})
+
+    def test_resources(self):
+        backup = Backup(source=Startpoint(self.tmp_dirpath), destination=Endpoint('/backup', remote=True),
+                        server=Server('nas.local'))
+        self.assertEqual(resources(backup), [f'disk:{os.stat(self.tmp_dirpath).st_dev}', 'server:nas.local'])
+
+    def test_per_disk_limit(self):
+        jobs = {name: self._backup(name) for name in ['a', 'b', 'c']}
+        results = run_jobs(jobs, Limits(per_disk=1), durations={'a': 1., 'b': 3., 'c': 2.})
+        self.assertEqual([r['code'] for r in results.values()], [0, 0, 0])
+        self.assertFalse(path.exists(path.join(self.tmp_dirpath, 'concurrent.txt')))
+        with open(path.join(self.tmp_dirpath, 'order.txt')) as f:
+            order = [path.basename(line.strip().rstrip('/')) for line in f]
+        self.assertEqual(order, ['b', 'c', 'a'])  # longest first
+
+    def test_concurrent(self):
+        jobs = {name: self._backup(name) for name in ['a', 'b']}
+        run_jobs(jobs, Limits(per_disk=None), durations={})
+        self.assertTrue(path.exists(path.join(self.tmp_dirpath, 'concurrent.txt')))
+
+    def test_save(self):
+        state_filepath = path.join(self.tmp_dirpath, 'state.json')
+        result_filepath = path.join(self.tmp_dirpath, 'result.json')
+        jobs = JobsConfig(jobs={'a': self._backup('a'), 'b': self._backup('b')},
+                          state=state_filepath, result=result_filepath)
+        self.assertEqual(jobs.save(), 0)
+        with open(result_filepath) as f:
+            result = json.load(f)
+        self.assertEqual(result['failed'], [])
+        self.assertEqual(sorted(result['jobs']), ['a', 'b'])
+        with open(state_filepath) as f:
+            self.assertGreater(json.load(f)['a']['duration'], 0.1)
+
+
+class TestLogger(unittest.TestCase):
+    def setUp(self):
+        self._tmp_dir = tempfile.TemporaryDirectory()
+        self.actions_filepath = path.join(self._tmp_dir.name, 'actions.txt')
+
+    def tearDown(self):
+        self._tmp_dir.cleanup()
+
+    def _run(self, content: str, **kwargs):
+        with Logger3(actions_filepath=self.actions_filepath, progress_filepath=None, errors_filepath=None,
+                     **kwargs) as logger:
+            logger.actions.write(content)
+
+    def test_index(self):
+        self._run('first run\n', index=True)
+        self._run('second run\n', index=True)
+        self._run('third run\n', index=True)
+        runs = read_index(self.actions_filepath)
+        self.assertEqual([r['offset'] for r in runs], [0, 10, 21])
+        self.assertEqual(read_run(self.actions_filepath), 'third run\n')
+        self.assertEqual(read_run(self.actions_filepath, 1), 'second run\n')
+
+    def test_rotate_runs(self):
+        self._run('first run\n', max_runs=2, compression='gzip')
+        self._run('second run\n', max_runs=2, compression='gzip')
+        self._run('third run\n', max_runs=2, compression='gzip')
+        with open(self.actions_filepath) as f:
+            self.assertEqual(f.read(), 'third run\n')
+        segments = rotated_segments(self.actions_filepath)
+        self.assertEqual(len(segments), 1)
+        self.assertTrue(segments[0].endswith('.gz'))
+        with gzip.open(segments[0], 'rt') as f:
+            self.assertEqual(f.read(), 'first run\nsecond run\n')
+        self.assertEqual(len(read_index(self.actions_filepath)), 1)
+
+    def test_rotate_size(self):
+        self._run('x' * 100, max_size=50, keep=1)
+        self._run('y' * 100, max_size=50, keep=1)
+        self._run('z' * 10, max_size=50, keep=1)
+        self._run('z' * 10, max_size=50, keep=1)
+        segments = rotated_segments(self.actions_filepath)
+        self.assertEqual(len(segments), 1)
+        with open(segments[0]) as f:
+            self.assertEqual(f.read(), 'y' * 100)
+        with open(self.actions_filepath) as f:
+            self.assertEqual(f.read(), 'z' * 20)
+
+    def test_rotation_requires_actions(self):
+        with self.assertRaises(ValueError):
+            Backup(source=Startpoint('/tmp/a'), destination=Endpoint('/tmp/b'),
+                   logging=Logging(rotation=Rotation(max_runs=10)))
+
+
+class TestDedup(unittest.TestCase):
+    def setUp(self):
+        self._tmp_dir = tempfile.TemporaryDirectory()
+        self.tmp_dirpath = self._tmp_dir.name
+        self.index_filepath = path.join(self.tmp_dirpath, 'dedup.sqlite')
+        for dirname, files in {'latest': {'a': 'same' * 10, 'b': 'other' * 10},
+                               '2024-07-22-13-26': {'a': 'same' * 10, 'moved/c': 'same' * 10},
+                               '2024-07-23-13-26': {'a': 'diff' * 10, 'd': 'x'}}.items():
+            for filename, content in files.items():
+                filepath = path.join(self.tmp_dirpath, dirname, filename)
+                os.makedirs(path.dirname(filepath), exist_ok=True)
+                with open(filepath, 'w') as f:
+                    f.write(content)
+                os.utime(filepath, (1700000000, 1700000000))  # copies keep modification times (rsync -t)
+
+    def tearDown(self):
+        self._tmp_dir.cleanup()
+
+    def _path(self, *names):
+        return path.join(self.tmp_dirpath, *names)
+
+    def test_dedup(self):
+        roots = [self._path('latest') + '/', self._path('2024-07-22-13-26'), self._path('2024-07-23-13-26')]
+        latest_inode = os.stat(self._path('latest', 'a')).st_ino
+        result = dedup(roots, self.index_filepath, preferred_dirpath=roots[0])
+        self.assertEqual(result.linked, 2)
+        self.assertEqual(result.reclaimed, 80)
+        self.assertEqual(os.stat(self._path('latest', 'a')).st_ino, latest_inode)  # latest is kept
+        self.assertEqual(os.stat(self._path('2024-07-22-13-26', 'moved', 'c')).st_ino, latest_inode)
+        self.assertNotEqual(os.stat(self._path('2024-07-23-13-26', 'a')).st_ino, latest_inode)
+        # next pass only hashes new files
+        with open(self._path('latest', 'e'), 'w') as f:
+            f.write('other' * 10)
+        os.utime(self._path('latest', 'e'), (1700000000, 1700000000))
+        result = dedup(roots, self.index_filepath, preferred_dirpath=roots[0])
+        self.assertEqual(result.hashed, 2)  # e, and b not hashed before (unique size)
+        self.assertEqual(result.linked, 1)
+        self.assertEqual(result.reclaimed, 50)
+
+    def test_metadata(self):
+        # links share their metadata: copies with another modification time or mode are kept apart
+        os.utime(self._path('2024-07-22-13-26', 'a'), (1600000000, 1600000000))
+        os.chmod(self._path('2024-07-22-13-26', 'moved', 'c'), 0o600)
+        result = dedup([self._path('latest'), self._path('2024-07-22-13-26')], self.index_filepath)
+        self.assertEqual(result.linked, 0)
+        self.assertEqual(os.stat(self._path('2024-07-22-13-26', 'a')).st_mtime, 1600000000)
+
+    def test_dryrun(self):
+        roots = [self._path('latest'), self._path('2024-07-22-13-26')]
+        os.link(self._path('latest', 'a'), self._path('latest', 'b.dedup-tmp'))
+        result = dedup(roots, self.index_filepath, dryrun=True)
+        self.assertEqual(result.reclaimed, 80)
+        self.assertNotEqual(os.stat(self._path('latest', 'a')).st_ino, os.stat(self._path('2024-07-22-13-26', 'a')).st_ino)
+        self.assertTrue(path.exists(self._path('latest', 'b.dedup-tmp')))  # nothing removed
+
+    def test_resume(self):
+        # leftover of an interrupted link is cleaned up
+        os.link(self._path('latest', 'a'), self._path('latest', 'b.dedup-tmp'))
+        dedup([self._path('latest')], self.index_filepath)
+        self.assertFalse(path.exists(self._path('latest', 'b.dedup-tmp')))
+
+    def test_backup_dedup(self):
+        backup = Backup(source=Startpoint(self.tmp_dirpath), destination=Endpoint(
+            self._path('latest'), history=self._path('%Y-%m-%d-%H-%M')), deduplication=Dedup(self.index_filepath, min_size=1))
+        latest_inode = os.stat(self._path('latest', 'a')).st_ino
+        with contextlib.redirect_stdout(io.StringIO()):
+            backup.dedup()
+        self.assertEqual(os.stat(self._path('2024-07-22-13-26', 'a')).st_ino,
+                         os.stat(self._path('2024-07-22-13-26', 'moved', 'c')).st_ino)
+        # latest is left out: rsync updates its files in place (e.g. their modification time)
+        self.assertEqual(os.stat(self._path('latest', 'a')).st_ino, latest_inode)
+        self.assertEqual(os.stat(self._path('latest', 'a')).st_nlink, 1)
+        with self.assertRaises(ValueError):
+            Backup(source=Startpoint(self.tmp_dirpath), destination=Endpoint(self._path('latest')),
+                   deduplication=Dedup(self.index_filepath)).dedup()
+
+
+class TestRetention(unittest.TestCase):
+    def setUp(self):
+        self._tmp_dir = tempfile.TemporaryDirectory()
+        self.tmp_dirpath = self._tmp_dir.name
+
+    def tearDown(self):
+        self._tmp_dir.cleanup()
+
+    def test_select_kept(self):
+        # every 12 hours over 60 days
+        timestamps = [datetime(2024, 1, 1) + i * (datetime(2024, 1, 1, 12) - datetime(2024, 1, 1)) for i in range(120)]
+        kept = select_kept(timestamps, last=3)
+        self.assertEqual(kept, timestamps[-3:])
+        kept = select_kept(timestamps, last=1, daily=3)
+        self.assertEqual(kept, [datetime(2024, 2, 27, 12), datetime(2024, 2, 28, 12), datetime(2024, 2, 29, 12)])
+        kept = select_kept(timestamps, last=1, monthly=6)
+        self.assertEqual(kept, [datetime(2024, 1, 31, 12), datetime(2024, 2, 29, 12)])
+        kept = select_kept(timestamps, last=2, weekly=2)
+        self.assertEqual(kept, [datetime(2024, 2, 25, 12), datetime(2024, 2, 29), datetime(2024, 2, 29, 12)])
+
+    def _make_history(self, names):
+        for name in names:
+            os.makedirs(path.join(self.tmp_dirpath, name, 'sub'))
+            with open(path.join(self.tmp_dirpath, name, 'sub', 'file'), 'w') as f:
+                f.write(name)
+
+    def test_prune(self):
+        names = ['2024-01-01-00-00', '2024-01-02-00-00', '2024-01-02-12-00', '2024-01-03-00-00']
+        self._make_history(names + ['other'])
+        expired = expired_paths(path.join(self.tmp_dirpath, '%Y-%m-%d-%H-%M'), last=1, daily=2)
+        self.assertEqual([path.basename(p) for p in expired], ['2024-01-01-00-00', '2024-01-02-00-00'])
+        self.assertEqual(prune(expired, workers=2), [])
+        self.assertEqual(sorted(os.listdir(self.tmp_dirpath)), ['2024-01-02-12-00', '2024-01-03-00-00', 'other'])
+
+    def test_backup_prune(self):
+        self._make_history(['2024-01-01-00-00', '2024-01-02-00-00'])
+        backup = Backup(source=Startpoint('/tmp/a'), destination=Endpoint(
+            path.join(self.tmp_dirpath, 'latest'), history=path.join(self.tmp_dirpath, '%Y-%m-%d-%H-%M'),
+            retention=Retention(last=1)))
+        os.makedirs(backup._history_dirpath)  # this run history is never removed
+        backup.prune()
+        self.assertEqual(os.listdir(self.tmp_dirpath), [path.basename(backup._history_dirpath.rstrip('/'))])
+
+    def test_invalid(self):
+        with self.assertRaises(ValueError):
+            Backup(source=Startpoint('/tmp/a'), destination=Endpoint('/tmp/b', retention=Retention()))
+        with self.assertRaises(ValueError):
+            Backup(source=Startpoint('/tmp/a'), destination=Endpoint('/tmp/b', history='/tmp/%Y', retention=Retention(last=0)))
+
+
+class TestCatalog(unittest.TestCase):
+    def setUp(self):
+        self._tmp_dir = tempfile.TemporaryDirectory()
+        self.tmp_dirpath = self._tmp_dir.name
+        self.index_filepath = path.join(self.tmp_dirpath, 'catalog.db')
+
+    def tearDown(self):
+        self._tmp_dir.cleanup()
+
+    def _write(self, rel_path: str, content: str, mtime: int = 1700000000):
+        filepath = path.join(self.tmp_dirpath, rel_path)
+        os.makedirs(path.dirname(filepath), exist_ok=True)
+        with open(filepath, 'w') as f:
+            f.write(content)
+        os.utime(filepath, (mtime, mtime))
+
+    def test_record_run(self):
+        latest = path.join(self.tmp_dirpath, 'latest')
+        history = path.join(self.tmp_dirpath, '2024-01-02') + '/'
+        self._write('latest/a.txt', 'v1')
+        self._write('latest/dir/b', 'b')
+        with CatalogIndex(self.index_filepath) as catalog:
+            catalog.record_run(datetime(2024, 1, 1), latest, None, written=['a.txt', 'dir/b'], deleted=[])
+            # second run: a.txt updated and dir deleted, previous versions moved to history
+            os.makedirs(history)
+            os.rename(path.join(latest, 'a.txt'), path.join(history, 'a.txt'))
+            os.renames(path.join(latest, 'dir/b'), path.join(history, 'dir/b'))
+            self._write('latest/a.txt', 'v2.', mtime=1700000100)
+            catalog.record_run(datetime(2024, 1, 2), latest, history, written=['a.txt'], deleted=['dir/b', 'dir/'])
+            versions = catalog.versions('a.txt')
+            self.assertEqual([(v.since, v.until, v.size, v.location) for v in versions],
+                             [('2024-01-01T00:00:00', '2024-01-02T00:00:00', 2, history),
+                              ('2024-01-02T00:00:00', None, 3, None)])
+            [old] = catalog.versions('a.txt', at=datetime(2024, 1, 1, 12))
+            self.assertEqual(locate(old, latest, []), path.join(history, 'a.txt'))
+            self.assertEqual(catalog.versions('dir', at=datetime(2024, 1, 3)), [])
+            self.assertEqual([v.path for v in catalog.versions('*')], ['a.txt', 'a.txt', 'dir/b'])
+            catalog.forget(history)
+            self.assertEqual(len(catalog.versions('*')), 1)
+
+    def test_record_snapshots(self):
+        self._write('2024-01-01/a.txt', 'a')
+        self._write('2024-01-01/dir/b.txt', 'b')
+        with CatalogIndex(self.index_filepath) as catalog:
+            catalog.record_run(datetime(2024, 1, 1), path.join(self.tmp_dirpath, '2024-01-01'), None,
+                               written=['a.txt', 'dir/b.txt'], deleted=[], snapshot=True)
+            # dir/b.txt deleted from source: not in the next snapshot, and not itemized by rsync
+            self._write('2024-01-02/a.txt', 'a')
+            catalog.record_run(datetime(2024, 1, 2), path.join(self.tmp_dirpath, '2024-01-02'), None,
+                               written=[], deleted=[], snapshot=True)
+            self.assertEqual([(v.path, v.until) for v in catalog.versions('*')],
+                             [('a.txt', None), ('dir/b.txt', '2024-01-02T00:00:00')])
+            self.assertEqual(catalog.versions('dir', at=datetime(2024, 1, 3)), [])
+
+    def test_reindex_snapshots(self):
+        self._write('2024-01-01/a.txt', 'v1')
+        self._write('2024-01-01/b.txt', 'b')
+        self._write('2024-01-02/a.txt', 'v1')
+        self._write('2024-01-03/a.txt', 'v2.', mtime=1700000100)
+        snapshots = list_timestamped(path.join(self.tmp_dirpath, '%Y-%m-%d'))
+        with CatalogIndex(self.index_filepath) as catalog:
+            catalog.reindex_snapshots(snapshots)
+            self.assertEqual([(v.path, v.since, v.until) for v in catalog.versions('*')],
+                             [('a.txt', '2024-01-01T00:00:00', '2024-01-03T00:00:00'),
+                              ('a.txt', '2024-01-03T00:00:00', None),
+                              ('b.txt', '2024-01-01T00:00:00', '2024-01-02T00:00:00')])
+            [old] = catalog.versions('a.txt', at=datetime(2024, 1, 2, 12))
+        # most recent snapshot holding that version
+        self.assertEqual(locate(old, '', snapshots), path.join(self.tmp_dirpath, '2024-01-02', 'a.txt'))
+
+    @unittest.skipIf(sys.platform.startswith('win'), 'no shell script on windows')
+    def test_backup_find_restore(self):
+        source = path.join(self.tmp_dirpath, 'src')
+        latest = path.join(self.tmp_dirpath, 'latest')
+        self._write('src/a.txt', 'v1')
+        # rsync stand-in: copies a.txt, and reports it as itemized change
+        rsync_filepath = path.join(self.tmp_dirpath, 'rsync')
+        with open(rsync_filepath, 'w') as f:
+            f.write(f'#!/bin/sh\nmkdir -p {latest}\ncp -p {source}/a.txt {latest}/a.txt\n'
+                    'echo ">f+++++++++ 2 a.txt"\n')
+        os.chmod(rsync_filepath, 0o755)
+        backup = Backup(source=Startpoint(source), destination=Endpoint(latest),
+                        catalog=Catalog(self.index_filepath), rsync_local_path=rsync_filepath)
+        self.assertIn('--out-format=%i %l %n%L', backup._create_rsync_command())
+        self.assertEqual(backup.save(), 0)
+        output = io.StringIO()
+        with contextlib.redirect_stdout(output):
+            backup.find('a.txt', as_json=True)
+        [version] = json.loads(output.getvalue())
+        self.assertEqual((version['path'], version['size'], version['until']), ('a.txt', 2, None))
+        with contextlib.redirect_stdout(io.StringIO()):
+            backup.restore('a.txt', to=path.join(self.tmp_dirpath, 'restored'))
+            backup.reindex()
+        with open(path.join(self.tmp_dirpath, 'restored', 'a.txt')) as f:
+            self.assertEqual(f.read(), 'v1')
+        with CatalogIndex(self.index_filepath) as catalog:
+            self.assertEqual(len(catalog.versions('*')), 1)
+        with self.assertRaises(ValueError):
+            Backup(source=Startpoint(source), destination=Endpoint(latest, remote=True), server=Server('url'),
+                   catalog=Catalog(self.index_filepath))
+
+
+@unittest.skipIf(sys.platform.startswith('win'), 'no shell script on windows')
+class TestFanout(unittest.TestCase):
+    def setUp(self):
+        self._tmp_dir = tempfile.TemporaryDirectory()
+        self.tmp_dirpath = self._tmp_dir.name
+        self.calls_filepath = path.join(self.tmp_dirpath, 'calls.txt')
+
+    def tearDown(self):
+        self._tmp_dir.cleanup()
+
+    def _rsync(self, replay_code: int = 0) -> str:
+        """ rsync stand-in, recording its calls, replays exit with replay_code """
+        rsync_filepath = path.join(self.tmp_dirpath, 'rsync')
+        with open(rsync_filepath, 'w') as f:
+            f.write('#!/bin/sh\n'
+                    f'echo "$@" >> {self.calls_filepath}\n'
+                    f'case "$*" in *--read-batch=*) exit {replay_code};; esac\n'
+                    'exit 0\n')
+        os.chmod(rsync_filepath, 0o755)
+        return rsync_filepath
+
+    def _calls(self):
+        with open(self.calls_filepath) as f:
+            return [line.split() for line in f]
+
+    def _backup(self, destinations, **kwargs):
+        return Backup(source=Startpoint(path.join(self.tmp_dirpath, 'src')), destination=destinations, **kwargs)
+
+    def test_destinations(self):
+        backup = self._backup([Endpoint('/a', history='/a-%Y'), Endpoint('/b')])
+        self.assertEqual(backup.destination.path, '/a')
+        self.assertEqual(backup._destination_dirpath, '/a/')
+        self.assertEqual([f._destination_dirpath for f in backup._fanout], ['/b/'])
+        self.assertEqual(backup._fanout[0]._history_dirpath, None)
+        self.assertEqual(backup._fanout[0]._timestamp, backup._timestamp)
+        self.assertEqual(self._backup(Endpoint('/a'))._fanout, [])
+        with self.assertRaises(ValueError):
+            self._backup([Endpoint('/a'), Endpoint('/b')], sharding=Sharding(shards=2))
+
+    def test_batch(self):
+        backup = self._backup([Endpoint(path.join(self.tmp_dirpath, name)) for name in ['a', 'b', 'c']],
+                              rsync_local_path=self._rsync())
+        self.assertEqual(backup.save(), 0)
+        calls = self._calls()
+        self.assertEqual(len(calls), 3)
+        self.assertTrue(any(o.startswith('--write-batch=') for o in calls[0]))
+        for call, name in zip(calls[1:], ['b', 'c']):
+            self.assertTrue(any(o.startswith('--read-batch=') for o in call))
+            self.assertNotIn('--checksum', call)
+            self.assertEqual(call[-1], path.join(self.tmp_dirpath, name) + '/')
+
+    def test_replay_protect(self):
+        # rsync stand-in: a replay deletes the destination files, except those protected by a merged rules file
+        rsync_filepath = path.join(self.tmp_dirpath, 'rsync')
+        with open(rsync_filepath, 'w') as f:
+            f.write(f'#!{sys.executable}\n'
+                    'import os, sys\n'
+                    'if any(o.startswith("--read-batch=") for o in sys.argv):\n'
+                    '    protected = set()\n'
+                    '    for o in sys.argv:\n'
+                    '        if o.startswith("--filter=merge "):\n'
+                    '            protected |= {r.split()[1].lstrip("/") for r in open(o.split(" ", 1)[1])\n'
+                    '                          if r.startswith("protect ")}\n'
+                    '    for name in os.listdir(sys.argv[-1]):\n'
+                    '        if name not in protected:\n'
+                    '            os.remove(os.path.join(sys.argv[-1], name))\n')
+        os.chmod(rsync_filepath, 0o755)
+        os.makedirs(path.join(self.tmp_dirpath, 'src'))
+        for dirpath in ['src', 'b']:
+            for name in ['old.jpg', 'extra']:
+                filepath = path.join(self.tmp_dirpath, dirpath, name)
+                os.makedirs(path.dirname(filepath), exist_ok=True)
+                with open(filepath, 'w') as f:
+                    f.write('x')
+                os.utime(filepath, (1000000000, 1000000000))
+        os.utime(path.join(self.tmp_dirpath, 'src', 'extra'))
+        backup = self._backup([Endpoint(path.join(self.tmp_dirpath, name)) for name in ['a', 'b']],
+                              rsync_local_path=rsync_filepath, filters=Filters(max_age=365))
+        self.assertEqual(backup.save(), 0)
+        # the stale file is hidden from the transfer, and its copy is kept on the replayed destination
+        self.assertEqual(os.listdir(path.join(self.tmp_dirpath, 'b')), ['old.jpg'])
+
+    def test_replay_failed(self):
+        backup = self._backup([Endpoint(path.join(self.tmp_dirpath, name)) for name in ['a', 'b']],
+                              rsync_local_path=self._rsync(replay_code=12))
+        self.assertEqual(backup.save(), 0)
+        calls = self._calls()
+        self.assertEqual(len(calls), 3)
+        self.assertFalse(any(o.startswith('--read-batch=') for o in calls[2]))  # full transfer instead
+        self.assertEqual(calls[2][-2:], [path.join(self.tmp_dirpath, 'src') + '/', path.join(self.tmp_dirpath, 'b') + '/'])
+
+    def test_parallel(self):
+        backup = self._backup([Endpoint(path.join(self.tmp_dirpath, name)) for name in ['a', 'b']],
+                              rsync_local_path=self._rsync(), fanout='parallel')
+        self.assertEqual(backup.save(), 0)
+        calls = self._calls()
+        self.assertEqual(sorted(call[-1] for call in calls),
+                         [path.join(self.tmp_dirpath, 'a') + '/', path.join(self.tmp_dirpath, 'b') + '/'])
+        self.assertFalse(any(o.startswith('--write-batch=') for call in calls for o in call))
+
+
+@unittest.skipUnless(path.isdir('/proc/self'), 'no /proc')
+class TestTelemetry(unittest.TestCase):
+    def test_read_process(self):
+        sample = read_process(os.getpid())
+        self.assertGreater(sample['rss'], 0)
+        self.assertGreaterEqual(sample['peak_rss'], sample['rss'])
+        self.assertGreater(sample['cpu'], 0)
+        self.assertIsNone(read_process(2 ** 22 + 1))  # above pid_max
+
+    def test_sample_children(self):
+        # a shell and its busy python child, as rsync and ssh
+        process = subprocess.Popen(['sh', '-c', f'{sys.executable} -c "import time\nt = time.time()\n'
+                                                 f'while time.time() - t < 0.5: pass"; true'])
+        with Telemetry(interval=0.05) as telemetry:
+            telemetry.attach(process.pid)
+            time.sleep(0.3)
+            telemetry.detach(process.pid)
+            _, _, usage = os.wait4(process.pid, 0)
+            process.returncode = 0
+            telemetry.add_usage(usage)
+        self.assertGreater(len(telemetry.samples), 2)
+        self.assertEqual(max(s['processes'] for s in telemetry.samples), 2)
+        self.assertGreater(max(s['cpu_percent'] for s in telemetry.samples), 10)
+        summary = telemetry.summary()
+        self.assertEqual(summary['runs'], 1)
+        self.assertGreater(summary['cpu_user'] + summary['cpu_system'], 0.2)
+        self.assertGreater(summary['peak_rss'], 0)
+
+    def test_backup_telemetry(self):
+        with tempfile.TemporaryDirectory() as tmp_dirpath:
+            rsync_filepath = path.join(tmp_dirpath, 'rsync')
+            with open(rsync_filepath, 'w') as f:
+                f.write('#!/bin/sh\nsleep 0.2\nexit 0\n')
+            os.chmod(rsync_filepath, 0o755)
+            backup = Backup(source=Startpoint(path.join(tmp_dirpath, 'src')),
+                            destination=Endpoint(path.join(tmp_dirpath, 'dst')),
+                            logging=Logging(actions=path.join(tmp_dirpath, 'actions.log'),
+                                            telemetry=path.join(tmp_dirpath, 'telemetry.json')),
+                            rsync_local_path=rsync_filepath)
+            self.assertEqual(backup.save(), 0)
+            with open(path.join(tmp_dirpath, 'telemetry.json')) as f:
+                telemetry = json.load(f)
+            self.assertEqual(telemetry['summary']['runs'], 1)
+            self.assertGreaterEqual(len(telemetry['samples']), 2)
+            with open(path.join(tmp_dirpath, 'actions.log')) as f:
+                self.assertIn('telemetry: cpu ', f.read())
+
+
+@unittest.skipIf(sys.platform.startswith('win'), 'no shell script on windows')
+class TestRsyncDaemon(unittest.TestCase):
+    def setUp(self):
+        self._tmp_dir = tempfile.TemporaryDirectory()
+        self.tmp_dirpath = self._tmp_dir.name
+        with socket.socket() as s:
+            s.bind(('127.0.0.1', 0))
+            self.port = s.getsockname()[1]
+        # rsync stand-in: as daemon, keeps a copy of its config and accepts connections, otherwise records its calls
+        self.rsync_filepath = path.join(self.tmp_dirpath, 'rsync')
+        with open(self.rsync_filepath, 'w') as f:
+            f.write(f'#!{sys.executable}\n'
+                    'import shutil, socket, sys\n'
+                    'args = sys.argv[1:]\n'
+                    'if "--daemon" not in args:\n'
+                    f'    open({self.tmp_dirpath!r} + "/calls.txt", "a").write(" ".join(args) + "\\n")\n'
+                    '    sys.exit(0)\n'
+                    'option = lambda name: next(a.split("=", 1)[1] for a in args if a.startswith(name + "="))\n'
+                    f'shutil.copy(option("--config"), {self.tmp_dirpath!r} + "/rsyncd.conf")\n'
+                    'server = socket.socket()\n'
+                    'server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)\n'
+                    'server.bind(("127.0.0.1", int(option("--port"))))\n'
+                    'server.listen()\n'
+                    'while True:\n'
+                    '    server.accept()[0].close()\n')
+        os.chmod(self.rsync_filepath, 0o755)
+
+    def tearDown(self):
+        self._tmp_dir.cleanup()
+
+    def test_daemon(self):
+        config = daemon_config('backup', '/backup/latest/', username='user')
+        script = daemon_script(self.rsync_filepath, config, self.port, username='user', remote=False)
+        with RsyncDaemon(['sh', '-c', script], '127.0.0.1', self.port, secret='s3cr3t', timeout=10) as daemon:
+            self.assertTrue(daemon.running, daemon.error)
+            self.assertTrue(is_listening('127.0.0.1', self.port))
+            with open(path.join(self.tmp_dirpath, 'rsyncd.conf')) as f:
+                config = f.read()
+            secrets_filepath = re.search(r'secrets file = (.*)', config).group(1)
+            with open(secrets_filepath) as f:
+                self.assertEqual(f.read(), 'user:s3cr3t\n')
+            self.assertNotIn('s3cr3t', script)  # given on stdin, never in a command line
+            self.assertEqual(os.stat(secrets_filepath).st_mode & 0o077, 0)
+        self.assertIn('[backup]', config)
+        self.assertIn('path = /backup/latest/', config)
+        self.assertIn('auth users = user', config)
+        self.assertIn('address = 127.0.0.1', config)
+        self.assertIn('hosts allow = 127.0.0.1', config)
+        self.assertIn(f'uid = {os.getuid()}', config)
+        self.assertFalse(is_listening('127.0.0.1', self.port))
+        self.assertFalse(path.exists(secrets_filepath))  # config directory removed
+        with RsyncDaemon(['sh', '-c', 'exit 3'], '127.0.0.1', self.port, secret='secret', timeout=10) as daemon:
+            self.assertFalse(daemon.running)
+
+    def test_backup_spawn(self):
+        password_filepath = path.join(self.tmp_dirpath, 'secret')
+        with open(password_filepath, 'w') as f:
+            f.write('secret\n')
+        backup = Backup(source=Startpoint(path.join(self.tmp_dirpath, 'src')),
+                        destination=Endpoint('/backup/latest', remote=True),
+                        server=Server('127.0.0.1', username='user',
+                                      daemon=Daemon(port=self.port, spawn='local', password_file=password_filepath)),
+                        logging=Logging(errors=path.join(self.tmp_dirpath, 'errors.txt')),
+                        rsync_local_path=self.rsync_filepath)
+        self.assertEqual(backup.save(), 0)
+        with open(path.join(self.tmp_dirpath, 'calls.txt')) as f:
+            self.assertTrue(f.read().rstrip().endswith(f'rsync://user@127.0.0.1:{self.port}/backup/'))
+        with open(path.join(self.tmp_dirpath, 'rsyncd.conf')) as f:
+            self.assertIn('path = /backup/latest/', f.read())
+        errors_filepath = path.join(self.tmp_dirpath, 'errors.txt')
+        self.assertFalse(path.exists(errors_filepath) and os.path.getsize(errors_filepath))
+        self.assertFalse(is_listening('127.0.0.1', self.port))
+
+
+@unittest.skipIf(sys.platform.startswith('win'), 'no shell script on windows')
+class TestAsync(unittest.TestCase):
+    def setUp(self):
+        self._tmp_dir = tempfile.TemporaryDirectory()
+        self.tmp_dirpath = self._tmp_dir.name
+
+    def tearDown(self):
+        self._tmp_dir.cleanup()
+
+    def _backup(self, script: str) -> Backup:
+        rsync_filepath = path.join(self.tmp_dirpath, 'rsync')
+        with open(rsync_filepath, 'w') as f:
+            f.write('#!/bin/sh\n' + script)
+        os.chmod(rsync_filepath, 0o755)
+        return Backup(source=Startpoint(path.join(self.tmp_dirpath, 'src')),
+                      destination=Endpoint(path.join(self.tmp_dirpath, 'dst')),
+                      rsync_local_path=rsync_filepath)
+
+    def test_events(self):
+        backup = self._backup('printf "      1,024  50%%    1.00MB/s    0:00:01 (xfr#1, to-chk=1/2)\\r"\n'
+                              'echo ">f+++++++++ 1024 dir/file.txt"\n'
+                              'echo "Total file size: 2,048 bytes"\n')
+
+        async def main():
+            run = run_async(backup)
+            return [event async for event in run], await run
+
+        events, result = asyncio.run(main())
+        self.assertEqual([e['type'] for e in events], ['progress', 'change', 'finished'])
+        self.assertEqual(events[0]['percent'], 50)
+        self.assertEqual(events[1]['name'], 'dir/file.txt')
+        self.assertTrue(result.ok)
+        self.assertEqual(result.report['created']['files'], 1)
+        self.assertEqual(result.report['stats']['total_size'], 2048)
+
+    def test_timeout(self):
+        backup = self._backup('trap "exit 20" TERM\nwhile true; do sleep .1; done\n')
+        result = asyncio.run(self._await(run_async(backup, timeout=.5)))
+        self.assertTrue(result.timed_out)
+        self.assertEqual(result.code, 20)
+
+    def test_timeout_retry_delay(self):
+        backup = self._backup('echo "rsync: connection unexpectedly closed" >&2\nexit 30\n')
+        backup.retry = Retry(attempts=3, delay=60.)
+        start = time.monotonic()
+        result = asyncio.run(self._await(run_async(backup, timeout=.5)))
+        self.assertLess(time.monotonic() - start, 10.)  # no wait for the retry delay
+        self.assertTrue(result.timed_out)
+        self.assertEqual(result.code, 20)
+
+    def test_cancel(self):
+        backup = self._backup('trap "" TERM\nwhile true; do sleep .1; done\n')  # ignores SIGTERM
+
+        async def main():
+            run = run_async(backup, grace=.3)
+            task = asyncio.ensure_future(self._await(run))
+            await asyncio.sleep(.3)
+            task.cancel()
+            with self.assertRaises(asyncio.CancelledError):
+                await task
+            run = run_async(backup, grace=.3)
+            task = asyncio.ensure_future(self._await(run))
+            await asyncio.sleep(.3)
+            run.cancel()
+            return await task
+
+        result = asyncio.run(main())
+        self.assertTrue(result.cancelled)
+        self.assertEqual(result.code, -signal.SIGKILL)
+
+    @staticmethod
+    async def _await(run):
+        return await run
+
+
+class TestFilters(unittest.TestCase):
+    def setUp(self):
+        self._tmp_dir = tempfile.TemporaryDirectory()
+        self.src_dirpath = path.join(self._tmp_dir.name, 'source')
+        for name, size, mtime in [('a.txt', 10, 1700000000), ('b.tmp', 20, 1700000000),
+                                  ('cache/x', 30, 1700000000), ('photos/big.raw', 1000, 1700000000),
+                                  ('photos/old.jpg', 40, 1000000000), ('photos/thumbs/t.jpg', 5, 1700000000)]:
+            filepath = path.join(self.src_dirpath, name)
+            os.makedirs(path.dirname(filepath), exist_ok=True)
+            with open(filepath, 'w') as f:
+                f.write('x' * size)
+            os.utime(filepath, (mtime, mtime))
+        with open(path.join(self.src_dirpath, 'photos', '.backupignore'), 'w') as f:
+            f.write('# thumbnails\nthumbs/\n!keep\n')
+        self.patterns_filepath = path.join(self._tmp_dir.name, 'excludes.txt')
+        with open(self.patterns_filepath, 'w') as f:
+            f.write('*.tmp\n\ncache/\n*.tmp\n')
+
+    def tearDown(self):
+        self._tmp_dir.cleanup()
+
+    def test_read_patterns(self):
+        self.assertEqual(read_patterns(path.join(self.src_dirpath, 'photos', '.backupignore')), ['thumbs/', '!keep'])
+        self.assertEqual(read_patterns(self.patterns_filepath), ['*.tmp', 'cache/', '*.tmp'])
+
+    def test_compile_rules(self):
+        rules = compile_rules(['*.tmp', 'cache/', '*.tmp'], ignore_file='.backupignore',
+                              stale=['photos/old[1].jpg', 'archive/'])
+        self.assertEqual(rules, ['- *.tmp', '- cache/', 'dir-merge,- .backupignore',
+                                 'hide /photos/old\\[1].jpg', 'protect /photos/old\\[1].jpg',
+                                 'hide /archive/***', 'protect /archive/***'])
+        # the last matching pattern wins, the first matching rsync rule wins
+        self.assertEqual(compile_rules(['*.log', '!keep.log', '*.log']), ['- *.log', '+ keep.log'])
+        self.assertEqual(compile_rules(['*.log', '!keep.log']), ['+ keep.log', '- *.log'])
+        with self.assertRaises(ValueError):
+            compile_rules([], stale=[f'{i}.txt' for i in range(MAX_STALE_RULES + 1)])
+
+    def test_negation(self):
+        self.assertTrue(is_excluded('a.log', False, ['*.log', '!keep.log']))
+        self.assertFalse(is_excluded('keep.log', False, ['*.log', '!keep.log']))
+        self.assertTrue(is_excluded('keep.log', False, ['*.log', '!keep.log', 'keep.*']))
+        report = excluded_report(self.src_dirpath, ['*.txt', '!a.txt', '*.tmp'])
+        self.assertEqual(report['*.tmp'], dict(files=1, bytes=20))
+        self.assertEqual(report['*.txt'], dict(files=0, bytes=0))
+        self.assertNotIn('!a.txt', report)
+
+    def test_stale(self):
+        self.assertEqual(stale_paths(self.src_dirpath, max_age=365, now=1700000000), ['photos/old.jpg'])
+        for name in ['archive/2001/a.jpg', 'archive/2001/b.jpg', 'archive/2002/c.jpg']:
+            filepath = path.join(self.src_dirpath, name)
+            os.makedirs(path.dirname(filepath), exist_ok=True)
+            with open(filepath, 'w') as f:
+                f.write('x')
+            os.utime(filepath, (1000000000, 1000000000))
+        # a directory of old files is a single path
+        self.assertEqual(stale_paths(self.src_dirpath, max_age=365, now=1700000000), ['archive/', 'photos/old.jpg'])
+
+    def test_report(self):
+        report = excluded_report(self.src_dirpath, ['*.tmp', 'cache/', 'missing'], ignore_file='.backupignore',
+                                 max_size=100, max_age=365, now=1700000000)
+        self.assertEqual(report, {
+            '*.tmp': dict(files=1, bytes=20),
+            'cache/': dict(files=1, bytes=30),
+            'missing': dict(files=0, bytes=0),
+            'photos/.backupignore: thumbs/': dict(files=1, bytes=5),
+            'photos/.backupignore: !keep (ignored negation)': dict(files=0, bytes=0),
+            'max_size': dict(files=1, bytes=1000),
+            'max_age': dict(files=1, bytes=40),
+        })
+
+    def test_command(self):
+        backup = Backup(source=Startpoint(self.src_dirpath), destination=Endpoint('/destination'),
+                        exclude=['a', 'a', 'b'])
+        cmd = backup._create_rsync_command()
+        self.assertEqual([o for o in cmd if o.startswith('--exclude')], ['--exclude=a', '--exclude=b'])
+        backup = Backup(source=Startpoint(self.src_dirpath), destination=Endpoint('/destination'), exclude=['a'],
+                        filters=Filters(exclude_from=[self.patterns_filepath], ignore_file='.backupignore',
+                                        max_size='1G', max_age=3650))
+        cmd = backup._create_rsync_command()
+        self.assertFalse(any(o.startswith('--exclude') for o in cmd))
+        self.assertIn('--max-size=1G', cmd)
+        self.assertIn('--delete-after', cmd)
+        merge = [o for o in cmd if o.startswith('--filter=merge ')]
+        self.assertEqual(len(merge), 1)
+        with open(merge[0][len('--filter=merge '):]) as f:
+            rules = f.read().splitlines()
+        self.assertEqual(rules, ['- *.tmp', '- cache/', '- a', 'dir-merge,- .backupignore',
+                                 'hide /photos/old.jpg', 'protect /photos/old.jpg'])
+
+    def test_printed_command(self):
+        actions_filepath = path.join(self._tmp_dir.name, 'logs', 'actions.log')
+        backup = Backup(source=Startpoint(self.src_dirpath), destination=Endpoint('/destination'),
+                        filters=Filters(exclude_from=[self.patterns_filepath], max_age=3650),
+                        logging=Logging(actions=Path_f(actions_filepath)))
+        # printed rules are inline, the source is not walked
+        with contextlib.redirect_stdout(io.StringIO()) as output:
+            backup.debug()
+        self.assertIn("--filter='- *.tmp'", output.getvalue())
+        self.assertIn('plus hide and protect rules', output.getvalue())
+        self.assertNotIn('merge', output.getvalue())
+        self.assertIsNone(getattr(backup, '_filter_rules_filepath_cache', None))
+        # rules given to rsync are kept beside the actions log
+        cmd = backup._create_rsync_command()
+        self.assertIn(f'--filter=merge {actions_filepath}.filter', cmd)
+        with open(actions_filepath + '.filter') as f:
+            self.assertIn('hide /photos/old.jpg', f.read().splitlines())
+
+
+class TestBenchmark(unittest.TestCase):
+    def setUp(self):
+        self._tmp_dir = tempfile.TemporaryDirectory()
+        self.tmp_dirpath = self._tmp_dir.name
+        self.spec = TreeSpec(tiny_files=200, tiny_size=64, huge_files=1, huge_size=1 << 16, depth=3, fanout=3)
+
+    def tearDown(self):
+        self._tmp_dir.cleanup()
+
+    def _listing(self, root: str):
+        listing = {}
+        for dirpath, _, filenames in os.walk(root):
+            for filename in filenames:
+                with open(path.join(dirpath, filename), 'rb') as f:
+                    listing[path.relpath(path.join(dirpath, filename), root)] = f.read()
+        return listing
+
+    def test_reproducible(self):
+        for name in ['a', 'b']:
+            generate_tree(path.join(self.tmp_dirpath, name), self.spec)
+        first = self._listing(path.join(self.tmp_dirpath, 'a'))
+        self.assertEqual(first, self._listing(path.join(self.tmp_dirpath, 'b')))
+        self.assertEqual(len(first), 201)
+        self.assertEqual(len(first['huge/h0.bin']), 1 << 16)
+
+    def test_churn(self):
+        root = path.join(self.tmp_dirpath, 'a')
+        generate_tree(root, self.spec)
+        before = self._listing(root)
+        counts = apply_churn(root, self.spec, ChurnSpec(modify=0.1, touch=0., create=0.05, delete=0.1, append=10))
+        self.assertEqual(counts, dict(modify=20, touch=0, delete=20, create=10, append=1))
+        after = self._listing(root)
+        self.assertEqual(len(after), len(before) - 20 + 10)
+        self.assertEqual(len(after['huge/h0.bin']), (1 << 16) + 10)
+
+    @unittest.skipIf(sys.platform.startswith('win'), 'no shell script on windows')
+    def test_run_variant(self):
+        rsync_filepath = path.join(self.tmp_dirpath, 'rsync')
+        with open(rsync_filepath, 'w') as f:
+            f.write('#!/bin/sh\nexit 0\n')
+        os.chmod(rsync_filepath, 0o755)
+        result = run_variant(dict(name='fake', config=dict(rsync_local_path=rsync_filepath)),
+                             self.spec, ChurnSpec(), runs=2)
+        self.assertEqual(result['initial']['code'], 0, result['initial']['errors'])
+        self.assertEqual(len(result['incremental']), 2)
+        self.assertGreater(result['initial']['peak_rss'], 0)
+        self.assertGreater(result['initial']['wall'], 0)
+
+
+class TestVerify(unittest.TestCase):
+    def setUp(self):
+        self._tmp_dir = tempfile.TemporaryDirectory()
+        self.src_dirpath = path.join(self._tmp_dir.name, 'source')
+        self.dst_dirpath = path.join(self._tmp_dir.name, 'latest')
+        for root in [self.src_dirpath, self.dst_dirpath]:
+            for name in ['a', 'dir/b', 'dir/c']:
+                self._write(path.join(root, name), name)
+
+    def tearDown(self):
+        self._tmp_dir.cleanup()
+
+    @staticmethod
+    def _write(filepath: str, content: str, mtime: int = 1700000000):
+        os.makedirs(path.dirname(filepath), exist_ok=True)
+        with open(filepath, 'w') as f:
+            f.write(content)
+        os.utime(filepath, (mtime, mtime))
+
+    def test_in_sample(self):
+        paths = [f'file{i}' for i in range(1000)]
+        samples = [{p for p in paths if in_sample(p, 0.1, rotation)} for rotation in range(10)]
+        self.assertEqual(sum(len(s) for s in samples), 1000)  # every file once over 10 rotations
+        self.assertEqual(set().union(*samples), set(paths))
+        self.assertTrue(all(in_sample(p, 1., 3) for p in paths))
+
+    def test_verify_trees(self):
+        self._write(path.join(self.dst_dirpath, 'dir/b'), 'dir/X')  # bit rot: same size and time
+        os.remove(path.join(self.dst_dirpath, 'dir/c'))
+        self._write(path.join(self.src_dirpath, 'd'), 'new', mtime=1800000000)  # not transferred yet
+        self._write(path.join(self.dst_dirpath, 'd'), 'old')
+        result, manifest = verify_trees(self.src_dirpath, self.dst_dirpath, excludes=[], workers=2)
+        self.assertEqual(result.checked, 2)
+        self.assertEqual(result.mismatched, ['dir/b'])
+        self.assertEqual(result.missing, ['dir/c'])
+        self.assertEqual(result.skipped, 1)
+        self.assertEqual(list(manifest), ['a'])
+
+    def test_verify_manifest(self):
+        result, manifest = verify_trees(self.src_dirpath, self.dst_dirpath, excludes=[], workers=2)
+        self.assertTrue(result.ok)
+        shutil.rmtree(self.src_dirpath)  # only destination is read
+        self.assertTrue(verify_manifest(self.dst_dirpath, manifest, workers=2).ok)
+        self._write(path.join(self.dst_dirpath, 'a'), 'b')
+        self.assertEqual(verify_manifest(self.dst_dirpath, manifest, workers=2).mismatched, ['a'])
+
+    def test_backup_verify(self):
+        history = path.join(self._tmp_dir.name, '%Y-%m-%d-%H-%M')
+        manifest_filepath = path.join(self._tmp_dir.name, 'state', 'verify.json')
+        backup = Backup(source=Startpoint(self.src_dirpath), destination=Endpoint(self.dst_dirpath, history=history),
+                        verification=Verification(workers=2, manifest=manifest_filepath))
+        with self.assertRaises(ValueError):
+            backup.verify(one_side=True)  # no manifest yet
+        self.assertTrue(backup.verify())
+        self.assertTrue(path.exists(manifest_filepath))
+        self.assertFalse(path.exists(backup._history_dirpath))  # nothing written in the backup
+        self.assertTrue(backup.verify(one_side=True))
+
+    def test_backup_verify_filters(self):
+        # files rsync does not transfer are not missing
+        self._write(path.join(self.src_dirpath, 'big'), 'x' * 1000)
+        self._write(path.join(self.src_dirpath, 'dir/old'), 'old', mtime=1000000000)
+        self._write(path.join(self.src_dirpath, 'dir/cache/d'), 'd')
+        for root in [self.src_dirpath, self.dst_dirpath]:
+            self._write(path.join(root, 'dir/.ignore'), 'cache/\n')
+        backup = Backup(source=Startpoint(self.src_dirpath), destination=Endpoint(self.dst_dirpath),
+                        filters=Filters(ignore_file='.ignore', max_size='100', max_age=3650),
+                        verification=Verification(workers=2))
+        result = backup._verify(self.dst_dirpath)
+        self.assertEqual(result.missing, [])
+
+
 class TestProcess(unittest.TestCase):
     def setUp(self):
         # Create a temporary directory